@@ -0,0 +1,171 @@
+# AnchorIndex.py ---
+#
+# Description: Neighborhood queries around anchor points (TSSs, CTCF
+# sites) for several radii at once.
+#
+# The features of a chromosome are kept as sorted start and end arrays.
+# The number of features overlapping [a - d, a + d] is
+# #{start <= a + d} - #{end < a - d}, two binary searches per anchor and
+# radius. The nearest feature left of an anchor is the one with the
+# largest end among the features starting at or before it (running
+# maximum over the features sorted by start), the nearest one to the right
+# is the first feature starting after it.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import unittest
+import numpy
+
+from IntervalTree import Interval
+
+
+class AnchorIndex:
+    def __init__(self, starts, ends, ids=None):
+        '''
+        Builds the index from arrays of feature start and end points (one chromosome).
+
+        @arg starts: feature start points
+        @arg ends: feature end points
+        @arg ids: feature ids reported by nearest() (default: position in input)
+        '''
+        starts = numpy.asarray(starts)
+        ends = numpy.asarray(ends)
+        if ids is None:
+            ids = numpy.arange(len(starts))
+        order = numpy.argsort(starts, kind='mergesort')
+        self.starts = starts[order]
+        self.ids = numpy.asarray(ids)[order]
+        self.sorted_ends = numpy.sort(ends)
+        ends = ends[order]
+        if len(order) > 0:
+            self.max_ends = numpy.maximum.accumulate(ends)
+            # position of the feature attaining max_ends
+            is_max = numpy.r_[True, ends[1:] > self.max_ends[:-1]]
+            self.max_end_position = numpy.maximum.accumulate(numpy.where(is_max, numpy.arange(len(ends)), 0))
+        else:
+            self.max_ends = ends
+            self.max_end_position = numpy.zeros(0, dtype=numpy.intp)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def count_within(self, anchors, radii):
+        '''
+        Number of features overlapping [anchor - radius, anchor + radius]
+
+        @arg anchors: array of anchor positions
+        @arg radii: array of radii
+        @return anchors x radii int64 array
+        '''
+        anchors = numpy.asarray(anchors, dtype=numpy.int64)
+        radii = numpy.asarray(radii, dtype=numpy.int64)
+        # binary searches for sorted anchors touch the arrays in order
+        order = numpy.argsort(anchors)
+        sorted_anchors = anchors[order]
+        counts = numpy.empty((len(anchors), len(radii)), dtype=numpy.int64)
+        for (j, radius) in enumerate(radii.tolist()):
+            counts[order, j] = numpy.searchsorted(self.starts, sorted_anchors + radius, 'right') - numpy.searchsorted(self.sorted_ends, sorted_anchors - radius, 'left')
+        return counts
+
+    def nearest(self, anchors):
+        '''
+        Nearest feature of each anchor
+
+        The distance is 0 for features containing the anchor (start <= anchor <= end),
+        anchor - end for features left of it and start - anchor for features right of it.
+
+        @arg anchors: array of anchor positions
+        @return (distances, ids) arrays, distance -1 and id -1 if there are no features
+        '''
+        anchors = numpy.asarray(anchors, dtype=numpy.int64)
+        distances = numpy.empty(len(anchors), dtype=numpy.int64)
+        distances.fill(-1)
+        ids = numpy.empty(len(anchors), dtype=self.ids.dtype if len(self) > 0 else numpy.intp)
+        ids.fill(-1)
+        if len(self) == 0:
+            return (distances, ids)
+        position = numpy.searchsorted(self.starts, anchors, 'right')
+        ############################################################
+        ## left: largest end among features starting at or before the anchor
+        ############################################################
+        has_left = position > 0
+        left = numpy.maximum(position - 1, 0)
+        left_distance = numpy.maximum(anchors - self.max_ends[left], 0)
+        left_distance[~has_left] = numpy.iinfo(numpy.int64).max
+        ############################################################
+        ## right: first feature starting after the anchor
+        ############################################################
+        has_right = position < len(self)
+        right = numpy.minimum(position, len(self) - 1)
+        right_distance = self.starts[right] - anchors
+        right_distance[~has_right] = numpy.iinfo(numpy.int64).max
+        use_left = left_distance <= right_distance
+        distances = numpy.where(use_left, left_distance, right_distance)
+        ids = numpy.where(use_left, self.ids[self.max_end_position[left]], self.ids[right])
+        return (distances, ids)
+
+
+############################################################
+# Per-chromosome queries on IntervalTables (see bed_loader)
+############################################################
+def table_neighborhoods(anchors, anchor_positions, features, radii, with_nearest=False):
+    '''
+    Neighborhood counts for anchors and features on all chromosomes
+
+    @arg anchors: IntervalTable giving the chromosome of each anchor
+    @arg anchor_positions: anchor position of each row of anchors
+    @arg features: IntervalTable of features
+    @arg radii: array of radii
+    @arg with_nearest: also return the nearest feature of each anchor
+    @return counts (anchors x radii), or (counts, distances, feature rows) if with_nearest
+            is set - feature rows index features, -1 on chromosomes without features
+    '''
+    anchor_positions = numpy.asarray(anchor_positions)
+    counts = numpy.zeros((len(anchors), len(radii)), dtype=numpy.int64)
+    distances = numpy.empty(len(anchors), dtype=numpy.int64)
+    distances.fill(-1)
+    nearest_rows = numpy.empty(len(anchors), dtype=numpy.int64)
+    nearest_rows.fill(-1)
+    feature_rows = dict(features.chromosome_groups())
+    for (chr, rows) in anchors.chromosome_groups():
+        if chr not in feature_rows:
+            continue
+        index = AnchorIndex(features.start[feature_rows[chr]], features.end[feature_rows[chr]], feature_rows[chr])
+        counts[rows] = index.count_within(anchor_positions[rows], radii)
+        if with_nearest:
+            (distances[rows], nearest_rows[rows]) = index.nearest(anchor_positions[rows])
+    if with_nearest:
+        return (counts, distances, nearest_rows)
+    return counts
+
+
+class TestAnchorIndex(unittest.TestCase):
+    def setUp(self):
+        self.interval_list = [Interval(20, 30, 0), Interval(0, 20, 1), Interval(0, 10, 2), Interval(15, 25, 3), Interval(40, 50, 4), Interval(50, 60, 5)]
+        self.index = AnchorIndex([x.left for x in self.interval_list], [x.right for x in self.interval_list])
+        self.anchors = [-5, 0, 12, 33, 37, 45, 70]
+        self.radii = [0, 3, 10]
+
+    def test_count_within(self):
+        counts = self.index.count_within(self.anchors, self.radii)
+        for (i, a) in enumerate(self.anchors):
+            for (j, d) in enumerate(self.radii):
+                Q = Interval(a - d, a + d)
+                # closed windows: features touching the window count
+                expected = len([x for x in self.interval_list if x.left <= Q.right and x.right >= Q.left])
+                self.assertEqual(counts[i, j], expected)
+
+    def test_nearest(self):
+        (distances, ids) = self.index.nearest(self.anchors)
+        for (i, a) in enumerate(self.anchors):
+            expected = min(max(x.left - a, a - x.right, 0) for x in self.interval_list)
+            self.assertEqual(distances[i], expected)
+            x = self.interval_list[ids[i]]
+            self.assertEqual(max(x.left - a, a - x.right, 0), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,76 +1,197 @@
+import re
+import unittest
 
-import re 
+import numpy
 
-GROSEQ_DEFAULT_SEPARATOR="\t" 
+GROSEQ_DEFAULT_SEPARATOR="\t"
+
+''' Sort keys of chromosome names seen so far, see chromosome_sort_key() '''
+_chromosome_keys = dict()
 
 ############################################################
-# Class for GROSeq records 
+# Natural chromosome order (chr2 before chr10)
 ############################################################
-class GROSeqRecord:
+def natural_chromosome_key(chromosome):
+    ''' Sort key placing chr2 before chr10 '''
+    return tuple(int(x) if x.isdigit() else x for x in re.split('(\d+)', chromosome))
+
+def chromosome_sort_key(chromosome):
+    ''' natural_chromosome_key(), computed once per chromosome name '''
+    key = _chromosome_keys.get(chromosome)
+    if key is None:
+        key = natural_chromosome_key(chromosome)
+        _chromosome_keys[chromosome] = key
+    return key
+
+def site_sort_key(site):
+    ''' Sort key of a (chromosome, peak_start, peak_end) tuple '''
+    return (chromosome_sort_key(site[0]), site[1], site[2])
+
+def natural_chromosome_ranks(chromosome_names):
+    ''' Rank of each name in natural chromosome order (array indexed like chromosome_names) '''
+    order = sorted(range(len(chromosome_names)), key=lambda k: chromosome_sort_key(chromosome_names[k]))
+    ranks = numpy.zeros(len(chromosome_names), dtype=numpy.int64)
+    ranks[order] = numpy.arange(len(chromosome_names))
+    return ranks
+
+''' Bits for the peak start in packed sort keys '''
+POSITION_BITS = 40
+
+def packed_sort_keys(chromosome_ranks, peak_starts):
     '''
-    GROSeqRecord - chromosome, peak_start, peak_end 
+    Integer sort keys rank * 2^POSITION_BITS + peak_start
+
+    Sorting the keys (numpy.argsort) orders peaks by natural chromosome
+    order and then peak start.
+
+    @arg chromosome_ranks: chromosome rank of each peak (see natural_chromosome_ranks)
+    @arg peak_starts: peak starts, 0 <= peak_start < 2^POSITION_BITS
+    @return int64 array
     '''
-    def __init__(self, _chr, _ps, _pe, sep=GROSEQ_DEFAULT_SEPARATOR, strand=None): 
-        self.separator = sep
+    return (numpy.asarray(chromosome_ranks, dtype=numpy.int64) << POSITION_BITS) + numpy.asarray(peak_starts, dtype=numpy.int64)
+
+############################################################
+# Class for GROSeq records
+############################################################
+class GROSeqRecord(object):
+    '''
+    GROSeqRecord - chromosome, peak_start, peak_end
+
+    Records order by natural chromosome order and then peak start; the
+    key is computed once in the constructor (sort_key). sep is the
+    separator of __str__ and __repr__; it is only stored (_separator) when
+    it differs from GROSEQ_DEFAULT_SEPARATOR.
+    '''
+    __slots__ = ('chromosome', 'peak_start', 'peak_end', 'strand', 'sort_key', '_separator')
+
+    def __init__(self, _chr, _ps, _pe, sep=GROSEQ_DEFAULT_SEPARATOR, strand=None):
         self.chromosome = _chr
         try:
             self.peak_start = int(_ps)
         except ValueError:
             self.peak_start = int(round(float(_ps)))
-        try: 
+        try:
             self.peak_end = int(_pe)
         except ValueError:
-            self.peak_end = int(round(float(_ps))) 
-        
+            self.peak_end = int(round(float(_pe)))
         self.strand = strand
-        
+        self.sort_key = (chromosome_sort_key(_chr), self.peak_start)
+        if sep != GROSEQ_DEFAULT_SEPARATOR:
+            self._separator = sep
+
+    @property
+    def separator(self):
+        try:
+            return self._separator
+        except AttributeError:
+            return GROSEQ_DEFAULT_SEPARATOR
+
+    @separator.setter
+    def separator(self, sep):
+        self._separator = sep
 
-    ''' Class method that constructs GROSeqRecord from GROSeq string''' 
+    ''' Class method that constructs GROSeqRecord from GROSeq string'''
     @classmethod
-    def read_record(cls, record, sep=GROSEQ_DEFAULT_SEPARATOR): 
-        result = re.split('\s', record)
-        if (len(result) == 6) and ((result[5] is '+') or  (result[5] is '-')):
+    def read_record(cls, record, sep=GROSEQ_DEFAULT_SEPARATOR):
+        result = record.split()
+        if (len(result) == 6) and ((result[5] == '+') or  (result[5] == '-')):
             strand = result[5]
         else:
             strand = None
-        obj = cls(result[0] , result[1], result[2], sep, strand)
-        return obj 
+        return cls(result[0] , result[1], result[2], sep, strand)
 
     def __eq__(self, other):
         return ((self.chromosome, self.peak_start, self.peak_end) ==
                 (other.chromosome, other.peak_start, other.peak_end))
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __hash__(self):
         return hash((self.chromosome, self.peak_start, self.peak_end))
 
-    def __cmp__(self, other): 
-        first_cmp = cmp(self.chromosome, other.chromosome)
-        if first_cmp is 0:
-            return cmp(self.peak_start, other.peak_start)
-        else:
-            return first_cmp 
-    def __repr__(self): 
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
+
+    def __cmp__(self, other):
+        return cmp(self.sort_key, other.sort_key)
+
+    def __repr__(self):
         return self.separator.join([ self.chromosome, str(self.peak_start), str(self.peak_end) ])
-    def __str__(self): 
+
+    def __str__(self):
         return self.separator.join([ self.chromosome, str(self.peak_start), str(self.peak_end) ])
 
+############################################################
+# Bulk parsing, sorting and formatting
+############################################################
+def read_records(lines, sep=GROSEQ_DEFAULT_SEPARATOR):
+    ''' List of GROSeqRecords of GROSeq lines (blank lines skipped), printed with sep '''
+    return [GROSeqRecord.read_record(line, sep) for line in lines if line.strip()]
+
+def sort_records(records):
+    ''' Sorts a list of GROSeqRecords in place by their precomputed keys '''
+    records.sort(key=lambda record: record.sort_key)
+    return records
+
+def format_records(records, sep=GROSEQ_DEFAULT_SEPARATOR):
+    ''' One CHROMOSOME PEAK_START PEAK_END line per record '''
+    return ''.join('%s%s%d%s%d\n' % (r.chromosome, sep, r.peak_start, sep, r.peak_end) for r in records)
+
 ############################################################
 # Function from comparing two GROSeq string records
-# @arg x: GROSeq record string 
+# @arg x: GROSeq record string
 # @arg y: GROSeq record string
-# @return cmp_val: comparison between x and y 
+# @return cmp_val: comparison between x and y
+#
+# @note Sorting with key=GROSeqStringKey splits each string once
+#       instead of on every comparison
 #
-# @note Same is achieved by GROSeqRecord class comparator
-#       but sorting seems to be a bit faster using GROSeqRecord
-# 
 ############################################################
+def GROSeqStringKey(x):
+    rx = x.split()
+    return (chromosome_sort_key(rx[0]), int(rx[1]))
+
 def GROSeqStringCmp(x , y):
-    rx = re.split('\s', x)
-    ry = re.split('\s', y)
-    first_cmp = cmp(rx[0], ry[0])
-    second_cmp = cmp(int(rx[1]), int(ry[1]))
-    if not (first_cmp == 0):
-        return first_cmp
-    else:
-        return second_cmp 
+    return cmp(GROSeqStringKey(x), GROSeqStringKey(y))
+
+
+class TestGROSeqRecord(unittest.TestCase):
+    def test_natural_order(self):
+        lines = ['chr10\t5\t6', 'chr2\t7\t8', 'chr2\t3\t4', 'chrX\t1\t2', 'chr1\t9\t10']
+        records = sort_records(read_records(lines))
+        self.assertEqual(format_records(records), 'chr1\t9\t10\nchr2\t3\t4\nchr2\t7\t8\nchr10\t5\t6\nchrX\t1\t2\n')
+        self.assertEqual(sorted(lines, key=GROSeqStringKey), [str(r) for r in records])
+
+    def test_packed_keys(self):
+        names = ['chr10', 'chr2', 'chrX', 'chr1']
+        codes = numpy.array([0, 1, 1, 2, 3])
+        starts = numpy.array([5, 7, 3, 1, 9])
+        order = numpy.argsort(packed_sort_keys(natural_chromosome_ranks(names)[codes], starts))
+        self.assertEqual(order.tolist(), [4, 2, 1, 0, 3])
+
+    def test_record(self):
+        record = GROSeqRecord.read_record('chr1 10554 10555.4 n 2 -')
+        self.assertEqual((record.peak_start, record.peak_end, record.strand), (10554, 10555, '-'))
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_constructor(self):
+        record = GROSeqRecord('chr1', '5', '6', '\t', '+')
+        self.assertEqual((record.peak_start, record.peak_end, record.strand), (5, 6, '+'))
+        self.assertEqual(GROSeqRecord('chr1', 5, 6, strand='-').strand, '-')
+        self.assertEqual(GROSeqRecord('chr1', 5, 6, ' ').strand, None)
+
+    def test_separator(self):
+        record = GROSeqRecord('chr1', 5, 6)
+        self.assertEqual((str(record), repr(record)), ('chr1\t5\t6', 'chr1\t5\t6'))
+        self.assertFalse(hasattr(record, '_separator'))
+        self.assertEqual(str(GROSeqRecord('chr1', 5, 6, ',')), 'chr1,5,6')
+        ## lines are split on white space, sep is the output separator
+        records = read_records(['chr1 5 6 n 0 +', 'chr2\t7\t8'], ',')
+        self.assertEqual([str(r) for r in records], ['chr1,5,6', 'chr2,7,8'])
+        self.assertEqual(records[0].strand, '+')
+        record.separator = ' '
+        self.assertEqual(str(record), 'chr1 5 6')
 
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+# IntervalIndex.py ---
+#
+# Description: Static interval index on contiguous integer arrays.
+#
+# The regions are kept as three flat arrays sorted by start point
+# (starts, ends, ids) together with the running maximum of the end
+# points. For a query (l, r) every region that can overlap it lies in
+# the slice [searchsorted(max_ends, l), searchsorted(starts, r)), so a
+# query costs two binary searches plus a scan of the candidate slice.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import unittest
+import numpy
+
+from IntervalTree import Interval, IntervalTree
+
+''' Maximum number of candidate (query, region) pairs expanded at once in batch queries '''
+BATCH_CANDIDATES = 1 << 22
+
+
+############################################################
+# Expand [lo, hi) ranges into (range_idx, position) pairs
+############################################################
+def expand_ranges(lo, hi):
+    '''
+    Expands the half-open ranges [lo[k], hi[k]) into flat arrays
+
+    @arg lo: array of range beginnings
+    @arg hi: array of range ends (empty if hi <= lo)
+    @return (range_idx, position) with one entry per element of each range
+    '''
+    counts = numpy.maximum(hi - lo, 0)
+    total = int(counts.sum())
+    range_idx = numpy.repeat(numpy.arange(len(lo)), counts)
+    offsets = numpy.cumsum(counts) - counts
+    position = numpy.arange(total) + numpy.repeat(lo - offsets, counts)
+    return (range_idx, position)
+
+
+############################################################
+# Number of intervals enclosed by each region
+############################################################
+def count_enclosed(region_starts, region_ends, starts, ends):
+    '''
+    Counts, for every region, the intervals it encloses (see Interval.encloses)
+
+    The count of {start >= rs, end <= re} is #{end <= re} - #{start < rs}
+    + #{start < rs, end > re}, the first two terms by binary search in the
+    sorted start and end points. Intervals in the last term are longer than
+    the region, so only intervals longer than the shortest region are
+    matched against the regions with an IntervalIndex.
+
+    @arg region_starts, region_ends: region start and end points
+    @arg starts, ends: interval start and end points
+    @return array with the number of intervals enclosed by each region
+    '''
+    region_starts = numpy.asarray(region_starts)
+    region_ends = numpy.asarray(region_ends)
+    starts = numpy.asarray(starts)
+    ends = numpy.asarray(ends)
+    if len(region_starts) == 0 or len(starts) == 0:
+        return numpy.zeros(len(region_starts), dtype=numpy.int64)
+    counts = numpy.searchsorted(numpy.sort(ends), region_ends, 'right') - numpy.searchsorted(numpy.sort(starts), region_starts, 'left')
+    counts = counts.astype(numpy.int64)
+    long_intervals = numpy.flatnonzero((ends - starts) > (region_ends - region_starts).min())
+    if len(long_intervals) > 0:
+        long_starts = starts[long_intervals]
+        long_ends = ends[long_intervals]
+        (region_idx, interval_idx) = IntervalIndex(long_starts, long_ends).batch_enclosing_search(region_starts, region_ends)
+        spanning = (long_starts[interval_idx] < region_starts[region_idx]) & (long_ends[interval_idx] > region_ends[region_idx])
+        counts = counts + numpy.bincount(region_idx[spanning], minlength=len(region_starts))
+    return counts
+
+def count_enclosed_indexed(region_starts, region_ends, starts, ends, chunk_size=BATCH_CANDIDATES):
+    '''
+    Same counts as count_enclosed(), from an IntervalIndex over the regions
+
+    The intervals are not sorted: they are matched against the region index
+    chunk_size at a time, so the cost is about len(starts) * log(len(region_starts))
+    plus the number of hits.
+    '''
+    region_starts = numpy.asarray(region_starts)
+    region_ends = numpy.asarray(region_ends)
+    starts = numpy.asarray(starts)
+    ends = numpy.asarray(ends)
+    counts = numpy.zeros(len(region_starts), dtype=numpy.int64)
+    if len(region_starts) == 0 or len(starts) == 0:
+        return counts
+    index = IntervalIndex(region_starts, region_ends)
+    for lo in xrange(0, len(starts), chunk_size):
+        (interval_idx, region_idx) = index.batch_enclosing_search(starts[lo:lo + chunk_size], ends[lo:lo + chunk_size])
+        counts += numpy.bincount(region_idx, minlength=len(region_starts))
+    return counts
+
+
+class IntervalIndex:
+    def __init__(self, starts, ends, ids=None):
+        '''
+        Builds the index from arrays of region start and end points.
+
+        @arg starts: region start points
+        @arg ends: region end points
+        @arg ids: region ids reported by the queries (default: position in input)
+        '''
+        starts = numpy.asarray(starts)
+        ends = numpy.asarray(ends)
+        if ids is None:
+            ids = numpy.arange(len(starts))
+        order = numpy.argsort(starts, kind='mergesort')
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.ids = numpy.asarray(ids)[order]
+        self.max_ends = numpy.maximum.accumulate(self.ends) if len(order) > 0 else self.ends
+
+    @classmethod
+    def init_from_list(cls, interval_list):
+        ''' Same input as IntervalTree.init_from_list() - list of Interval objects '''
+        starts = [x.left for x in interval_list]
+        ends = [x.right for x in interval_list]
+        ids = [(i if x.id is None else x.id) for (i, x) in enumerate(interval_list)]
+        return cls(starts, ends, ids)
+
+    def __len__(self):
+        return len(self.starts)
+
+    ############################################################
+    # Single queries - return arrays of region ids
+    ############################################################
+    def overlapping_interval_search(self, Q):
+        ''' ids of regions x with x.left < Q.right and x.right > Q.left (see Interval.has_overlap) '''
+        lo = numpy.searchsorted(self.max_ends, Q.left, 'right')
+        hi = numpy.searchsorted(self.starts, Q.right, 'left')
+        candidates = numpy.arange(lo, hi)
+        return self.ids[candidates[self.ends[lo:hi] > Q.left]]
+
+    def enclosing_interval_search(self, Q):
+        ''' ids of regions x with x.left <= Q.left and x.right >= Q.right (see Interval.encloses) '''
+        lo = numpy.searchsorted(self.max_ends, Q.right, 'left')
+        hi = numpy.searchsorted(self.starts, Q.left, 'right')
+        candidates = numpy.arange(lo, hi)
+        return self.ids[candidates[self.ends[lo:hi] >= Q.right]]
+
+    ############################################################
+    # Batch queries - return (query_idx, region_id) hit pairs
+    ############################################################
+    def batch_overlapping_search(self, query_starts, query_ends):
+        '''
+        Overlap query for arrays of intervals.
+
+        @return (query_idx, region_id) arrays, one entry per overlapping pair
+        '''
+        query_starts = numpy.asarray(query_starts)
+        query_ends = numpy.asarray(query_ends)
+        lo = numpy.searchsorted(self.max_ends, query_starts, 'right')
+        hi = numpy.searchsorted(self.starts, query_ends, 'left')
+        return self._batch_filter(lo, hi, query_starts, False)
+
+    def batch_enclosing_search(self, query_starts, query_ends):
+        '''
+        Enclosing query for arrays of intervals.
+
+        @return (query_idx, region_id) arrays, one entry per region enclosing a query
+        '''
+        query_starts = numpy.asarray(query_starts)
+        query_ends = numpy.asarray(query_ends)
+        lo = numpy.searchsorted(self.max_ends, query_ends, 'left')
+        hi = numpy.searchsorted(self.starts, query_starts, 'right')
+        return self._batch_filter(lo, hi, query_ends, True)
+
+    def _batch_filter(self, lo, hi, bound, inclusive):
+        ''' Expands candidate slices in chunks of at most BATCH_CANDIDATES pairs and keeps hits '''
+        counts = numpy.maximum(hi - lo, 0)
+        cumulative = numpy.cumsum(counts)
+        query_hits = []
+        region_hits = []
+        first = 0
+        num_queries = len(lo)
+        while first < num_queries:
+            offset = cumulative[first - 1] if first > 0 else 0
+            last = int(numpy.searchsorted(cumulative, offset + BATCH_CANDIDATES, 'right'))
+            last = min(max(last, first + 1), num_queries)
+            (query_idx, position) = expand_ranges(lo[first:last], hi[first:last])
+            query_idx = query_idx + first
+            if inclusive:
+                keep = self.ends[position] >= bound[query_idx]
+            else:
+                keep = self.ends[position] > bound[query_idx]
+            query_hits.append(query_idx[keep])
+            region_hits.append(self.ids[position[keep]])
+            first = last
+        if len(query_hits) == 0:
+            return (numpy.zeros(0, dtype=numpy.intp), self.ids[:0])
+        return (numpy.concatenate(query_hits), numpy.concatenate(region_hits))
+
+
+class TestIntervalIndex(unittest.TestCase):
+    def setUp(self):
+        self.interval_list = [Interval(2, 3, 0), Interval(0, 2, 1), Interval(0, 1, 2), Interval(1.5, 2.5, 3), Interval(4, 5, 4), Interval(5, 6, 5)]
+        self.interval_tree = IntervalTree.init_from_list(self.interval_list)
+        self.interval_index = IntervalIndex.init_from_list(self.interval_list)
+        self.queries = [Interval(1.5, 4.1), Interval(0.1, 0.2), Interval(2, 2), Interval(4.5, 5.5), Interval(-1, 10), Interval(6, 7)]
+
+    def test_overlapping(self):
+        for Q in self.queries:
+            expected = sorted(x.id for x in self.interval_tree.overlapping_interval_search(Q))
+            self.assertEqual(sorted(self.interval_index.overlapping_interval_search(Q).tolist()), expected)
+
+    def test_enclosing(self):
+        for Q in self.queries:
+            expected = sorted(x.id for x in self.interval_tree.enclosing_interval_search(Q))
+            self.assertEqual(sorted(self.interval_index.enclosing_interval_search(Q).tolist()), expected)
+
+    def test_batch(self):
+        starts = [Q.left for Q in self.queries]
+        ends = [Q.right for Q in self.queries]
+        (query_idx, region_idx) = self.interval_index.batch_overlapping_search(starts, ends)
+        pairs = sorted(zip(query_idx.tolist(), region_idx.tolist()))
+        expected = sorted((k, x.id) for (k, Q) in enumerate(self.queries) for x in self.interval_tree.overlapping_interval_search(Q))
+        self.assertEqual(pairs, expected)
+        (query_idx, region_idx) = self.interval_index.batch_enclosing_search(starts, ends)
+        pairs = sorted(zip(query_idx.tolist(), region_idx.tolist()))
+        expected = sorted((k, x.id) for (k, Q) in enumerate(self.queries) for x in self.interval_tree.enclosing_interval_search(Q))
+        self.assertEqual(pairs, expected)
+
+    def test_count_enclosed(self):
+        starts = [x.left for x in self.interval_list]
+        ends = [x.right for x in self.interval_list]
+        region_starts = [Q.left for Q in self.queries]
+        region_ends = [Q.right for Q in self.queries]
+        # intervals enclosed by the queries: swap the roles of queries and intervals
+        query_tree = IntervalTree.init_from_list([Interval(Q.left, Q.right, k) for (k, Q) in enumerate(self.queries)])
+        expected = [0] * len(self.queries)
+        for x in self.interval_list:
+            for Q in query_tree.enclosing_interval_search(x):
+                expected[Q.id] = expected[Q.id] + 1
+        self.assertEqual(count_enclosed(region_starts, region_ends, starts, ends).tolist(), expected)
+        self.assertEqual(count_enclosed_indexed(region_starts, region_ends, starts, ends, chunk_size=4).tolist(), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,13 +17,7 @@
 # Code:
 
 import unittest
-import sys
-
-############################################################
-## Need to have deeper recursion for tree construction
-############################################################
-MAX_RECURSION_LIMIT = 10000
-sys.setrecursionlimit(MAX_RECURSION_LIMIT)
+import numpy
 
 def median(x):
     return sorted(x)[len(x)//2]
@@ -109,46 +103,94 @@ class IntervalTree:
         
     @classmethod
     def init_from_list(cls, interval_list, par=None): 
-        if len(interval_list) == 0: 
-            result = None
-        else: 
-            single_list = reduce(lambda x, y: x + [y.left , y.right ] , interval_list , [])
-            median_val = median(single_list)
-            left_list = filter(lambda x: x.right < median_val, interval_list)
-            right_list = filter(lambda x: x.left > median_val, interval_list)
-            middle_list = filter(lambda x: (x.right >= median_val) and (x.left <= median_val) , interval_list)
-            result = cls(median_val, None, None , middle_list)
-            if left_list is not None: 
-                result.left_child = cls.init_from_list(left_list)
-            if right_list is not None: 
-                result.right_child = cls.init_from_list(right_list)
-        return result 
+        '''
+        Builds the tree level by level in O(n log n) without recursion.
+
+        All end points are sorted once. Within a node, the end points of
+        its left subtree all lie below the median and those of its right
+        subtree above it, so dropping the end points of the intervals
+        stored at a level keeps the array grouped by child node and sorted
+        within each group. Every level is then a single linear pass.
+        '''
+        n = len(interval_list)
+        if n == 0: 
+            return None
+        lefts = numpy.array([x.left for x in interval_list])
+        rights = numpy.array([x.right for x in interval_list])
+        values = numpy.concatenate((lefts, rights))
+        order = numpy.argsort(values, kind='mergesort')
+        ep_values = values[order]
+        ep_owner = order % n
+        ## node (numbered within the current level) of each end point
+        ep_node = numpy.zeros(2*n, dtype=numpy.intp)
+        interval_node = numpy.zeros(n, dtype=numpy.intp)
+        keys = []
+        parents = []
+        sides = []
+        level_offset = 0
+        level_parent = numpy.array([-1])
+        level_side = numpy.array([0])
+        while len(ep_values) > 0:
+            ############################################################
+            ## median end point of every node on this level
+            ############################################################
+            group_start = numpy.flatnonzero(numpy.r_[True, ep_node[1:] != ep_node[:-1]])
+            group_size = numpy.diff(numpy.r_[group_start, len(ep_node)])
+            medians = ep_values[group_start + group_size//2]
+            keys.extend(medians.tolist())
+            parents.extend(level_parent.tolist())
+            sides.extend(level_side.tolist())
+            ############################################################
+            ## 0 = left subtree, 1 = right subtree, -1 = stored at node
+            ############################################################
+            median_val = medians[ep_node]
+            side = numpy.where(rights[ep_owner] < median_val, 0, numpy.where(lefts[ep_owner] > median_val, 1, -1))
+            stored = side < 0
+            interval_node[ep_owner[stored]] = level_offset + ep_node[stored]
+            keep = ~stored
+            ep_values = ep_values[keep]
+            ep_owner = ep_owner[keep]
+            child_key = 2*ep_node[keep] + side[keep]
+            new_group = numpy.r_[True, child_key[1:] != child_key[:-1]] if len(child_key) > 0 else numpy.zeros(0, dtype=bool)
+            level_parent = level_offset + child_key[new_group]//2
+            level_side = child_key[new_group] % 2
+            level_offset = level_offset + len(medians)
+            ep_node = numpy.cumsum(new_group) - 1
+        ############################################################
+        ## Create the node objects
+        ############################################################
+        nodes = [cls(key, None, None, []) for key in keys]
+        for k in range(1, len(nodes)):
+            if sides[k] == 0:
+                nodes[parents[k]].left_child = nodes[k]
+            else:
+                nodes[parents[k]].right_child = nodes[k]
+        for i in numpy.argsort(interval_node, kind='mergesort').tolist():
+            nodes[interval_node[i]].intervals.append(interval_list[i])
+        return nodes[0] 
+
+    def _search(self, Q, predicate):
+        ''' Collects intervals x with predicate(x) from the nodes whose key range can reach Q '''
+        F = []
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            F.extend([x for x in node.intervals if predicate(x)])
+            ## right child pushed first so that the left subtree is reported first
+            if (node.key >= Q.left) and (node.key <= Q.right):
+                children = (node.right_child, node.left_child)
+            elif node.key > Q.right:
+                children = (node.left_child, )
+            else:
+                children = (node.right_child, )
+            stack.extend([child for child in children if child is not None])
+        return F
 
     def overlapping_interval_search(self, Q):
-        F = filter(lambda x: Q.has_overlap(x) , self.intervals)
-        if (self.key >= Q.left) and (self.key <= Q.right):
-            if self.left_child is not None:
-                F = F + self.left_child.overlapping_interval_search(Q)
-            if self.right_child is not None: 
-                F = F  + self.right_child.overlapping_interval_search(Q)
-        elif (self.key > Q.right) and (self.left_child is not None):
-            F = F + self.left_child.overlapping_interval_search(Q)
-        elif (self.key < Q.left) and (self.right_child is not None):
-            F = F + self.right_child.overlapping_interval_search(Q)
-        return F 
+        return self._search(Q, Q.has_overlap)
 
     def enclosing_interval_search(self, Q): 
-        F = filter(lambda x: x.encloses(Q) , self.intervals)
-        if (self.key >= Q.left) and (self.key <= Q.right):
-            if self.left_child is not None:
-                F = F + self.left_child.enclosing_interval_search(Q)
-            if self.right_child is not None: 
-                F = F  + self.right_child.enclosing_interval_search(Q)
-        if (self.key > Q.right) and (self.left_child is not None):
-            F = F + self.left_child.enclosing_interval_search(Q)
-        elif (self.key < Q.left) and (self.right_child is not None):
-            F = F + self.right_child.enclosing_interval_search(Q)
-        return F 
+        return self._search(Q, lambda x: x.encloses(Q))
 
 class TestIntervalTree(unittest.TestCase): 
     def setUp(self):
@@ -0,0 +1,113 @@
+# MinimumSpanningTree.py ---
+#
+# Description: Kruskal's algorithm on sparse graphs given as edge arrays.
+#
+# Edges are taken in increasing weight in batches. The edges of a batch
+# whose ends are already in one tree are dropped with one vectorized
+# ArrayUnionFind.find_all(); the rest are added one by one. The components
+# of the whole graph are known up front (ArrayUnionFind.union_edges), so
+# the scan stops as soon as the forest spans every component and the
+# remaining, heavier edges are never looked at.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import unittest
+import numpy
+
+from UnionFind import ArrayUnionFind
+
+''' Edges examined per batch '''
+BATCH_SIZE = 1 << 16
+
+
+def minimum_spanning_forest(n, src, dst, weights, batch_size=BATCH_SIZE):
+    '''
+    Minimum spanning forest of a sparse graph (Kruskal)
+
+    @arg n: number of vertices 0 .. n-1
+    @arg src, dst: edge end points
+    @arg weights: edge weights (ties are broken by edge order)
+    @return (src, dst, weights) arrays of the forest edges in the order they are added
+    '''
+    src = numpy.asarray(src, dtype=numpy.int64)
+    dst = numpy.asarray(dst, dtype=numpy.int64)
+    weights = numpy.asarray(weights)
+    components = ArrayUnionFind(n)
+    components.union_edges(src, dst)
+    target = components.num_components
+    forest = ArrayUnionFind(n)
+    order = numpy.argsort(weights, kind='mergesort')
+    chosen = []
+    for lo in xrange(0, len(order), batch_size):
+        if forest.num_components == target:
+            break
+        batch = order[lo:lo + batch_size]
+        candidates = batch[forest.find_all(src[batch]) != forest.find_all(dst[batch])]
+        for e in candidates.tolist():
+            if forest.union(src.item(e), dst.item(e)):
+                chosen.append(e)
+                if forest.num_components == target:
+                    break
+    chosen = numpy.array(chosen, dtype=numpy.int64)
+    return (src[chosen], dst[chosen], weights[chosen])
+
+def MinimumSpanningTree(G):
+    '''
+    Minimum spanning tree of a dense graph
+
+    @arg G: list of lists (or array) of edge weights, G[u][v] for u < v is read
+    @return list of edges (u, v), u < v, in the order they are added
+    '''
+    weights = numpy.asarray(G, dtype=numpy.float64)
+    (u, v) = numpy.triu_indices(len(weights), 1)
+    (src, dst, w) = minimum_spanning_forest(len(weights), u, v, weights[u, v])
+    return zip(src.tolist(), dst.tolist())
+
+
+class TestMinimumSpanningTree(unittest.TestCase):
+    def test_dense(self):
+        a = [[0, 1, 4, 3],
+             [1, 0, 1, 2],
+             [4, 1, 0, 5],
+             [3, 2, 5, 0]]
+        self.assertEqual(MinimumSpanningTree(a), [(0, 1), (1, 2), (1, 3)])
+
+    def test_sparse(self):
+        random = numpy.random.RandomState(0)
+        n = 60
+        (u, v) = numpy.triu_indices(n, 1)
+        keep = random.rand(len(u)) < 0.05
+        (u, v) = (u[keep], v[keep])
+        w = random.rand(len(u))
+        (src, dst, weights) = minimum_spanning_forest(n, u, v, w, batch_size=7)
+        ## Prim's algorithm from every unvisited vertex
+        dense = numpy.empty((n, n))
+        dense.fill(numpy.inf)
+        dense[u, v] = w
+        dense[v, u] = w
+        visited = numpy.zeros(n, dtype=bool)
+        total = 0.0
+        num_edges = 0
+        for root in range(n):
+            if visited[root]:
+                continue
+            visited[root] = True
+            best = dense[root].copy()
+            while True:
+                best[visited] = numpy.inf
+                k = numpy.argmin(best)
+                if best[k] == numpy.inf:
+                    break
+                total += best[k]
+                num_edges += 1
+                visited[k] = True
+                best = numpy.minimum(best, dense[k])
+        self.assertEqual(len(src), num_edges)
+        self.assertAlmostEqual(weights.sum(), total)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,148 @@
 Union-find data structure. Based on Josiah Carlson's code,
 http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/215912
 with significant additional changes by D. Eppstein.
+
+ArrayUnionFind keeps the forest of the integer ids 0 .. n-1 in numpy
+arrays (union by size, path halving) and merges whole arrays of edges at
+once; UnionFind maps hashable objects to such ids.
 """
 
+import unittest
+import numpy
+
+
+class ArrayUnionFind:
+    """Union-find over the integers 0 .. n-1, backed by numpy arrays.
+
+    - X.find(i) returns the root of the set containing i, halving the path
+      on the way; X.find_all(items) does the same for an array of ids.
+
+    - X.union(i, j) merges two sets, the smaller one under the larger.
+
+    - X.union_edges(src, dst) merges the sets of all pairs (src[k], dst[k])
+      in a few vectorized rounds.
+
+    - X.component_labels() numbers the sets 0 .. num_components - 1.
+    """
+
+    def __init__(self, n=0):
+        """Create n singleton sets 0 .. n-1."""
+        self.n = 0
+        self.num_components = 0
+        self._parents = numpy.zeros(0, dtype=numpy.int64)
+        self._sizes = numpy.zeros(0, dtype=numpy.int64)
+        self.add(n)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def parents(self):
+        return self._parents[:self.n]
+
+    @property
+    def sizes(self):
+        """Set sizes, valid at the roots."""
+        return self._sizes[:self.n]
+
+    def add(self, count=1):
+        """Add count singleton sets and return the id of the first one."""
+        first = self.n
+        if first + count > len(self._parents):
+            capacity = max(first + count, 2 * len(self._parents), 16)
+            self._parents = numpy.r_[self._parents[:first], numpy.zeros(capacity - first, dtype=numpy.int64)]
+            self._sizes = numpy.r_[self._sizes[:first], numpy.zeros(capacity - first, dtype=numpy.int64)]
+        if count == 1:
+            self._parents.itemset(first, first)
+            self._sizes.itemset(first, 1)
+        else:
+            self._parents[first:first + count] = numpy.arange(first, first + count)
+            self._sizes[first:first + count] = 1
+        self.n += count
+        self.num_components += count
+        return first
+
+    def find(self, item):
+        """Find the root of the set containing item."""
+        parent_of = self._parents.item
+        parent = parent_of(item)
+        while parent != item:
+            grandparent = parent_of(parent)
+            self._parents.itemset(item, grandparent)
+            item = grandparent
+            parent = parent_of(item)
+        return item
+
+    def find_all(self, items):
+        """Roots of the sets containing each item of an integer array."""
+        parents = self.parents
+        current = numpy.array(items, dtype=numpy.int64)
+        active = numpy.arange(len(current))
+        while len(active) > 0:
+            x = current[active]
+            parent = parents[x]
+            grandparent = parents[parent]
+            parents[x] = grandparent
+            current[active] = grandparent
+            active = active[parent != grandparent]
+        return current
+
+    def union(self, item1, item2):
+        """Merge the sets containing item1 and item2; False if they were the same set."""
+        root1 = self.find(item1)
+        root2 = self.find(item2)
+        if root1 == root2:
+            return False
+        sizes = self._sizes
+        (size1, size2) = (sizes.item(root1), sizes.item(root2))
+        if size1 < size2:
+            (root1, root2) = (root2, root1)
+        self._parents.itemset(root2, root1)
+        sizes.itemset(root1, size1 + size2)
+        self.num_components -= 1
+        return True
+
+    def union_edges(self, src, dst):
+        """Merge the sets containing src[k] and dst[k] for all k.
+
+        Each round hooks the smaller root of every unmerged edge under the
+        larger one (by size, then id) - a strict order, so no cycles -
+        until both ends of all edges have the same root.
+
+        @return number of merges
+        """
+        src = numpy.asarray(src, dtype=numpy.int64)
+        dst = numpy.asarray(dst, dtype=numpy.int64)
+        n = self.n
+        sizes = self.sizes
+        before = self.num_components
+        while len(src) > 0:
+            root1 = self.find_all(src)
+            root2 = self.find_all(dst)
+            keep = root1 != root2
+            (src, dst, root1, root2) = (src[keep], dst[keep], root1[keep], root2[keep])
+            if len(src) == 0:
+                break
+            key1 = sizes[root1] * n + root1
+            key2 = sizes[root2] * n + root2
+            ## the smaller root of each edge goes under the larger one; a root
+            ## in several edges keeps one of its (larger) partners
+            child = numpy.where(key1 < key2, root1, root2)
+            self.parents[child] = numpy.maximum(key1, key2) % n
+            ## sizes of the merged roots
+            touched = numpy.unique(numpy.r_[root1, root2])
+            (roots, inverse) = numpy.unique(self.find_all(touched), return_inverse=True)
+            totals = numpy.zeros(len(roots), dtype=numpy.int64)
+            numpy.add.at(totals, inverse, sizes[touched])
+            sizes[roots] = totals
+            self.num_components -= len(touched) - len(roots)
+        return before - self.num_components
+
+    def component_labels(self):
+        """Component of each id, numbered 0 .. num_components - 1 by smallest root."""
+        return numpy.unique(self.find_all(numpy.arange(self.n)), return_inverse=True)[1]
+
+
 class UnionFind:
     """Union-find data structure.
 
@@ -20,43 +160,86 @@ class UnionFind:
     - X.union(item1, item2, ...) merges the sets containing each item
       into a single larger set.  If any item is not yet part of a set
       in X, it is added to X as one of the members of the merged set.
+
+    The sets are kept in an ArrayUnionFind over the ids of the objects
+    (X.id(item)).
     """
 
     def __init__(self):
         """Create a new empty union-find structure."""
-        self.weights = {}
-        self.parents = {}
+        self.ids = {}
+        self.objects = []
+        self.forest = ArrayUnionFind()
+
+    def id(self, object):
+        """Integer id of the object in self.forest, added as a singleton if unknown."""
+        id = self.ids.get(object)
+        if id is None:
+            id = self.forest.add()
+            self.ids[object] = id
+            self.objects.append(object)
+        return id
 
     def __getitem__(self, object):
         """Find and return the name of the set containing the object."""
+        return self.objects[self.forest.find(self.id(object))]
 
-        # check for previously unknown object
-        if object not in self.parents:
-            self.parents[object] = object
-            self.weights[object] = 1
-            return object
-
-        # find path of objects leading to the root
-        path = [object]
-        root = self.parents[object]
-        while root != path[-1]:
-            path.append(root)
-            root = self.parents[root]
-
-        # compress the path and return
-        for ancestor in path:
-            self.parents[ancestor] = root
-        return root
-        
     def __iter__(self):
         """Iterate through all items ever found or unioned by this structure."""
-        return iter(self.parents)
+        return iter(self.objects)
 
     def union(self, *objects):
         """Find the sets containing the objects and merge them all."""
-        roots = [self[x] for x in objects]
-        heaviest = max([(self.weights[r],r) for r in roots])[1]
-        for r in roots:
-            if r != heaviest:
-                self.weights[heaviest] += self.weights[r]
-                self.parents[r] = heaviest
+        ids = [self.id(x) for x in objects]
+        for id in ids[1:]:
+            self.forest.union(ids[0], id)
+
+    def union_edges(self, objects1, objects2):
+        """Merge the sets containing objects1[k] and objects2[k] for all k."""
+        ids1 = [self.id(x) for x in objects1]
+        ids2 = [self.id(x) for x in objects2]
+        self.forest.union_edges(ids1, ids2)
+
+
+class TestUnionFind(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.n = 2000
+        self.src = random.randint(0, self.n, 1500)
+        self.dst = random.randint(0, self.n, 1500)
+
+    def components(self, labels):
+        groups = {}
+        for (item, label) in enumerate(labels):
+            groups.setdefault(label, set()).add(item)
+        return sorted(sorted(x) for x in groups.values())
+
+    def test_union_edges(self):
+        scalar = ArrayUnionFind(self.n)
+        for (u, v) in zip(self.src.tolist(), self.dst.tolist()):
+            scalar.union(u, v)
+        batch = ArrayUnionFind(self.n)
+        half = len(self.src) // 2
+        merges = batch.union_edges(self.src[:half], self.dst[:half]) + batch.union_edges(self.src[half:], self.dst[half:])
+        self.assertEqual(merges, self.n - scalar.num_components)
+        self.assertEqual(batch.num_components, scalar.num_components)
+        self.assertEqual(self.components(batch.component_labels()), self.components(scalar.component_labels()))
+        roots = batch.find_all(numpy.arange(self.n))
+        self.assertTrue((numpy.bincount(roots, minlength=self.n)[roots] == batch.sizes[roots]).all())
+
+    def test_objects(self):
+        sets = UnionFind()
+        sets.union('a', 'b')
+        sets.union('c', 'd', 'e')
+        self.assertEqual(sets['a'], sets['b'])
+        self.assertNotEqual(sets['a'], sets['c'])
+        sets.union('b', 'e')
+        self.assertEqual(len(set(sets[x] for x in 'abcde')), 1)
+        sets.union_edges(['f', 'g'], ['h', 'i'])
+        self.assertEqual(sets['f'], sets['h'])
+        self.assertNotEqual(sets['f'], sets['g'])
+        self.assertEqual(sets['j'], 'j')
+        self.assertEqual(sorted(sets), list('abcdefghij'))
+
+if __name__ == '__main__':
+    unittest.main()
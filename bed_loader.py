@@ -0,0 +1,964 @@
+# bed_loader.py ---
+#
+# Description: Columnar reader for BED / GROSeq files.
+#
+# Files are read in large blocks and each block is split into fields
+# with NumPy operations on the raw bytes: chromosome names are interned
+# by comparing them as zero padded byte strings, start/end are parsed
+# eight digits at a time from unaligned 64-bit words, and the rest of
+# the line is kept as byte offsets into the file.
+#
+# gzip and BGZF files are read transparently (see bgzf.py); offsets then
+# refer to the uncompressed data. A coordinate-sorted BGZF file can be
+# indexed (FILE.bgzidx, see build_bgzf_index) so that only the blocks
+# holding given chromosomes and ranges are inflated.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import os
+import mmap
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+import numpy
+
+from logger import logger
+import bgzf
+
+''' Bytes read from the file per block '''
+BLOCK_SIZE = 1 << 24
+
+''' Strand codes '''
+STRAND_PLUS = 1
+STRAND_MINUS = -1
+STRAND_NONE = 0
+STRAND_SYMBOLS = {STRAND_PLUS: '+', STRAND_MINUS: '-', STRAND_NONE: ''}
+
+''' Lines starting with these tokens are skipped '''
+HEADER_PREFIXES = ('#', 'track', 'browser')
+
+''' Zero bytes before the block in unaligned_words (room for reading 16 bytes before a token end) '''
+WORD_PADDING = 16
+
+''' PREFIX_MASKS[n] keeps the first n bytes of a little-endian uint64 word '''
+PREFIX_MASKS = numpy.array([(1 << (8 * n)) - 1 for n in range(9)], dtype=numpy.uint64)
+ASCII_ZEROS = numpy.uint64(0x3030303030303030)
+ASCII_ABOVE_NINE = numpy.uint64(0x4646464646464646)
+HIGH_BITS = numpy.uint64(0x8080808080808080)
+
+
+class IntervalTable:
+    '''
+    Columns of a BED / GROSeq file, one row per line
+
+    chromosome        int32 index into chromosome_names
+    chromosome_names  chromosome names in order of first appearance
+    start, end        int64 columns 2 and 3
+    strand            int8 column 6 (STRAND_PLUS, STRAND_MINUS or STRAND_NONE)
+    score             float64 column 5 (only if read with_score)
+    rest_start        byte offset of column 4 in the file (end of line if missing)
+    rest_end          byte offset of the end of the line
+    rest              columns 4.. joined by tabs (only if read with_rest)
+    '''
+    def __init__(self, chromosome, chromosome_names, start, end, strand, score=None, rest_start=None, rest_end=None, rest=None, file_name=None):
+        self.chromosome = chromosome
+        self.chromosome_names = chromosome_names
+        self.start = start
+        self.end = end
+        self.strand = strand
+        self.score = score
+        self.rest_start = rest_start
+        self.rest_end = rest_end
+        self.rest = rest
+        self.file_name = file_name
+        ''' Number of lines skipped for having less than three fields '''
+        self.skipped_lines = 0
+        ''' Row offset of each chromosome code if rows are grouped by chromosome '''
+        self.chromosome_offsets = None
+
+    def __len__(self):
+        return len(self.start)
+
+    def take(self, rows):
+        ''' Table with the given rows (index array or boolean mask) '''
+        rows = numpy.asarray(rows)
+        if rows.dtype == bool:
+            rows = numpy.flatnonzero(rows)
+        select = lambda x: None if x is None else x[rows]
+        rest = None if self.rest is None else [self.rest[i] for i in numpy.asarray(rows).tolist()]
+        return IntervalTable(self.chromosome[rows], self.chromosome_names, self.start[rows], self.end[rows], self.strand[rows],
+                             select(self.score), select(self.rest_start), select(self.rest_end), rest, self.file_name)
+
+    @classmethod
+    def concatenate(cls, tables, chromosome_names):
+        ''' Joins tables read from the same file (sharing chromosome codes) '''
+        join = lambda column: None if getattr(tables[0], column) is None else numpy.concatenate([getattr(t, column) for t in tables])
+        rest = None
+        if tables[0].rest is not None:
+            rest = [x for t in tables for x in t.rest]
+        result = cls(join('chromosome'), chromosome_names, join('start'), join('end'), join('strand'), join('score'),
+                     join('rest_start'), join('rest_end'), rest, tables[0].file_name)
+        result.skipped_lines = sum(t.skipped_lines for t in tables)
+        return result
+
+    def chromosome_groups(self):
+        '''
+        Rows of each chromosome
+
+        @return list of (chromosome name, row indices in file order), chromosomes in order of first appearance
+        '''
+        if self.chromosome_offsets is not None:
+            offsets = self.chromosome_offsets.tolist()
+            return [(self.chromosome_names[code], numpy.arange(offsets[code], offsets[code + 1]))
+                    for code in range(len(self.chromosome_names)) if offsets[code + 1] > offsets[code]]
+        order = numpy.argsort(self.chromosome, kind='mergesort')
+        counts = numpy.bincount(self.chromosome, minlength=len(self.chromosome_names))
+        groups = numpy.split(order, numpy.cumsum(counts)[:-1])
+        return [(self.chromosome_names[code], rows) for (code, rows) in enumerate(groups) if len(rows) > 0]
+
+    def group_by_chromosome(self):
+        ''' Table with rows grouped by chromosome and chromosome_offsets set '''
+        if self.chromosome_offsets is not None:
+            return self
+        counts = numpy.bincount(self.chromosome, minlength=len(self.chromosome_names))
+        grouped = self.take(numpy.argsort(self.chromosome, kind='mergesort'))
+        grouped.chromosome_offsets = numpy.r_[0, numpy.cumsum(counts)]
+        grouped.skipped_lines = self.skipped_lines
+        return grouped
+
+    def strand_symbols(self):
+        ''' Strand column as '+', '-' or '' '''
+        symbols = numpy.array(['', '+', '-'], dtype=object)
+        return symbols[numpy.where(self.strand == STRAND_MINUS, 2, self.strand)]
+
+    def rest_of_line(self, rows=None):
+        '''
+        Columns 4.. of the given rows, joined by tabs
+
+        A gzip or BGZF file is inflated once per call: ask for all rows at once.
+        '''
+        if rows is None:
+            rows = numpy.arange(len(self))
+        rows = numpy.asarray(rows).tolist()
+        if self.rest is not None:
+            return [self.rest[i] for i in rows]
+        if len(rows) == 0:
+            return []
+        rest_start = self.rest_start.tolist()
+        rest_end = self.rest_end.tolist()
+        if bgzf.is_compressed(self.file_name):
+            with bgzf.open_input(self.file_name) as fid:
+                data = fid.read()
+            return ['\t'.join(data[rest_start[i]:rest_end[i]].split()) for i in rows]
+        with open(self.file_name, 'rb') as fid:
+            data = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return ['\t'.join(data[rest_start[i]:rest_end[i]].split()) for i in rows]
+            finally:
+                data.close()
+
+
+############################################################
+# Vectorized parsing of a block of complete lines
+############################################################
+def unaligned_words(a):
+    '''
+    Little-endian uint64 words starting at every byte of a
+
+    @return words where words[p + WORD_PADDING] holds a[p:p + 8]; the bytes
+            before a[0] and after a[-1] read as zeros
+    '''
+    padded = numpy.zeros(len(a) + WORD_PADDING + 8, dtype=numpy.uint8)
+    padded[WORD_PADDING:WORD_PADDING + len(a)] = a
+    return numpy.ndarray((len(a) + WORD_PADDING + 1,), dtype='<u8', buffer=padded, strides=(1,))
+
+def prefix_masks(lengths):
+    ''' Masks keeping the first lengths[k] bytes (all 8 if more, none if less than 1) of little-endian words '''
+    return PREFIX_MASKS[numpy.clip(lengths, 0, 8)]
+
+def parse_digit_words(words, digits):
+    '''
+    Values of the decimal numbers in the last bytes of little-endian words
+
+    @arg digits: number of digits at the end of each word (the bytes before are ignored)
+    @return (values, ok) where ok[k] is False if one of the digits is not 0-9
+    '''
+    ignored = prefix_masks(8 - digits)
+    ## the ignored bytes become '0'
+    x = (words | ignored) ^ (ignored & ~ASCII_ZEROS)
+    ## a byte below '0' borrows into its high bit, a byte above '9' carries into it
+    ok = (((x - ASCII_ZEROS) | (x + ASCII_ABOVE_NINE)) & HIGH_BITS) == 0
+    x -= ASCII_ZEROS
+    x = (x * numpy.uint64(10) + (x >> numpy.uint64(8))) & numpy.uint64(0x00ff00ff00ff00ff)
+    x = (x * numpy.uint64(100) + (x >> numpy.uint64(16))) & numpy.uint64(0x0000ffff0000ffff)
+    x = (x * numpy.uint64(10000) + (x >> numpy.uint64(32))) & numpy.uint64(0x00000000ffffffff)
+    return (x, ok)
+
+def parse_integers(words, starts, ends):
+    '''
+    Parses unsigned decimal tokens of up to 16 digits
+
+    @arg words: unaligned_words of the block
+    @return (values, ok) where ok[k] is False for tokens that are not plain digits
+    '''
+    lengths = ends - starts
+    (values, ok) = parse_digit_words(words[ends + (WORD_PADDING - 8)], lengths)
+    ok &= lengths > 0
+    if (len(lengths) > 0) and (lengths.max() > 8):
+        (high, high_ok) = parse_digit_words(words[ends + (WORD_PADDING - 16)], lengths - 8)
+        values += high * numpy.uint64(100000000)
+        ok &= high_ok & (lengths <= 16)
+    return (values.astype(numpy.int64), ok)
+
+def parse_coordinate(token):
+    ''' Parses a coordinate that is not a plain number of up to 16 digits (e.g. 100.0) '''
+    try:
+        return int(token)
+    except ValueError:
+        return int(round(float(token)))
+
+def token_keys(words, starts, ends):
+    '''
+    Tokens as rows of little-endian words, zero padded to a common width
+
+    @arg words: unaligned_words of the block
+    @return uint64 array of shape (number of tokens, words per token)
+    '''
+    lengths = ends - starts
+    width = max((int(lengths.max()) + 7) // 8, 1) if len(starts) > 0 else 1
+    keys = numpy.empty((len(starts), width), dtype='<u8')
+    for j in range(width):
+        ## words past the end of a token are masked out, whatever they read
+        position = numpy.minimum(starts + (WORD_PADDING + 8 * j), len(words) - 1)
+        keys[:, j] = words[position] & prefix_masks(lengths - 8 * j)
+    return keys
+
+def parse_block(buf, offset=0, chromosome_names=None, with_score=False, with_rest=False, file_name=None):
+    '''
+    Parses a block of complete lines into an IntervalTable
+
+    @arg buf: string holding whole lines
+    @arg offset: file offset of buf[0]
+    @arg chromosome_names: list of known chromosome names, extended in place
+    @arg with_score: also parse column 5 as float (nan if not a number)
+    @arg with_rest: also keep columns 4.. as strings
+    '''
+    if chromosome_names is None:
+        chromosome_names = []
+    a = numpy.frombuffer(buf, dtype=numpy.uint8)
+    words = unaligned_words(a)
+
+    ############################################################
+    ## Tokens: bytes up to 32 (space, tab, newline and other
+    ## control characters) separate tokens
+    ############################################################
+    separators = numpy.flatnonzero(a <= 32)
+    if (len(a) > 0) and (a[0] > 32) and (a[-1] == 10) and not (numpy.diff(separators) == 1).any():
+        ## Every separator ends a token (no empty lines, CR or repeated separators)
+        token_start = numpy.r_[0, separators[:-1] + 1]
+        token_end = separators
+        last_token = numpy.flatnonzero(a[separators] == 10)
+        newlines = separators[last_token]
+        first_token = numpy.r_[0, last_token[:-1] + 1]
+        num_tokens = last_token + 1 - first_token
+    else:
+        is_token = numpy.ones(len(a) + 2, dtype=bool)
+        is_token[[0, -1]] = False
+        is_token[separators + 1] = False
+        boundaries = numpy.flatnonzero(is_token[1:] != is_token[:-1])
+        token_start = boundaries[0::2]
+        token_end = boundaries[1::2]
+        newlines = separators[a[separators] == 10]
+        line_begin = numpy.r_[0, newlines + 1]
+        if (len(a) == 0) or (a[-1] == 10):
+            line_begin = line_begin[:-1]
+        first_token = numpy.searchsorted(token_start, line_begin)
+        num_tokens = numpy.diff(numpy.r_[first_token, len(token_start)])
+
+    ############################################################
+    ## Lines with at least chromosome, start and end, and the
+    ## bounds of their first six columns (a missing column
+    ## stands at the end of the line)
+    ############################################################
+    rows = numpy.flatnonzero(num_tokens >= 3)
+    skipped = numpy.flatnonzero((num_tokens > 0) & (num_tokens < 3))
+    skipped_lines = len([i for i in skipped.tolist() if not buf.startswith(HEADER_PREFIXES, int(token_start[first_token[i]]))])
+    num_fields = num_tokens[rows]
+    width = int(num_fields[0]) if len(rows) > 0 else 0
+    if (len(rows) > 0) and (len(token_start) == width * len(rows)) and (num_fields == width).all():
+        ## every line has the same number of columns: the columns are strided views
+        column_start = token_start.reshape(-1, width)
+        column_end = token_end.reshape(-1, width)
+        columns = [(column_start[:, min(j, width - 1)], column_end[:, min(j, width - 1)]) for j in range(6)]
+        line_end = column_end[:, -1]
+    else:
+        t0 = first_token[rows]
+        last_token = t0 + num_fields - 1
+        columns = [(token_start[numpy.minimum(t0 + j, last_token)], token_end[numpy.minimum(t0 + j, last_token)]) for j in range(6)]
+        line_end = token_end[last_token]
+
+    (start, start_ok) = parse_integers(words, columns[1][0], columns[1][1])
+    (end, end_ok) = parse_integers(words, columns[2][0], columns[2][1])
+    irregular = numpy.flatnonzero(~(start_ok & end_ok))
+    if len(irregular) > 0:
+        keep = numpy.ones(len(rows), dtype=bool)
+        for k in irregular.tolist():
+            if buf.startswith(HEADER_PREFIXES, int(columns[0][0][k])):
+                keep[k] = False
+                continue
+            try:
+                start[k] = parse_coordinate(buf[columns[1][0][k]:columns[1][1][k]])
+                end[k] = parse_coordinate(buf[columns[2][0][k]:columns[2][1][k]])
+            except ValueError:
+                line_start = newlines[rows[k] - 1] + 1 if rows[k] > 0 else 0
+                raise ValueError('%s: cannot parse line at byte %d: %s' % (file_name, offset + line_start, buf[line_start:line_end[k]]))
+        (rows, num_fields, start, end, line_end) = (rows[keep], num_fields[keep], start[keep], end[keep], line_end[keep])
+        columns = [(x[keep], y[keep]) for (x, y) in columns]
+
+    ############################################################
+    ## Intern chromosome names: the names are compared as whole
+    ## zero padded byte strings, and only the first name of each
+    ## run of equal names is looked up
+    ############################################################
+    keys = token_keys(words, columns[0][0], columns[0][1])
+    name_type = 'S%d' % (8 * keys.shape[1])
+    runs = numpy.flatnonzero(numpy.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])[:len(rows)]
+    names = keys[runs, 0] if keys.shape[1] == 1 else keys[runs].view(name_type).ravel()
+    (unique_names, inverse) = numpy.unique(names, return_inverse=True)
+    unique_names = unique_names.view(name_type).tolist()
+    codes = numpy.zeros(len(unique_names), dtype=numpy.int32)
+    new_names = []
+    for (k, name) in enumerate(unique_names):
+        if name in chromosome_names:
+            codes[k] = chromosome_names.index(name)
+        else:
+            new_names.append(k)
+    if len(new_names) > 0:
+        ## new names are added in order of first appearance
+        first = numpy.unique(inverse, return_index=True)[1]
+        for k in sorted(new_names, key=lambda k: first[k]):
+            codes[k] = len(chromosome_names)
+            chromosome_names.append(unique_names[k])
+    chromosome = numpy.repeat(codes[inverse], numpy.diff(numpy.r_[runs, len(rows)]))
+
+    ############################################################
+    ## Strand (column 6), score (column 5) and rest of line
+    ############################################################
+    (strand_start, strand_end) = columns[5]
+    symbol = numpy.where((num_fields >= 6) & (strand_end - strand_start == 1), a[numpy.minimum(strand_start, len(a) - 1)], 0)
+    strand = numpy.zeros(len(rows), dtype=numpy.int8)
+    strand[symbol == 43] = STRAND_PLUS
+    strand[symbol == 45] = STRAND_MINUS
+
+    score = None
+    if with_score:
+        score = numpy.full(len(rows), numpy.nan)
+        (score_start, score_end) = columns[4]
+        for k in numpy.flatnonzero(num_fields >= 5).tolist():
+            try:
+                score[k] = float(buf[score_start[k]:score_end[k]])
+            except ValueError:
+                pass
+
+    rest_start = numpy.where(num_fields >= 4, columns[3][0], line_end)
+    rest_end = line_end
+    rest = None
+    if with_rest:
+        rest = ['\t'.join(buf[x:y].split()) for (x, y) in zip(rest_start.tolist(), rest_end.tolist())]
+
+    table = IntervalTable(chromosome, chromosome_names, start, end, strand, score,
+                          rest_start + offset, rest_end + offset, rest, file_name)
+    table.skipped_lines = skipped_lines
+    return table
+
+
+############################################################
+# Reading files
+############################################################
+def read_blocks(fid, block_size=BLOCK_SIZE):
+    '''
+    Generator over (offset, buf) where buf holds complete lines of fid starting at offset
+    '''
+    offset = 0
+    remainder = ''
+    while True:
+        data = fid.read(block_size)
+        if len(data) == 0:
+            break
+        data = remainder + data
+        last_newline = data.rfind('\n')
+        if last_newline < 0:
+            remainder = data
+            continue
+        yield (offset, data[:last_newline + 1])
+        offset = offset + last_newline + 1
+        remainder = data[last_newline + 1:]
+    if len(remainder) > 0:
+        yield (offset, remainder)
+
+def iter_tables(file_name, block_size=BLOCK_SIZE, with_score=False, with_rest=False):
+    '''
+    Generator over IntervalTables of consecutive blocks of a file
+
+    All tables share one chromosome_names list, so chromosome codes agree between blocks.
+    gzip and BGZF files are decompressed on the fly.
+    '''
+    chromosome_names = []
+    with bgzf.open_input(file_name) as fid:
+        for (offset, buf) in read_blocks(fid, block_size):
+            yield parse_block(buf, offset, chromosome_names, with_score, with_rest, file_name)
+
+def read_table(file_name, block_size=BLOCK_SIZE, with_score=False, with_rest=False):
+    ''' Reads a whole BED / GROSeq file into an IntervalTable '''
+    chromosome_names = None
+    tables = []
+    for table in iter_tables(file_name, block_size, with_score, with_rest):
+        chromosome_names = table.chromosome_names
+        tables.append(table)
+    if len(tables) == 0:
+        table = parse_block('', 0, [], with_score, with_rest, file_name)
+    else:
+        table = IntervalTable.concatenate(tables, chromosome_names)
+    if table.skipped_lines > 0:
+        logger.warning('%s: skipped %d lines with less than three fields' % (file_name, table.skipped_lines))
+    logger.info('%s: read %d lines on %d chromosomes' % (file_name, len(table), len(table.chromosome_names)))
+    return table
+
+def sorted_chromosome_blocks(file_name, block_size=BLOCK_SIZE):
+    '''
+    Checks in one streaming pass whether a file is sorted by start within contiguous chromosome blocks
+
+    @return list of chromosome names in file order, None if the file is not sorted
+    '''
+    blocks = []
+    last = None
+    for table in iter_tables(file_name, block_size):
+        if len(table) == 0:
+            continue
+        if last is not None:
+            chromosome = numpy.r_[last[0], table.chromosome]
+            start = numpy.r_[last[1], table.start]
+        else:
+            chromosome = table.chromosome
+            start = table.start
+        same = chromosome[1:] == chromosome[:-1]
+        if numpy.any(same & (start[1:] < start[:-1])):
+            logger.info('%s: not sorted by start' % file_name)
+            return None
+        changes = chromosome[numpy.r_[last is None, ~same]]
+        for code in changes.tolist():
+            name = table.chromosome_names[code]
+            if (len(blocks) == 0) or (blocks[-1] != name):
+                if name in blocks:
+                    logger.info('%s: chromosome %s is not contiguous' % (file_name, name))
+                    return None
+                blocks.append(name)
+        last = (table.chromosome[-1], table.start[-1])
+    return blocks
+
+
+############################################################
+# Binary cache next to the parsed file
+############################################################
+''' Sidecar cache directory: FILE + CACHE_SUFFIX '''
+CACHE_SUFFIX = '.npcache'
+CACHE_VERSION = 1
+CACHE_COLUMNS = ('chromosome', 'start', 'end', 'strand', 'score', 'rest_start', 'rest_end')
+
+''' Content hash covers the first and last block and HASH_SAMPLES blocks in between '''
+HASH_BLOCK_SIZE = 1 << 20
+HASH_SAMPLES = 16
+
+def file_signature(file_name):
+    '''
+    Identifies the contents of a file without reading all of it
+
+    @return dict with size, mtime and md5 of sampled blocks
+    '''
+    status = os.stat(file_name)
+    size = status.st_size
+    digest = hashlib.md5()
+    with open(file_name, 'rb') as fid:
+        offsets = set([0, max(size - HASH_BLOCK_SIZE, 0)])
+        offsets.update((size * k) // (HASH_SAMPLES + 1) for k in range(1, HASH_SAMPLES + 1))
+        for offset in sorted(offsets):
+            fid.seek(offset)
+            digest.update(fid.read(HASH_BLOCK_SIZE))
+    return {'size': size, 'mtime': status.st_mtime, 'md5': digest.hexdigest()}
+
+def cache_directory(file_name):
+    return file_name + CACHE_SUFFIX
+
+def write_cache(table, file_name):
+    '''
+    Writes the columns of table, grouped by chromosome, next to file_name
+
+    The directory holds one .npy file per column and index.json with the
+    chromosome names, the row offset of each chromosome and the signature
+    of the source file.
+    '''
+    directory = cache_directory(file_name)
+    signature = file_signature(file_name)
+    grouped = table.group_by_chromosome()
+    tmp_directory = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.', dir=os.path.dirname(os.path.abspath(file_name)))
+    try:
+        for column in CACHE_COLUMNS:
+            if getattr(grouped, column) is not None:
+                numpy.save(os.path.join(tmp_directory, column + '.npy'), getattr(grouped, column))
+        index = {'version': CACHE_VERSION,
+                 'signature': signature,
+                 'chromosome_names': grouped.chromosome_names,
+                 'chromosome_offsets': grouped.chromosome_offsets.tolist(),
+                 'skipped_lines': grouped.skipped_lines}
+        with open(os.path.join(tmp_directory, 'index.json'), 'w') as fid:
+            json.dump(index, fid)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp_directory, directory)
+    except:
+        shutil.rmtree(tmp_directory, True)
+        raise
+    logger.info('%s: wrote cache %s' % (file_name, directory))
+
+def read_cache(file_name, with_score=False):
+    '''
+    Memory-maps the cache of file_name
+
+    @return IntervalTable grouped by chromosome, None if there is no valid cache
+    '''
+    directory = cache_directory(file_name)
+    try:
+        with open(os.path.join(directory, 'index.json'), 'r') as fid:
+            index = json.load(fid)
+    except (IOError, ValueError):
+        return None
+    if (index.get('version') != CACHE_VERSION) or (index.get('signature') != file_signature(file_name)):
+        logger.info('%s: cache %s is out of date' % (file_name, directory))
+        return None
+    columns = dict()
+    for column in CACHE_COLUMNS:
+        path = os.path.join(directory, column + '.npy')
+        columns[column] = numpy.load(path, mmap_mode='r') if os.path.exists(path) else None
+    if with_score and (columns['score'] is None):
+        return None
+    names = [str(name) for name in index['chromosome_names']]
+    table = IntervalTable(columns['chromosome'], names, columns['start'], columns['end'], columns['strand'],
+                          columns['score'] if with_score else None, columns['rest_start'], columns['rest_end'], None, file_name)
+    table.chromosome_offsets = numpy.array(index['chromosome_offsets'], dtype=numpy.int64)
+    table.skipped_lines = index['skipped_lines']
+    logger.info('%s: memory-mapped %d lines from cache %s' % (file_name, len(table), directory))
+    return table
+
+def load_table(file_name, cache=False, rebuild_cache=False, with_score=False):
+    '''
+    Reads a BED / GROSeq file, through its binary cache if cache is True
+
+    The cache is used if its signature matches the file, and written
+    after parsing otherwise. Rows of a cached table are grouped by
+    chromosome (in file order within each chromosome).
+
+    @arg cache: use and write the cache (the command line tools turn it on unless --no_cache)
+    @arg rebuild_cache: ignore an existing cache and write a new one
+    '''
+    if cache and not os.path.isfile(file_name):
+        cache = False
+    if cache and not rebuild_cache:
+        table = read_cache(file_name, with_score)
+        if table is not None:
+            return table
+    table = read_table(file_name, with_score=with_score)
+    if cache:
+        try:
+            write_cache(table, file_name)
+        except (IOError, OSError) as e:
+            logger.warning('%s: could not write cache: %s' % (file_name, e))
+    return table
+
+
+############################################################
+# Chromosome index of sorted BGZF files
+############################################################
+''' Index file next to a BGZF file: FILE + INDEX_SUFFIX '''
+INDEX_SUFFIX = '.bgzidx'
+INDEX_VERSION = 1
+
+''' Bases per bin of the linear index '''
+INDEX_BIN_SIZE = 1 << 14
+
+''' Byte ranges closer than this are read as one (see index_segments) '''
+SEGMENT_MERGE_GAP = 1 << 16
+
+def index_file_name(file_name):
+    return file_name + INDEX_SUFFIX
+
+def line_starts(buf, offset, rest_start):
+    ''' File offset of the line holding each rest_start offset of a block read at offset '''
+    newlines = numpy.flatnonzero(numpy.frombuffer(buf, dtype=numpy.uint8) == 10)
+    if len(newlines) == 0:
+        return numpy.zeros(len(rest_start), dtype=numpy.int64) + offset
+    k = numpy.searchsorted(newlines, rest_start - offset)
+    return numpy.where(k > 0, newlines[numpy.maximum(k - 1, 0)] + 1, 0) + offset
+
+def build_bgzf_index(file_name, block_size=BLOCK_SIZE):
+    '''
+    Indexes a BGZF file sorted by start within contiguous chromosome blocks
+
+    Offsets are positions in the uncompressed data. For each chromosome the
+    index holds the offsets of its first line (begin) and of the end of its
+    block (end), and two linear indices over bins of INDEX_BIN_SIZE bases:
+
+    first_end[w]    offset of the first line ending at or after bin w
+                    (all earlier lines end before w * INDEX_BIN_SIZE)
+    first_start[w]  offset of the first line starting at or after w * INDEX_BIN_SIZE
+
+    @return index dict, with chromosomes set to None if the file is not sorted
+    '''
+    (block_offsets, block_starts, size) = bgzf.scan_blocks(file_name)
+    index = {'version': INDEX_VERSION,
+             'signature': file_signature(file_name),
+             'bin_size': INDEX_BIN_SIZE,
+             'block_offsets': block_offsets.tolist(),
+             'block_starts': block_starts.tolist(),
+             'size': size,
+             'chromosomes': []}
+    entry = None
+    chromosome_names = []
+    with bgzf.open_input(file_name) as fid:
+        for (offset, buf) in read_blocks(fid, block_size):
+            table = parse_block(buf, offset, chromosome_names, file_name=file_name)
+            if len(table) == 0:
+                continue
+            lines = line_starts(buf, offset, table.rest_start)
+            runs = numpy.r_[numpy.flatnonzero(numpy.r_[True, table.chromosome[1:] != table.chromosome[:-1]]), len(table)]
+            for (lo, hi) in zip(runs[:-1].tolist(), runs[1:].tolist()):
+                name = chromosome_names[table.chromosome[lo]]
+                start = table.start[lo:hi]
+                if (entry is None) or (entry['name'] != name):
+                    if any(x['name'] == name for x in index['chromosomes']):
+                        logger.info('%s: chromosome %s is not contiguous, cannot index' % (file_name, name))
+                        index['chromosomes'] = None
+                        return index
+                    if entry is not None:
+                        entry['end'] = int(lines[lo])
+                    entry = {'name': name, 'begin': int(lines[lo]), 'end': size, 'first_end': [], 'first_start': []}
+                    index['chromosomes'].append(entry)
+                    (last_start, max_end) = (start[0], -1)
+                if (start[0] < last_start) or numpy.any(start[1:] < start[:-1]):
+                    logger.info('%s: not sorted by start, cannot index' % file_name)
+                    index['chromosomes'] = None
+                    return index
+                end_bins = numpy.maximum.accumulate(numpy.maximum(table.end[lo:hi], max_end)) // INDEX_BIN_SIZE
+                new_bins = numpy.arange(len(entry['first_end']), end_bins[-1] + 1)
+                entry['first_end'].extend(lines[lo:hi][numpy.searchsorted(end_bins, new_bins)].tolist())
+                start_bins = start // INDEX_BIN_SIZE
+                new_bins = numpy.arange(len(entry['first_start']), start_bins[-1] + 1)
+                entry['first_start'].extend(lines[lo:hi][numpy.searchsorted(start_bins, new_bins)].tolist())
+                (last_start, max_end) = (start[-1], max(max_end, table.end[lo:hi].max()))
+    return index
+
+def write_bgzf_index(index, file_name):
+    ''' Writes the index of file_name to FILE.bgzidx '''
+    path = index_file_name(file_name)
+    (handle, tmp_path) = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(file_name)))
+    try:
+        with os.fdopen(handle, 'w') as fid:
+            json.dump(index, fid)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    logger.info('%s: wrote index %s' % (file_name, path))
+
+def read_bgzf_index(file_name):
+    ''' Index of file_name, None if there is no up-to-date index '''
+    try:
+        with open(index_file_name(file_name), 'r') as fid:
+            index = json.load(fid)
+    except (IOError, ValueError):
+        return None
+    if (index.get('version') != INDEX_VERSION) or (index.get('signature') != file_signature(file_name)):
+        logger.info('%s: index %s is out of date' % (file_name, index_file_name(file_name)))
+        return None
+    for entry in (index['chromosomes'] or []):
+        entry['name'] = str(entry['name'])
+    return index
+
+def uncompressed_size(file_name):
+    ''' Size of the (uncompressed) data of a file, None for a compressed file without an up-to-date index '''
+    if not bgzf.is_compressed(file_name):
+        return os.path.getsize(file_name)
+    if (bgzf.file_format(file_name) == 'bgzf') and os.path.isfile(index_file_name(file_name)):
+        index = read_bgzf_index(file_name)
+        if index is not None:
+            return index['size']
+    return None
+
+def load_bgzf_index(file_name, cache=False, rebuild_cache=False):
+    '''
+    Index of a BGZF file, built if missing or out of date
+
+    @arg cache: read FILE.bgzidx and write it after building the index
+                (otherwise the index is built in memory only)
+    @arg rebuild_cache: ignore an existing FILE.bgzidx and write a new one
+    @return index dict, None if the file is not BGZF or not sorted
+    '''
+    if bgzf.file_format(file_name) != 'bgzf':
+        return None
+    index = None
+    if cache and not rebuild_cache:
+        index = read_bgzf_index(file_name)
+    if index is None:
+        index = build_bgzf_index(file_name)
+        if cache:
+            try:
+                write_bgzf_index(index, file_name)
+            except (IOError, OSError) as e:
+                logger.warning('%s: could not write index: %s' % (file_name, e))
+    if index['chromosomes'] is None:
+        return None
+    return index
+
+def index_segments(index, regions):
+    '''
+    Byte ranges of an indexed file holding all lines that can overlap the regions
+
+    @arg regions: IntervalTable
+    @return sorted list of disjoint (begin, end) offsets into the uncompressed data
+    '''
+    entries = dict((entry['name'], entry) for entry in index['chromosomes'])
+    bin_size = index['bin_size']
+    begins = []
+    ends = []
+    for (chr, rows) in regions.chromosome_groups():
+        if chr not in entries:
+            continue
+        entry = entries[chr]
+        ## last element: end of the chromosome, for bins past the last line
+        first_end = numpy.array(entry['first_end'] + [entry['end']], dtype=numpy.int64)
+        first_start = numpy.array(entry['first_start'] + [entry['end']], dtype=numpy.int64)
+        start_bins = numpy.maximum(regions.start[rows], 0) // bin_size
+        end_bins = numpy.maximum(regions.end[rows], 0) // bin_size + 1
+        begins.append(first_end[numpy.minimum(start_bins, len(first_end) - 1)])
+        ends.append(first_start[numpy.minimum(end_bins, len(first_start) - 1)])
+    if len(begins) == 0:
+        return []
+    begins = numpy.concatenate(begins)
+    ends = numpy.concatenate(ends)
+    keep = ends > begins
+    order = numpy.argsort(begins[keep], kind='mergesort')
+    begins = begins[keep][order]
+    ends = ends[keep][order]
+    if len(begins) == 0:
+        return []
+    reach = numpy.maximum.accumulate(ends)
+    first = numpy.flatnonzero(numpy.r_[True, begins[1:] > reach[:-1] + SEGMENT_MERGE_GAP])
+    return zip(begins[first].tolist(), numpy.maximum.reduceat(ends, first).tolist())
+
+def segment_lines(pieces, block_size=BLOCK_SIZE):
+    '''
+    Generator over (offset, buf) of complete lines from (offset, data) pieces
+
+    Pieces that are not contiguous start a new buf (segments begin and end at line boundaries).
+    '''
+    (begin, parts, length) = (0, [], 0)
+    for (offset, data) in pieces:
+        if (len(parts) > 0) and (offset != begin + length):
+            yield (begin, ''.join(parts))
+            (parts, length) = ([], 0)
+        if len(parts) == 0:
+            begin = offset
+        parts.append(data)
+        length += len(data)
+        if length >= block_size:
+            buf = ''.join(parts)
+            last_newline = buf.rfind('\n')
+            if last_newline >= 0:
+                yield (begin, buf[:last_newline + 1])
+                remainder = buf[last_newline + 1:]
+                begin += last_newline + 1
+                (parts, length) = ([remainder] if len(remainder) > 0 else [], len(remainder))
+    if len(parts) > 0:
+        yield (begin, ''.join(parts))
+
+def read_indexed_table(file_name, regions, index, block_size=BLOCK_SIZE, with_score=False, with_rest=False):
+    '''
+    Reads the lines of an indexed BGZF file that can overlap the regions
+
+    Only the BGZF blocks holding these lines are inflated. The table can
+    hold lines outside the regions as well.
+    '''
+    segments = index_segments(index, regions)
+    pieces = bgzf.read_segments(file_name, index['block_offsets'], index['block_starts'], segments)
+    chromosome_names = []
+    tables = [parse_block(buf, offset, chromosome_names, with_score, with_rest, file_name) for (offset, buf) in segment_lines(pieces, block_size)]
+    if len(tables) == 0:
+        table = parse_block('', 0, [], with_score, with_rest, file_name)
+    else:
+        table = IntervalTable.concatenate(tables, chromosome_names)
+    logger.info('%s: read %d lines in %d ranges (%d of %d bytes)' % (file_name, len(table), len(segments), sum(end - begin for (begin, end) in segments), index['size']))
+    return table
+
+def load_overlapping(file_name, regions, cache=False, rebuild_cache=False, with_score=False):
+    '''
+    Reads the lines of a file that can overlap the regions
+
+    Sorted BGZF files are read through their index (FILE.bgzidx if cache
+    is True, see load_bgzf_index), other files are loaded whole with load_table().
+
+    @arg regions: IntervalTable
+    @arg cache: also read and write the index of BGZF files
+    @arg rebuild_cache: also rebuild the index of BGZF files
+    '''
+    index = load_bgzf_index(file_name, cache, rebuild_cache)
+    if index is None:
+        return load_table(file_name, cache, rebuild_cache, with_score)
+    return read_indexed_table(file_name, regions, index, with_score=with_score)
+
+
+class TestParseBlock(unittest.TestCase):
+    def rows(self, table):
+        return zip([table.chromosome_names[c] for c in table.chromosome.tolist()], table.start.tolist(),
+                   table.end.tolist(), table.strand_symbols().tolist(), table.rest_of_line())
+
+    def test_columns(self):
+        text = ('track name=peaks\n'
+                '#chr\tstart\tend\n'
+                'browser position chr1:1-100\n'
+                'chr1\t10\t20\tp1\t5\t+\n'
+                'chr1  30   40 p2 5 -  x y\n'
+                'chr2\t1.5e2\t2.6e2\tp3\t5\t.\n'
+                '\n'
+                'chr2\t300\t400\n'
+                'chr2\t500\n'
+                'chr1\t1234567890123\t1234567890124\tp4\n')
+        table = parse_block(text, with_score=True, with_rest=True)
+        self.assertEqual(self.rows(table), [('chr1', 10, 20, '+', 'p1\t5\t+'),
+                                            ('chr1', 30, 40, '-', 'p2\t5\t-\tx\ty'),
+                                            ('chr2', 150, 260, '', 'p3\t5\t.'),
+                                            ('chr2', 300, 400, '', ''),
+                                            ('chr1', 1234567890123, 1234567890124, '', 'p4')])
+        self.assertEqual(table.skipped_lines, 1)
+        self.assertEqual(table.score[:3].tolist(), [5.0, 5.0, 5.0])
+        self.assertTrue(numpy.isnan(table.score[3:]).all())
+        self.assertRaises(ValueError, parse_block, 'chr1\t10\t20\nchr1\tten\t20\n')
+
+    def test_crlf(self):
+        lines = ['chr1\t%d\t%d\tp%d\t0\t%s' % (k, k + 5, k, '+-.'[k % 3]) for k in range(20)]
+        unix = parse_block('\n'.join(lines) + '\n', with_rest=True)
+        windows = parse_block('\r\n'.join(lines) + '\r\n', with_rest=True)
+        self.assertEqual(self.rows(windows), self.rows(unix))
+        ## no line break after the last line
+        self.assertEqual(self.rows(parse_block('\r\n'.join(lines), with_rest=True)), self.rows(unix))
+
+    def test_chromosome_names(self):
+        ## names that share their first 8 or 16 bytes, and prefixes of each other
+        names = ['chr1', 'chr1_gl000191_random', 'chr1_gl000192_random', 'chrUn_gl000220', 'chrUn_gl000221',
+                 'chr1_gl000191_random_long', 'c', 'chr12345', 'chr123456', 'chr1234']
+        random = numpy.random.RandomState(0)
+        picks = random.randint(0, len(names), 500).tolist()
+        text = ''.join('%s\t%d\t%d\n' % (names[k], i, i + 1) for (i, k) in enumerate(picks))
+        known = ['chrUn_gl000221', 'chr2']
+        table = parse_block(text, chromosome_names=known)
+        self.assertTrue(table.chromosome_names is known)
+        self.assertEqual([known[c] for c in table.chromosome.tolist()], [names[k] for k in picks])
+        first_seen = []
+        for k in picks:
+            if (names[k] not in first_seen) and (names[k] not in ['chrUn_gl000221', 'chr2']):
+                first_seen.append(names[k])
+        self.assertEqual(known, ['chrUn_gl000221', 'chr2'] + first_seen)
+
+    def test_block_boundaries(self):
+        work_dir = tempfile.mkdtemp(prefix='bed_loader_')
+        try:
+            random = numpy.random.RandomState(1)
+            lines = ['#header\n']
+            for k in range(300):
+                chr = ['chr1', 'chr2', 'chrUn_gl000220'][random.randint(0, 3)]
+                start = random.randint(0, 10 ** random.randint(1, 10))
+                fields = [chr, str(start), str(start + random.randint(1, 100)), 'p%d' % k, '0', '+-.'[k % 3]]
+                lines.append(' \t'[k % 2].join(fields[:random.randint(3, 7)]) + ('\r\n' if k % 5 == 0 else '\n'))
+            file_name = os.path.join(work_dir, 'peaks.bed')
+            with open(file_name, 'w') as fid:
+                fid.writelines(lines)
+            whole = read_table(file_name, block_size=1 << 20)
+            self.assertEqual(len(whole), 300)
+            for block_size in [1, 7, 64, 1000]:
+                table = read_table(file_name, block_size=block_size)
+                self.assertEqual(self.rows(table), self.rows(whole))
+                self.assertEqual(table.rest_start.tolist(), whole.rest_start.tolist())
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class TestBgzfIndex(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='bed_loader_')
+        random = numpy.random.RandomState(0)
+        lines = []
+        for chr in ['chr1', 'chr2', 'chr3']:
+            starts = numpy.sort(random.randint(0, 5000000, 20000))
+            lengths = random.randint(1, 3000, len(starts))
+            lines.extend('%s\t%d\t%d\tn\t0\t%s\n' % (chr, start, start + length, '+-'[length % 2]) for (start, length) in zip(starts.tolist(), lengths.tolist()))
+        self.lines = lines
+        self.sorted_file = self.write_bgzf('sorted.groseq', lines)
+        random.shuffle(lines)
+        self.unsorted_file = self.write_bgzf('unsorted.groseq', lines)
+        ## sparse regions, one on a chromosome missing from the peaks
+        regions = []
+        for chr in ['chr1', 'chr3', 'chr7']:
+            starts = random.randint(0, 5100000, 15)
+            regions.extend('%s\t%d\t%d\n' % (chr, start, start + random.randint(1, 40000)) for start in starts.tolist())
+        region_file = os.path.join(self.work_dir, 'regions.bed')
+        with open(region_file, 'w') as fid:
+            fid.writelines(regions)
+        self.regions = read_table(region_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_bgzf(self, name, lines):
+        plain = os.path.join(self.work_dir, name)
+        with open(plain, 'w') as fid:
+            fid.writelines(lines)
+        bgzf.compress_file(plain, plain + '.bgz')
+        return plain + '.bgz'
+
+    def counts(self, peaks):
+        from IntervalIndex import count_enclosed
+        peak_rows = dict(peaks.chromosome_groups())
+        result = []
+        for (chr, rows) in self.regions.chromosome_groups():
+            other = peak_rows.get(chr, numpy.zeros(0, dtype=numpy.int64))
+            result.extend(count_enclosed(self.regions.start[rows], self.regions.end[rows], peaks.start[other], peaks.end[other]).tolist())
+        return result
+
+    def test_indexed_counts(self):
+        full = read_table(self.sorted_file)
+        self.assertEqual(len(full), len(self.lines))
+        ## without cache the index is built in memory only
+        indexed = load_overlapping(self.sorted_file, self.regions)
+        self.assertFalse(os.path.exists(index_file_name(self.sorted_file)))
+        self.assertTrue(uncompressed_size(self.sorted_file) is None)
+        self.assertTrue(0 < len(indexed) < len(full))
+        self.assertEqual(self.counts(indexed), self.counts(full))
+        self.assertEqual(self.counts(load_overlapping(self.sorted_file, self.regions, cache=True)), self.counts(full))
+        self.assertTrue(os.path.isfile(index_file_name(self.sorted_file)))
+        self.assertEqual(uncompressed_size(self.sorted_file), len(''.join(self.lines)))
+        ## second call reads the index written by the first
+        self.assertEqual(self.counts(load_overlapping(self.sorted_file, self.regions, cache=True)), self.counts(full))
+        segments = index_segments(load_bgzf_index(self.sorted_file, cache=True), self.regions)
+        self.assertEqual(segments, sorted(segments))
+        self.assertTrue(all(end > begin for (begin, end) in segments))
+
+    def test_unsorted_fallback(self):
+        self.assertTrue(load_bgzf_index(self.unsorted_file) is None)
+        self.assertFalse(os.path.exists(index_file_name(self.unsorted_file)))
+        table = load_overlapping(self.unsorted_file, self.regions, cache=False)
+        self.assertEqual(len(table), len(self.lines))
+        self.assertEqual(self.counts(table), self.counts(read_table(self.sorted_file)))
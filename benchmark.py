@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# benchmark.py ---
+#
+# Description: Synthetic benchmarks for count_peaks.py,
+# count_peaks_in_region.py and extract_common_v3.py and their core
+# functions.
+#
+# USAGE: python benchmark.py [--scales 1e4 1e5 1e6] [--seed SEED] [--work_dir DIR] [-o OUTPUT_FILE]
+#
+# Inputs are generated with a seeded numpy RandomState on the hg19
+# chromosome sizes and kept in --work_dir, so repeated runs reuse them:
+#
+#   regions: CTCF-like regions (150-1000 bp) clustered around random centres
+#   peaks:   1 bp GRO-seq peaks, half of them inside regions, with duplicate
+#            reads and a per-site strand of which a small fraction conflicts
+#
+# Every benchmark runs in its own process and reports wall time, peak RSS
+# and records/s. The results are written as JSON.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import sys
+import os
+import time
+import json
+import platform
+import resource
+import argparse
+import subprocess
+import multiprocessing
+
+import numpy
+
+############################################################
+# Global parameters
+############################################################
+''' hg19 chromosome sizes '''
+HG19_SIZES = [('chr1', 249250621), ('chr2', 243199373), ('chr3', 198022430), ('chr4', 191154276),
+              ('chr5', 180915260), ('chr6', 171115067), ('chr7', 159138663), ('chr8', 146364022),
+              ('chr9', 141213431), ('chr10', 135534747), ('chr11', 135006516), ('chr12', 133851895),
+              ('chr13', 115169878), ('chr14', 107349540), ('chr15', 102531392), ('chr16', 90354753),
+              ('chr17', 81195210), ('chr18', 78077248), ('chr19', 59128983), ('chr20', 63025520),
+              ('chr21', 48129895), ('chr22', 51304566), ('chrX', 155270560), ('chrY', 59373566),
+              ('chrM', 16571)]
+
+''' Default numbers of records per benchmark '''
+DEFAULT_SCALES = [10 ** 4, 10 ** 5, 10 ** 6]
+
+''' Records generated and written at a time '''
+GENERATE_CHUNK = 1000000
+
+''' Regions per cluster centre '''
+CLUSTER_SIZE = 20
+
+''' Standard deviation of region positions around a cluster centre '''
+CLUSTER_SPREAD = 50000
+
+''' Mean number of reads per peak site '''
+READS_PER_SITE = 2.5
+
+''' Fraction of reads whose strand differs from that of the site '''
+STRAND_CONFLICTS = 0.001
+
+''' Regions per peak in the region counting benchmarks '''
+REGIONS_PER_PEAK = 0.01
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+############################################################
+# Seeded input generators
+############################################################
+def random_positions(random, num):
+    ''' (chromosome index, position) pairs uniform over the genome '''
+    sizes = numpy.array([size for (chr, size) in HG19_SIZES], dtype=numpy.int64)
+    genome = numpy.concatenate([[0], numpy.cumsum(sizes)])
+    positions = random.randint(0, genome[-1], num)
+    chromosomes = numpy.searchsorted(genome, positions, 'right') - 1
+    return (chromosomes, positions - genome[chromosomes])
+
+def write_columns(fid, chromosomes, starts, ends, extra_columns):
+    ''' Writes tab-separated lines from column arrays '''
+    names = numpy.array([chr for (chr, size) in HG19_SIZES])
+    columns = [names[chromosomes], starts.astype(str), ends.astype(str)] + extra_columns
+    lines = columns[0]
+    for column in columns[1:]:
+        lines = numpy.core.defchararray.add(numpy.core.defchararray.add(lines, '\t'), column)
+    fid.write('\n'.join(lines.tolist()))
+    fid.write('\n')
+
+def generate_regions(file_name, num, seed):
+    '''
+    Writes num CTCF-like regions clustered around random centres
+
+    @arg file_name: output BED file
+    @arg num: number of regions
+    @arg seed: RandomState seed
+    '''
+    random = numpy.random.RandomState(seed)
+    sizes = numpy.array([size for (chr, size) in HG19_SIZES], dtype=numpy.int64)
+    with open(file_name, 'w') as fid:
+        written = 0
+        while written < num:
+            n = min(GENERATE_CHUNK, num - written)
+            (centre_chr, centre_pos) = random_positions(random, max(n // CLUSTER_SIZE, 1))
+            cluster = random.randint(0, len(centre_chr), n)
+            chromosomes = centre_chr[cluster]
+            lengths = random.randint(150, 1000, n)
+            starts = centre_pos[cluster] + numpy.round(random.normal(0, CLUSTER_SPREAD, n)).astype(numpy.int64)
+            starts = numpy.clip(starts, 0, sizes[chromosomes] - lengths)
+            scores = random.randint(0, 1000, n)
+            write_columns(fid, chromosomes, starts, starts + lengths, [numpy.array(['ctcf']).repeat(n), scores.astype(str)])
+            written = written + n
+
+def generate_peaks(file_name, num, seed, regions_file=None):
+    '''
+    Writes num 1 bp GRO-seq reads with duplicates and mixed strands
+
+    @arg file_name: output GROSeq file
+    @arg num: number of reads
+    @arg seed: RandomState seed
+    @arg regions_file: half of the sites are placed inside these regions (if given)
+    '''
+    random = numpy.random.RandomState(seed)
+    region_chr = None
+    if regions_file is not None:
+        names = dict((chr, k) for (k, (chr, size)) in enumerate(HG19_SIZES))
+        region_chr = []
+        region_start = []
+        region_end = []
+        with open(regions_file, 'r') as fid:
+            for line in fid:
+                parts = line.split('\t')
+                region_chr.append(names[parts[0]])
+                region_start.append(int(parts[1]))
+                region_end.append(int(parts[2]))
+        region_chr = numpy.array(region_chr)
+        region_start = numpy.array(region_start, dtype=numpy.int64)
+        region_end = numpy.array(region_end, dtype=numpy.int64)
+    strand_symbols = numpy.array(['+', '-'])
+    with open(file_name, 'w') as fid:
+        written = 0
+        while written < num:
+            n = min(GENERATE_CHUNK, num - written)
+            num_sites = max(int(n / READS_PER_SITE), 1)
+            (chromosomes, starts) = random_positions(random, num_sites)
+            if region_chr is not None and len(region_chr) > 0:
+                inside = numpy.flatnonzero(random.rand(num_sites) < 0.5)
+                region = random.randint(0, len(region_chr), len(inside))
+                chromosomes[inside] = region_chr[region]
+                starts[inside] = region_start[region] + (random.rand(len(inside)) * (region_end[region] - region_start[region])).astype(numpy.int64)
+            site_strands = random.randint(0, 2, num_sites)
+            site = random.randint(0, num_sites, n)
+            strands = site_strands[site] ^ (random.rand(n) < STRAND_CONFLICTS)
+            scores = random.randint(0, 5, n)
+            write_columns(fid, chromosomes[site], starts[site], starts[site] + 1, [numpy.array(['n']).repeat(n), scores.astype(str), strand_symbols[strands]])
+            written = written + n
+
+def input_file(work_dir, kind, num, seed):
+    ''' Generates (once) and returns the name of a benchmark input file '''
+    file_name = os.path.join(work_dir, '%s_%d_%d.%s' % (kind, num, seed, 'groseq' if kind == 'peaks' else 'bed'))
+    if not os.path.exists(file_name):
+        print >> sys.stderr, 'Generating', file_name
+        if kind == 'peaks':
+            generate_peaks(file_name + '.tmp', num, seed, input_file(work_dir, 'regions', max(int(num * REGIONS_PER_PEAK), 1), seed))
+        elif kind == 'regions2':
+            generate_regions(file_name + '.tmp', num, seed + 1)
+        else:
+            generate_regions(file_name + '.tmp', num, seed)
+        os.rename(file_name + '.tmp', file_name)
+    return file_name
+
+
+############################################################
+# Measurements
+############################################################
+def run_command(command, work_dir):
+    ''' Runs a command and returns (wall time, peak RSS in KB) of that process '''
+    start = time.time()
+    with open(os.devnull, 'w') as null:
+        process = subprocess.Popen(command, cwd=work_dir, stdout=null, stderr=null)
+        (pid, status, usage) = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError('%s failed with status %d' % (' '.join(command), status))
+    return (elapsed, usage.ru_maxrss)
+
+def _run_function(function, args, connection):
+    ''' Process body for run_function() '''
+    prepared = function(*args)
+    start = time.time()
+    prepared()
+    elapsed = time.time() - start
+    connection.send((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    connection.close()
+
+def run_function(function, args):
+    '''
+    Runs function(*args)() in a new process
+
+    function prepares the inputs and returns the callable that is timed.
+
+    @return (wall time, peak RSS in KB) of that process
+    '''
+    (receiver, sender) = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_run_function, args=(function, args, sender))
+    process.start()
+    ## only the child holds the sending end: recv() sees EOF if it dies
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError('%s failed with exit code %s' % (function.__name__, process.exitcode))
+    return result
+
+
+############################################################
+# Benchmarks - each returns (record count, command or prepared function)
+############################################################
+def tool_count_peaks(work_dir, num, seed):
+    peaks = input_file(work_dir, 'peaks', num, seed)
+    return (num, [sys.executable, os.path.join(SCRIPT_DIR, 'count_peaks.py'), peaks, 'count_peaks.out'])
+
+def tool_count_peaks_in_region(work_dir, num, seed):
+    peaks = input_file(work_dir, 'peaks', num, seed)
+    regions = input_file(work_dir, 'regions', max(int(num * REGIONS_PER_PEAK), 1), seed)
+    return (num, [sys.executable, os.path.join(SCRIPT_DIR, 'count_peaks_in_region.py'), '--no_cache', regions, peaks, 'count_peaks_in_region.out'])
+
+def tool_extract_common(work_dir, num, seed):
+    regions1 = input_file(work_dir, 'regions', num, seed)
+    regions2 = input_file(work_dir, 'regions2', num, seed)
+    return (2 * num, [sys.executable, os.path.join(SCRIPT_DIR, 'extract_common_v3.py'), '--no_cache',
+                      os.path.basename(regions1), os.path.basename(regions2)])
+
+def prepare_find_overlapping_sequences(regions1, regions2):
+    from extract_common_v3 import read_file_to_map, find_overlapping_sequences
+    with open(regions1, 'r') as fid:
+        map1 = read_file_to_map(fid, cache=False)
+    with open(regions2, 'r') as fid:
+        map2 = read_file_to_map(fid, cache=False)
+    return lambda: [find_overlapping_sequences(map1[chr], map2[chr]) for chr in set(map1).intersection(map2)]
+
+def prepare_interval_tree(regions):
+    from IntervalTree import Interval, IntervalTree
+    from bed_loader import read_table
+    table = read_table(regions)
+    intervals = [Interval(start, end, k) for (k, (start, end)) in enumerate(zip(table.start.tolist(), table.end.tolist()))]
+    return lambda: IntervalTree.init_from_list(intervals)
+
+def prepare_count_peaks_in_regions(regions, peaks):
+    from count_peaks_in_region import count_peaks_in_regions
+    from bed_loader import read_table
+    region_table = read_table(regions)
+    peak_table = read_table(peaks)
+    return lambda: count_peaks_in_regions(region_table, peak_table)
+
+def function_find_overlapping_sequences(work_dir, num, seed):
+    return (2 * num, (prepare_find_overlapping_sequences, (input_file(work_dir, 'regions', num, seed), input_file(work_dir, 'regions2', num, seed))))
+
+def function_interval_tree(work_dir, num, seed):
+    return (num, (prepare_interval_tree, (input_file(work_dir, 'regions', num, seed),)))
+
+def function_count_peaks_in_regions(work_dir, num, seed):
+    return (num, (prepare_count_peaks_in_regions, (input_file(work_dir, 'regions', max(int(num * REGIONS_PER_PEAK), 1), seed), input_file(work_dir, 'peaks', num, seed))))
+
+''' (name, kind, setup function) - kind is 'command' or 'function' '''
+BENCHMARKS = [('count_peaks.py', 'command', tool_count_peaks),
+              ('count_peaks_in_region.py', 'command', tool_count_peaks_in_region),
+              ('extract_common_v3.py', 'command', tool_extract_common),
+              ('find_overlapping_sequences', 'function', function_find_overlapping_sequences),
+              ('IntervalTree.init_from_list', 'function', function_interval_tree),
+              ('count_peaks_in_regions', 'function', function_count_peaks_in_regions)]
+
+
+def run_benchmarks(work_dir, scales=DEFAULT_SCALES, seed=0, names=None):
+    '''
+    Runs the benchmarks at each scale
+
+    @arg work_dir: directory for generated inputs and tool outputs
+    @arg scales: numbers of input records
+    @arg seed: RandomState seed of the generated inputs
+    @arg names: benchmark names to run (default: all)
+    @return list of result dicts
+    '''
+    results = []
+    for num in scales:
+        for (name, kind, setup) in BENCHMARKS:
+            if names is not None and name not in names:
+                continue
+            (records, task) = setup(work_dir, num, seed)
+            print >> sys.stderr, 'Running', name, 'on', records, 'records'
+            try:
+                if kind == 'command':
+                    (elapsed, peak_rss) = run_command(task, work_dir)
+                else:
+                    (elapsed, peak_rss) = run_function(*task)
+            except RuntimeError as error:
+                print >> sys.stderr, '%s %d records: %s' % (name, records, error)
+                results.append({'benchmark': name, 'scale': num, 'records': records, 'error': str(error)})
+                continue
+            results.append({'benchmark': name, 'scale': num, 'records': records,
+                            'wall_time': elapsed, 'peak_rss_kb': peak_rss,
+                            'records_per_second': (records / elapsed if elapsed > 0 else None)})
+            print >> sys.stderr, '%s %d records: %.3f s, %d KB, %.0f records/s' % (name, records, elapsed, peak_rss, records / max(elapsed, 1e-9))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic benchmarks for the command-line tools and their core functions.')
+    parser.add_argument('--scales', metavar='N', type=float, nargs='+', default=DEFAULT_SCALES, help='Numbers of records, e.g. 1e4 1e5 ... 1e8 (default: 1e4 1e5 1e6)')
+    parser.add_argument('--seed', metavar='SEED', type=int, default=0, help='Seed for the generated inputs (default: 0)')
+    parser.add_argument('--work_dir', metavar='DIR', type=str, default='benchmark_data', help='Directory for generated inputs and outputs (default: benchmark_data)')
+    parser.add_argument('--benchmarks', metavar='NAME', type=str, nargs='+', default=None, choices=[name for (name, kind, setup) in BENCHMARKS], help='Benchmarks to run (default: all)')
+    parser.add_argument('-o', metavar='OUTPUT_FILE', type=str, default=None, help='Write JSON results to OUTPUT_FILE (default: stdout)')
+    args = parser.parse_args(sys.argv[1:])
+
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+    sys.path.insert(0, SCRIPT_DIR)
+    results = run_benchmarks(os.path.abspath(args.work_dir), [int(x) for x in args.scales], args.seed, args.benchmarks)
+    report = {'seed': args.seed, 'python': platform.python_version(), 'numpy': numpy.__version__,
+              'platform': platform.platform(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+    if args.o is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(args.o, 'w') as fid:
+            json.dump(report, fid, indent=2, sort_keys=True)
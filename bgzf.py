@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# bgzf.py ---
+#
+# USAGE: python bgzf.py INPUT_FILE OUTPUT_FILE
+#
+# Description: Transparent gzip / BGZF input.
+#
+# BGZF (the bgzip format read by tabix and samtools) is a series of gzip
+# members holding at most 64 KB of data each, with the size of the
+# compressed member in a header field. Blocks can be located without
+# decompressing them, so they are inflated in a thread pool (zlib releases
+# the GIL) and, given a table of block offsets, a byte range of the
+# uncompressed data can be read by inflating only the blocks holding it.
+# Plain gzip files are read as a single stream.
+#
+# Run as a script, compresses INPUT_FILE into a BGZF OUTPUT_FILE (as
+# bgzip does).
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import io
+import os
+import sys
+import gzip
+import zlib
+import shutil
+import struct
+import argparse
+import tempfile
+import unittest
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+############################################################
+# Global parameters
+############################################################
+GZIP_MAGIC = '\x1f\x8b'
+
+''' Fixed gzip header with the BC extra subfield written by bgzip '''
+BGZF_HEADER_SIZE = 18
+
+''' Uncompressed bytes per block written by compress_file() (bgzip uses the same) '''
+BGZF_BLOCK_DATA = 0xff00
+
+''' Empty block marking the end of a BGZF file '''
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+''' Threads inflating BGZF blocks '''
+THREADS = min(4, multiprocessing.cpu_count())
+
+''' Blocks handed to each thread per batch '''
+BLOCKS_PER_THREAD = 64
+
+''' Buffer of the file objects returned by open_input() '''
+READ_BUFFER_SIZE = 1 << 20
+
+
+############################################################
+# File format
+############################################################
+def is_bgzf_header(header):
+    ''' True if header starts a gzip member with the BC (block size) extra subfield '''
+    return (len(header) >= BGZF_HEADER_SIZE and header.startswith(GZIP_MAGIC) and (ord(header[3]) & 4) != 0
+            and header[12:14] == 'BC' and struct.unpack('<H', header[14:16])[0] == 2)
+
+def file_format(file_name):
+    ''' 'bgzf', 'gzip' or 'plain' from the first bytes of a file '''
+    with open(file_name, 'rb') as fid:
+        header = fid.read(BGZF_HEADER_SIZE)
+    if not header.startswith(GZIP_MAGIC):
+        return 'plain'
+    if is_bgzf_header(header):
+        return 'bgzf'
+    return 'gzip'
+
+def is_compressed(file_name):
+    return file_format(file_name) != 'plain'
+
+
+############################################################
+# BGZF blocks
+############################################################
+def read_raw_block(fid):
+    '''
+    Reads the BGZF block at the current position of fid
+
+    @return block as a string, '' at the end of the file
+    '''
+    offset = fid.tell()
+    header = fid.read(BGZF_HEADER_SIZE)
+    if len(header) == 0:
+        return ''
+    if not is_bgzf_header(header):
+        raise IOError('%s: no BGZF block at byte %d' % (fid.name, offset))
+    block_size = struct.unpack('<H', header[16:18])[0] + 1
+    block = header + fid.read(block_size - BGZF_HEADER_SIZE)
+    if len(block) != block_size:
+        raise IOError('%s: truncated BGZF block at byte %d' % (fid.name, offset))
+    return block
+
+def inflate_block(block):
+    return zlib.decompress(block, 16 + zlib.MAX_WBITS)
+
+def inflate_blocks(raw_blocks, threads=THREADS):
+    '''
+    Generator over (key, data) of an iterable of (key, raw block), in order
+
+    Blocks are inflated in batches by a pool of threads; the next batch is
+    inflated while the current one is consumed.
+    '''
+    if threads <= 1:
+        for (key, block) in raw_blocks:
+            yield (key, inflate_block(block))
+        return
+    raw_blocks = iter(raw_blocks)
+    pool = ThreadPool(threads)
+    try:
+        pending = None
+        while True:
+            batch = list(itertools.islice(raw_blocks, BLOCKS_PER_THREAD * threads))
+            submitted = None
+            if len(batch) > 0:
+                submitted = (batch, pool.map_async(inflate_block, [block for (key, block) in batch]))
+            if pending is not None:
+                for ((key, block), data) in itertools.izip(pending[0], pending[1].get()):
+                    yield (key, data)
+            if submitted is None:
+                break
+            pending = submitted
+    finally:
+        pool.terminate()
+        pool.join()
+
+def scan_blocks(file_name):
+    '''
+    Table of the blocks of a BGZF file, read from the block headers and trailers
+
+    @return (compressed offsets, uncompressed offsets, uncompressed size) - the
+            arrays have one entry per block
+    '''
+    offsets = []
+    starts = []
+    position = 0
+    with open(file_name, 'rb') as fid:
+        offset = 0
+        while True:
+            header = fid.read(BGZF_HEADER_SIZE)
+            if len(header) == 0:
+                break
+            if not is_bgzf_header(header):
+                raise IOError('%s: no BGZF block at byte %d' % (file_name, offset))
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            fid.seek(offset + block_size - 4)
+            trailer = fid.read(4)
+            if len(trailer) != 4:
+                raise IOError('%s: truncated BGZF block at byte %d' % (file_name, offset))
+            offsets.append(offset)
+            starts.append(position)
+            position += struct.unpack('<I', trailer)[0]
+            offset += block_size
+    return (numpy.array(offsets, dtype=numpy.int64), numpy.array(starts, dtype=numpy.int64), position)
+
+def read_segments(file_name, block_offsets, block_starts, segments, threads=THREADS):
+    '''
+    Reads byte ranges of the uncompressed data of a BGZF file
+
+    Only the blocks holding the ranges are read and inflated.
+
+    @arg block_offsets, block_starts: block table (see scan_blocks)
+    @arg segments: sorted, disjoint list of (begin, end) uncompressed offsets
+    @return generator over (offset, data) - pieces of at most one block, in
+            order; the pieces of a segment are contiguous
+    '''
+    block_offsets = numpy.asarray(block_offsets)
+    block_starts = numpy.asarray(block_starts)
+    segments = [(begin, end) for (begin, end) in segments if end > begin]
+    if len(segments) == 0 or len(block_starts) == 0:
+        return
+    begins = numpy.array([begin for (begin, end) in segments], dtype=numpy.int64)
+    ends = numpy.array([end for (begin, end) in segments], dtype=numpy.int64)
+    first = numpy.searchsorted(block_starts, begins, 'right') - 1
+    last = numpy.searchsorted(block_starts, ends, 'left') - 1
+    needed = numpy.unique(numpy.concatenate([numpy.arange(b0, b1 + 1) for (b0, b1) in zip(first.tolist(), last.tolist())]))
+    with open(file_name, 'rb') as fid:
+        def raw_blocks():
+            for b in needed.tolist():
+                if fid.tell() != block_offsets[b]:
+                    fid.seek(block_offsets[b])
+                yield (b, read_raw_block(fid))
+        blocks = inflate_blocks(raw_blocks(), threads)
+        current = (-1, '')
+        for (begin, end, b0, b1) in itertools.izip(begins.tolist(), ends.tolist(), first.tolist(), last.tolist()):
+            for b in xrange(b0, b1 + 1):
+                if current[0] != b:
+                    current = next(blocks)
+                block_start = int(block_starts[b])
+                lo = max(begin - block_start, 0)
+                hi = min(end - block_start, len(current[1]))
+                if hi > lo:
+                    yield (block_start + lo, current[1][lo:hi])
+
+
+############################################################
+# File objects
+############################################################
+class BgzfReader(io.RawIOBase):
+    '''
+    Raw stream of the uncompressed data of a BGZF file
+
+    Blocks are inflated ahead of the reader by inflate_blocks().
+    '''
+    def __init__(self, file_name, threads=THREADS):
+        io.RawIOBase.__init__(self)
+        self.name = file_name
+        self.fid = open(file_name, 'rb')
+        self.blocks = inflate_blocks(self.raw_blocks(), threads)
+        self.data = ''
+        self.position = 0
+
+    def raw_blocks(self):
+        while True:
+            offset = self.fid.tell()
+            block = read_raw_block(self.fid)
+            if len(block) == 0:
+                return
+            yield (offset, block)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.position >= len(self.data):
+            try:
+                (offset, self.data) = next(self.blocks)
+            except StopIteration:
+                return 0
+            self.position = 0
+        n = min(len(b), len(self.data) - self.position)
+        b[:n] = self.data[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.blocks.close()
+            self.fid.close()
+        io.RawIOBase.close(self)
+
+def open_input(file_name, threads=THREADS):
+    ''' Binary file object of the uncompressed contents of a plain, gzip or BGZF file '''
+    format = file_format(file_name)
+    if format == 'bgzf':
+        return io.BufferedReader(BgzfReader(file_name, threads), READ_BUFFER_SIZE)
+    if format == 'gzip':
+        return gzip.open(file_name, 'rb')
+    return open(file_name, 'rb')
+
+
+############################################################
+# Writing BGZF files
+############################################################
+def compress_block(data, level=6):
+    ''' BGZF block of at most BGZF_BLOCK_DATA bytes of data '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER_SIZE + len(deflated) + 8
+    header = GZIP_MAGIC + struct.pack('<BBIBBHBBHH', 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1)
+    return header + deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+def compress_file(input_file, output_file, level=6):
+    ''' Writes the (uncompressed) contents of input_file as a BGZF file '''
+    with open_input(input_file) as ifid:
+        with open(output_file, 'wb') as ofid:
+            while True:
+                data = ifid.read(BGZF_BLOCK_DATA)
+                if len(data) == 0:
+                    break
+                ofid.write(compress_block(data, level))
+            ofid.write(BGZF_EOF)
+
+
+class TestBgzf(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='bgzf_')
+        random = numpy.random.RandomState(0)
+        ## several blocks of text
+        lines = ['chr%d\t%d\t%d\n' % (c, s, s + 10) for (c, s) in zip(random.randint(1, 23, 30000).tolist(), random.randint(0, 10 ** 8, 30000).tolist())]
+        self.data = ''.join(lines)
+        self.plain = os.path.join(self.work_dir, 'data.txt')
+        with open(self.plain, 'wb') as fid:
+            fid.write(self.data)
+        self.bgzf = os.path.join(self.work_dir, 'data.txt.bgz')
+        compress_file(self.plain, self.bgzf)
+        self.gzip = os.path.join(self.work_dir, 'data.txt.gz')
+        with gzip.open(self.gzip, 'wb') as fid:
+            fid.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_formats(self):
+        self.assertEqual([file_format(x) for x in (self.plain, self.gzip, self.bgzf)], ['plain', 'gzip', 'bgzf'])
+        ## BGZF files are valid gzip files
+        with gzip.open(self.bgzf, 'rb') as fid:
+            self.assertEqual(fid.read(), self.data)
+
+    def test_round_trip(self):
+        for file_name in (self.plain, self.gzip, self.bgzf):
+            with open_input(file_name) as fid:
+                self.assertEqual(fid.read(), self.data)
+        ## small reads across block boundaries, single thread
+        reader = BgzfReader(self.bgzf, threads=1)
+        parts = []
+        buf = bytearray(1000)
+        while True:
+            n = reader.readinto(buf)
+            if n == 0:
+                break
+            parts.append(str(buf[:n]))
+        reader.close()
+        self.assertEqual(''.join(parts), self.data)
+
+    def test_read_segments(self):
+        (offsets, starts, size) = scan_blocks(self.bgzf)
+        self.assertEqual(size, len(self.data))
+        self.assertTrue(len(offsets) > 2)
+        random = numpy.random.RandomState(1)
+        ## disjoint ranges, the last one reaching the end of the data
+        bounds = numpy.unique(numpy.r_[random.randint(0, size, 19), size])
+        bounds = bounds[len(bounds) % 2:]
+        segments = zip(bounds[0::2].tolist(), bounds[1::2].tolist())
+        pieces = list(read_segments(self.bgzf, offsets, starts, segments))
+        for (begin, end) in segments:
+            data = ''.join(piece for (offset, piece) in pieces if begin <= offset < end)
+            self.assertEqual(data, self.data[begin:end])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compresses a (plain or gzip) file into a BGZF file, as bgzip does.')
+    parser.add_argument('input_file', metavar='INPUT_FILE', type=str, help='Plain, gzip or BGZF input file')
+    parser.add_argument('output_file', metavar='OUTPUT_FILE', type=str, help='BGZF output file')
+    args = parser.parse_args(sys.argv[1:])
+    compress_file(args.input_file, args.output_file)
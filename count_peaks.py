@@ -33,12 +33,20 @@
 #  
 
 import sys
-import re 
-import math
+import os
+import heapq
+import shutil
+import tempfile
+import argparse
+import unittest
+
+import numpy
 
 from logger import logger
-from GROSeqRecord import GROSeqRecord,GROSeqStringCmp
-from update_progress import update_progress, PROGRESS_DELAY 
+from bed_loader import iter_tables, uncompressed_size, STRAND_PLUS, STRAND_MINUS, BLOCK_SIZE
+from GROSeqRecord import chromosome_sort_key, site_sort_key, natural_chromosome_ranks, packed_sort_keys, POSITION_BITS
+from update_progress import ProgressReporter
+from pipeline import read_ahead, batches, BatchWriter
 
 ############################################################
 # Global parameters
@@ -46,98 +54,393 @@ from update_progress import update_progress, PROGRESS_DELAY
 ''' Separator for output file formatting '''
 SEPARATOR = '\t'
 
+''' Peak lines counted in memory per chunk in bounded-memory mode '''
+CHUNK_SIZE = 20000000
+
+''' Sites per output batch (formatted in one string and queued to the writer thread) '''
+WRITE_BATCH_SIZE = 1 << 18
+
+''' Strand bitmask of a site: OR of the bits of its reads (3 = conflicting or missing strand) '''
+PLUS_BIT = 1
+MINUS_BIT = 2
+
+''' Output strand of each bitmask '''
+MASK_SYMBOLS = ['.', '+', '-', '.']
+SYMBOL_MASKS = {'+': PLUS_BIT, '-': MINUS_BIT, '.': PLUS_BIT | MINUS_BIT}
+
+
+############################################################
+# Reading GROSeq peaks
+############################################################
+class PeakColumns:
+    '''
+    Chromosome codes, peak starts, peak ends and strand bits of a set of peak lines
+
+    Chromosome codes index the chromosome_names list shared by the tables
+    of a file (see bed_loader.iter_tables).
+    '''
+    def __init__(self, chromosome, start, end, strand_bits):
+        self.chromosome = chromosome
+        self.start = start
+        self.end = end
+        self.strand_bits = strand_bits
+
+    @classmethod
+    def from_table(cls, table):
+        strand_bits = numpy.where(table.strand == STRAND_PLUS, PLUS_BIT, numpy.where(table.strand == STRAND_MINUS, MINUS_BIT, PLUS_BIT | MINUS_BIT)).astype(numpy.uint8)
+        return cls(table.chromosome, table.start, table.end, strand_bits)
+
+    @classmethod
+    def concatenate(cls, columns):
+        if len(columns) == 1:
+            return columns[0]
+        join = lambda name: numpy.concatenate([getattr(c, name) for c in columns])
+        return cls(join('chromosome'), join('start'), join('end'), join('strand_bits'))
+
+    def take(self, rows):
+        return PeakColumns(self.chromosome[rows], self.start[rows], self.end[rows], self.strand_bits[rows])
+
+    def __len__(self):
+        return len(self.start)
+
+def read_peak_blocks(input_file, block_size=BLOCK_SIZE):
+    '''
+    Generator over the peak lines of a GROSeq file in blocks
+
+    @param input_file: Input GROSeq .bed file
+    @param block_size: Bytes read per block
+    @return (chromosome_names, PeakColumns) per block, chromosome_names is shared by all blocks
+    '''
+    ## compressed files: percentage only if the uncompressed size is known (BGZF index)
+    total_bytes = uncompressed_size(input_file)
+    skipped_lines = 0
+    missing_strands = 0
+    with ProgressReporter('Reading ' + input_file, total_bytes=total_bytes) as progress:
+        for table in iter_tables(input_file, block_size):
+            if len(table) == 0:
+                continue
+            progress.update(len(table), table.rest_end[-1])
+            skipped_lines = skipped_lines + table.skipped_lines
+            missing_strands = missing_strands + int(numpy.count_nonzero((table.strand != STRAND_PLUS) & (table.strand != STRAND_MINUS)))
+            yield (table.chromosome_names, PeakColumns.from_table(table))
+    if skipped_lines > 0:
+        print >> sys.stderr, '\n', skipped_lines, 'incomplete lines - skipping'
+    if missing_strands > 0:
+        print >> sys.stderr, '\n', missing_strands, "lines with missing strand - strand of their sites written as '.'"
+
+
+############################################################
+# Counting and merging sorted counts
+############################################################
+def count_sites(peaks, chromosome_names):
+    '''
+    Counts identical (chromosome, peak_start, peak_end) sites
+
+    Sites are packed into integer keys (natural chromosome rank, peak start),
+    sorted together with the peak end and counted in one unique pass. The
+    strand bits of the reads of a site are OR-ed together.
+
+    @param peaks: PeakColumns
+    @param chromosome_names: names of the chromosome codes of peaks
+    @return PeakColumns of the distinct sites in output order, and the array of counts
+            (strand_bits holds the bitmask of each site)
+    '''
+    if len(peaks) == 0:
+        return (peaks, numpy.zeros(0, dtype=numpy.int64))
+    if peaks.start.min() < 0 or peaks.start.max() >= (1 << POSITION_BITS):
+        raise ValueError('Peak starts must lie in [0, 2^%d)' % POSITION_BITS)
+    ranks = natural_chromosome_ranks(chromosome_names)[peaks.chromosome]
+    order = numpy.lexsort((peaks.end, packed_sort_keys(ranks, peaks.start)))
+    sorted_peaks = peaks.take(order)
+    new_site = numpy.ones(len(order), dtype=bool)
+    new_site[1:] = ((sorted_peaks.chromosome[1:] != sorted_peaks.chromosome[:-1]) | (sorted_peaks.start[1:] != sorted_peaks.start[:-1]) |
+                    (sorted_peaks.end[1:] != sorted_peaks.end[:-1]))
+    first = numpy.flatnonzero(new_site)
+    sites = sorted_peaks.take(first)
+    sites.strand_bits = numpy.bitwise_or.reduceat(sorted_peaks.strand_bits, first)
+    counts = numpy.diff(numpy.r_[first, len(order)])
+    return (sites, counts)
+
+def merge_sorted_counts(sorted_counts):
+    '''
+    Adds up the counts of equal consecutive sites
+
+    @param sorted_counts: iterable of (site, count, strand_bits) sorted by site
+    @return generator of [site, count, strand_bits]
+    '''
+    current = None
+    for (key, count, strand_bits) in sorted_counts:
+        if (current is not None) and (current[0] == key):
+            current[1] = current[1] + count
+            current[2] = current[2] | strand_bits
+        else:
+            if current is not None:
+                yield current
+            current = [key, count, strand_bits]
+    if current is not None:
+        yield current
+
+def format_sites(chromosome_names, sites, counts):
+    ''' CHROMOSOME PEAK_START PEAK_END COUNT STRAND lines for counted sites '''
+    names = numpy.array(chromosome_names, dtype=object)[sites.chromosome].tolist()
+    strands = numpy.array(MASK_SYMBOLS, dtype=object)[sites.strand_bits].tolist()
+    return ''.join('%s\t%d\t%d\t%d\t%s\n' % record for record in zip(names, sites.start.tolist(), sites.end.tolist(), counts.tolist(), strands))
+
+def write_sites(writer, fid, chromosome_names, sites, counts, batch_size=WRITE_BATCH_SIZE):
+    ''' Queues the format_sites() lines of counted sites to a BatchWriter, batch_size sites at a time '''
+    for first in xrange(0, len(counts), batch_size):
+        rows = slice(first, first + batch_size)
+        writer.write(fid, format_sites(chromosome_names, sites.take(rows), counts[rows]))
+
+def format_counts(sorted_counts):
+    ''' Output lines of (site, count, strand_bits) records '''
+    return ''.join(SEPARATOR.join([site[0], str(site[1]), str(site[2]), str(count), MASK_SYMBOLS[strand_bits]]) + '\n' for (site, count, strand_bits) in sorted_counts)
+
+def read_counts(file_name):
+    ''' Generator over (site, count, strand_bits) records of a file written by write_sites() '''
+    with open(file_name, 'r') as fid:
+        for line in fid:
+            parts = line.rstrip('\n').split(SEPARATOR)
+            yield ((parts[0], int(parts[1]), int(parts[2])), int(parts[3]), SYMBOL_MASKS[parts[4]])
+
+def merge_count_files(file_names):
+    ''' Merges files of (site, count, strand_bits) records sorted in output order '''
+    keyed = [((site_sort_key(record[0]), record) for record in read_counts(f)) for f in file_names]
+    return (record for (key, record) in heapq.merge(*keyed))
+
+def copy_counts(input_files, output_file):
+    ''' Concatenates count files '''
+    with open(output_file, 'w') as ofid:
+        for file_name in input_files:
+            with open(file_name, 'r') as fid:
+                shutil.copyfileobj(fid, ofid)
+
+def report_conflicts(num_conflicts):
+    if num_conflicts > 0:
+        print >> sys.stderr, '\n', num_conflicts, "sites with conflicting or missing strands - strand written as '.'"
+
 
 ############################################################
 # Peak counter
 ############################################################    
-def count_peaks(input_file, output_file): 
+def count_peaks(input_file, output_file, chunk_size=None, sorted_input=False, tmp_dir=None, block_size=BLOCK_SIZE): 
     '''
     Top-level function which counts peaks from GROSeq files
 
     @param input_file: Input GROSeq .bed file
     @param output_file: File to which write the output
+    @param chunk_size: Count at most chunk_size peak lines in memory at a time (default: no limit)
+    @param sorted_input: Input is sorted by chromosome and peak start
+    @param tmp_dir: Directory for temporary files in bounded-memory modes
+    @param block_size: Bytes of the input read per block
+    '''
+    if sorted_input:
+        return count_peaks_sorted(input_file, output_file, tmp_dir, block_size)
+    if chunk_size is not None:
+        return count_peaks_chunked(input_file, output_file, chunk_size, tmp_dir, block_size)
+    chromosome_names = []
+    blocks = []
+    for (chromosome_names, peaks) in read_ahead(read_peak_blocks(input_file, block_size)):
+        blocks.append(peaks)
+    if len(blocks) == 0:
+        open(output_file, 'w').close()
+        return
+    peaks = PeakColumns.concatenate(blocks)
+    print >> sys.stderr, "\nCounting and sorting", len(peaks), "peaks"
+    (sites, counts) = count_sites(peaks, chromosome_names)
+    ############################################################
+    # Write output file
+    ############################################################
+    with open(output_file, 'w') as ofid, BatchWriter() as writer:
+        write_sites(writer, ofid, chromosome_names, sites, counts)
+    report_conflicts(int(numpy.count_nonzero(sites.strand_bits == (PLUS_BIT | MINUS_BIT))))
+
+def count_peaks_chunked(input_file, output_file, chunk_size=CHUNK_SIZE, tmp_dir=None, block_size=BLOCK_SIZE):
+    '''
+    Bounded-memory peak counter
+
+    Counts chunks of at most chunk_size peak lines (rounded up to whole
+    blocks read by bed_loader), spills the sorted counts of each chunk to
+    a temporary file and k-way merges the partial counts. The next chunk
+    is read and counted while the writer thread writes the previous one.
     '''
-    with open(input_file, 'r') as fid: 
-        line_count = 0
-        lines = fid.readlines() 
-        res_dict = dict()
-        total_lines = len(lines)   
-        unreliable_strands_flag = False
+    work_dir = tempfile.mkdtemp(prefix='count_peaks_', dir=tmp_dir)
+    try:
+        spill_files = []
+        blocks = []
+        def spill(chromosome_names):
+            (sites, counts) = count_sites(PeakColumns.concatenate(blocks), chromosome_names)
+            spill_file = os.path.join(work_dir, 'chunk%d' % len(spill_files))
+            logger.info('Writing %d sites to %s' % (len(counts), spill_file))
+            sfid = open(spill_file, 'w')
+            write_sites(writer, sfid, chromosome_names, sites, counts)
+            writer.close_file(sfid)
+            spill_files.append(spill_file)
+            del blocks[:]
+        with BatchWriter() as writer:
+            for (chromosome_names, peaks) in read_ahead(read_peak_blocks(input_file, block_size)):
+                blocks.append(peaks)
+                if sum(len(b) for b in blocks) >= chunk_size:
+                    spill(chromosome_names)
+            if len(blocks) > 0:
+                spill(chromosome_names)
         ############################################################
-        # Read input file
+        # Merge sorted partial counts
         ############################################################
-        for line_orig in lines:
-            line_count = line_count + 1
-            ############################################################
-            #  Updating progress counter - can be safely removed
+        print >> sys.stderr, "\nMerging", len(spill_files), "sorted chunks"
+        num_conflicts = 0
+        with open(output_file, 'w') as ofid, BatchWriter() as writer:
+            for records in batches(merge_sorted_counts(merge_count_files(spill_files))):
+                num_conflicts = num_conflicts + sum(record[2] == (PLUS_BIT | MINUS_BIT) for record in records)
+                writer.write(ofid, format_counts(records))
+        report_conflicts(num_conflicts)
+    finally:
+        shutil.rmtree(work_dir)
+
+def count_peaks_sorted(input_file, output_file, tmp_dir=None, block_size=BLOCK_SIZE):
+    '''
+    Streaming peak counter for input sorted by chromosome and peak start
+
+    Each block is counted as soon as it is read, except for the peaks at
+    its last (chromosome, peak start), which are carried over to the next
+    block. Chromosomes are written to separate temporary files (by the
+    writer thread) and concatenated in output order at the end.
+    '''
+    work_dir = tempfile.mkdtemp(prefix='count_peaks_', dir=tmp_dir)
+    writer = BatchWriter()
+    try:
+        chromosome_files = dict()
+        state = {'fid': None, 'chromosome': None, 'conflicts': 0}
+        def write_block(chromosome_names, peaks):
+            (sites, counts) = count_sites(peaks, chromosome_names)
+            state['conflicts'] = state['conflicts'] + int(numpy.count_nonzero(sites.strand_bits == (PLUS_BIT | MINUS_BIT)))
+            boundaries = numpy.flatnonzero(numpy.diff(sites.chromosome)) + 1
+            groups = zip(numpy.r_[0, boundaries].tolist(), numpy.r_[boundaries, len(sites)].tolist())
+            ## sites come in output order: go through their chromosomes in file
+            ## order, so that a chromosome file is never opened twice
+            file_order = peaks.chromosome[numpy.r_[0, numpy.flatnonzero(numpy.diff(peaks.chromosome)) + 1]].tolist()
+            for (first, last) in sorted(groups, key=lambda group: file_order.index(sites.chromosome[group[0]])):
+                chr = chromosome_names[sites.chromosome[first]]
+                if chr != state['chromosome']:
+                    if state['fid'] is not None:
+                        writer.close_file(state['fid'])
+                    chromosome_files[chr] = os.path.join(work_dir, 'chr%d' % len(chromosome_files))
+                    state['fid'] = open(chromosome_files[chr], 'w')
+                    state['chromosome'] = chr
+                write_sites(writer, state['fid'], chromosome_names, sites.take(slice(first, last)), counts[first:last])
+        carry = None
+        current = None
+        finished = set()
+        chromosome_names = []
+        for (chromosome_names, peaks) in read_ahead(read_peak_blocks(input_file, block_size)):
+            if carry is not None:
+                peaks = PeakColumns.concatenate([carry, peaks])
             ############################################################
-            if line_count % PROGRESS_DELAY == 0:
-                progress = line_count * 1.0 / total_lines 
-                update_progress(progress, ('Reading ' + input_file)) 
+            # Check order: chromosomes contiguous, starts non-decreasing
             ############################################################
-            # Main function body
-            ############################################################    
-            line_orig = line_orig.strip()
-            parts = re.split('\s', line_orig)
-            ### do not put strand unless specified
-            strand = ''             
-            if len(parts) < 3: 
-                print >> sys.stderr,  line_count,  line_orig, 'Incomplete line - skipping'
-                continue
-            elif len(parts) < 6: 
-                unreliable_strands_flag = True
-                print >> sys.stderr, line_count, line_orig, 'missing strand - ignoring strands in output!'              
-            else: 
-                strand = parts[5]
-            ### constructing basic line - faster using str as key!
-            line = SEPARATOR.join(parts[0:3])
-            if line in res_dict:
-                prev_count = res_dict[line][0]
-                prev_strand = res_dict[line][1]
-                ############################################################
-                ## THIS LINE NEEDS TO BE REMOVED IF WISH TO SEE CONFLICTS
-                ############################################################
-                if (not unreliable_strands_flag) and (strand is not prev_strand):
-                    print >> sys.stderr, "\n", line_count, line, ' strand: ', strand, ' prev_strand: ' , prev_strand
-                    unreliable_strands_flag = True
-                res_dict[line] = (prev_count + 1, prev_strand)
-            else:
-                res_dict[line] = (1, strand)
-        ############################################################
-        # Write output file
-        ############################################################
-        output_line_count = len(res_dict)
-        curr_oline = 0
-        with open(output_file, 'w') as ofid:
+            changes = numpy.flatnonzero(peaks.chromosome[1:] != peaks.chromosome[:-1]) + 1
+            backwards = numpy.flatnonzero((peaks.start[1:] < peaks.start[:-1]) & (peaks.chromosome[1:] == peaks.chromosome[:-1]))
+            if len(backwards) > 0:
+                k = backwards[0]
+                raise ValueError('%s is not sorted: %s %d after %d' % (input_file, chromosome_names[peaks.chromosome[k]], peaks.start[k + 1], peaks.start[k]))
+            for code in peaks.chromosome[numpy.r_[0, changes]].tolist():
+                if code != current:
+                    if code in finished:
+                        raise ValueError('%s is not sorted: chromosome %s is not contiguous' % (input_file, chromosome_names[code]))
+                    finished.add(current)
+                    current = code
             ############################################################
-            ### sorting based on GROSeqRecord structure. 
+            # Count all but the last (chromosome, peak start)
             ############################################################
-            print >> sys.stderr, "\nSorting", output_line_count, "records for printing"             
-            records = [ GROSeqRecord.read_record(x) for x in res_dict.iterkeys() ]
-            for record in sorted(records):                
-                key = str(record)
-                curr_oline = curr_oline + 1 
-                ############################################################
-                # Progress counter - can be safely removed
-                ############################################################
-                if curr_oline % PROGRESS_DELAY == 0: 
-                    progress = curr_oline * 1.0 / output_line_count
-                    update_progress(progress, ('Writing ' + output_file))  
-                ############################################################
-                # Writing output line 
-                ############################################################    
-                oline = str(key) + SEPARATOR + str(res_dict[key][0])
-                if unreliable_strands_flag is False:
-                    oline = oline + SEPARATOR  + res_dict[key][1]
-                print >> ofid , oline
+            tail = (peaks.chromosome == peaks.chromosome[-1]) & (peaks.start == peaks.start[-1])
+            carry = peaks.take(tail)
+            if not tail.all():
+                write_block(chromosome_names, peaks.take(~tail))
+        if carry is not None and len(carry) > 0:
+            write_block(chromosome_names, carry)
+        if state['fid'] is not None:
+            writer.close_file(state['fid'])
+        writer.close()
+        copy_counts([chromosome_files[chr] for chr in sorted(chromosome_files, key=chromosome_sort_key)], output_file)
+        report_conflicts(state['conflicts'])
+    finally:
+        writer.close(check=False)
+        shutil.rmtree(work_dir)
+
+
+class TestCountPeaks(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='count_peaks_')
+        random = numpy.random.RandomState(0)
+        ## sorted by chromosome (lexicographic) and peak start; each site is
+        ## repeated with strands drawn from '+', '-', '.' and none
+        lines = []
+        expected = dict()
+        for chr in ['chr1', 'chr10', 'chr2']:
+            starts = numpy.sort(random.randint(0, 200, 40)).tolist()
+            for start in starts:
+                for end in sorted(set(start + random.randint(1, 4, 2))):
+                    strands = [['+', '-', '.', None][k] for k in random.randint(0, 4, random.randint(1, 5))]
+                    if random.rand() < 0.5:
+                        strands = [strands[0]] * len(strands)
+                    bits = 0
+                    for strand in strands:
+                        lines.append('%s\t%d\t%d\tn\t0%s\n' % (chr, start, end, '' if strand is None else '\t' + strand))
+                        bits |= SYMBOL_MASKS.get(strand, PLUS_BIT | MINUS_BIT)
+                    (count, previous) = expected.get((chr, start, end), (0, 0))
+                    expected[(chr, start, end)] = (count + len(strands), previous | bits)
+        self.input_file = os.path.join(self.work_dir, 'peaks.groseq')
+        with open(self.input_file, 'w') as fid:
+            fid.writelines(lines)
+        self.num_lines = len(lines)
+        self.expected = ''.join('%s\t%d\t%d\t%d\t%s\n' % (site + (count, MASK_SYMBOLS[bits]))
+                                for (site, (count, bits)) in sorted(expected.items(), key=lambda x: site_sort_key(x[0])))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def count(self, name, **options):
+        output_file = os.path.join(self.work_dir, name)
+        count_peaks(self.input_file, output_file, tmp_dir=self.work_dir, **options)
+        with open(output_file) as fid:
+            return fid.read()
+
+    def test_modes_agree(self):
+        in_memory = self.count('in_memory')
+        self.assertEqual(in_memory, self.expected)
+        self.assertTrue('\t.\n' in in_memory and '\t+\n' in in_memory and '\t-\n' in in_memory)
+        ## 40-byte blocks hold one or two lines, so sites span blocks
+        ## (and chunks of 3 or 7 lines)
+        for block_size in [40, 1 << 20]:
+            self.assertEqual(self.count('in_memory_%d' % block_size, block_size=block_size), self.expected)
+            for chunk_size in [1, 3, 7]:
+                self.assertEqual(self.count('chunked_%d_%d' % (block_size, chunk_size), chunk_size=chunk_size, block_size=block_size), self.expected)
+            self.assertEqual(self.count('sorted_%d' % block_size, sorted_input=True, block_size=block_size), self.expected)
+
+    def test_strand_conflicts(self):
+        with open(self.input_file, 'w') as fid:
+            fid.write('chr1\t5\t6\tn\t0\t+\n'
+                      'chr1\t5\t6\tn\t0\t+\n'
+                      'chr1\t7\t8\tn\t0\t+\n'
+                      'chr1\t7\t8\tn\t0\t-\n'
+                      'chr1\t9\t10\tn\t0\n'
+                      'chr1\t9\t10\tn\t0\t-\n'
+                      'chr1\t11\t12\tn\t0\t.\n')
+        expected = ('chr1\t5\t6\t2\t+\n'
+                    'chr1\t7\t8\t2\t.\n'
+                    'chr1\t9\t10\t2\t.\n'
+                    'chr1\t11\t12\t1\t.\n')
+        self.assertEqual(self.count('in_memory'), expected)
+        self.assertEqual(self.count('chunked', chunk_size=1, block_size=20), expected)
+        self.assertEqual(self.count('sorted', sorted_input=True, block_size=20), expected)
 
 
 if __name__=='__main__':
-    if len(sys.argv) < 2: 
-        sys.exit('Usage: count_peaks.py INPUT_FILE OUTPUT_FILE')
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]     
-    count_peaks(input_file, output_file) 
-     
-
-        
+    parser = argparse.ArgumentParser(description='This file counts the number of peaks in GRO-seq .bed file.')
+    parser.add_argument('input_file', metavar='INPUT_FILE', type=str, help='GROSeq .bed file')
+    parser.add_argument('output_file', metavar='OUTPUT_FILE', type=str, help='Output file with the number of times each peak occurs')
+    parser.add_argument('--chunk_size', metavar='N', type=int, default=None, help='Count at most N peak lines in memory at a time, merging sorted partial counts from temporary files (default: count in memory)')
+    parser.add_argument('--sorted', action='store_true', help='Input is sorted by chromosome and peak start: count runs of identical peaks while streaming')
+    parser.add_argument('--tmp_dir', metavar='DIR', type=str, default=None, help='Directory for temporary files (default: system temporary directory)')
+    args = parser.parse_args(sys.argv[1:])
+    count_peaks(args.input_file, args.output_file, args.chunk_size, args.sorted, args.tmp_dir) 
@@ -15,12 +15,18 @@
 # 
 
 # Code:
-import sys,logging,argparse
-from GROSeqRecord import GROSeqRecord
-from update_progress import update_progress
-from extract_common import read_file_to_map
+import sys,os,logging,argparse,itertools
+import shutil
+import tempfile
+import unittest
+import numpy
+from update_progress import ProgressReporter
+from bed_loader import load_table, load_overlapping, parse_block, STRAND_PLUS, STRAND_MINUS
 from logger import logger,set_verbosity  
-from IntervalTree import Interval, IntervalTree
+from IntervalIndex import count_enclosed, count_enclosed_indexed
+import parallel
+import genome_windows
+from pipeline import BatchWriter
 
 
 ############################################################
@@ -36,87 +42,267 @@ SKIP_ZERO_COUNTS = True
 ## How much logging do you want? 0 = minimal, 2 = verbose
 VERBOSITY = 1 
 
+## Counting strategy: 'index_regions', 'sort_peaks' or 'auto' (cheaper of the two, see plan_strategy)
+STRATEGY = 'auto'
+STRATEGIES = ('auto', 'index_regions', 'sort_peaks')
+
+## Output lines per batch (formatted in one string and queued to the writer thread)
+WRITE_BATCH_SIZE = 1 << 18
+
+## Cost of a search in the region index relative to a binary search step
+## in sorted peaks (candidate expansion and filtering, measured on random inputs)
+INDEX_SEARCH_COST = 1.5
+
+
 ############################################################
-# Increase recursion level
+# Choice of the counting strategy
 ############################################################
-MAX_RECURSION_LEVEL = 20000
-sys.setrecursionlimit(MAX_RECURSION_LEVEL) 
+def strategy_costs(num_regions, num_peaks):
+    '''
+    Estimated costs (comparisons) of counting num_peaks peaks in num_regions regions
+
+    index_regions: sort the regions into an IntervalIndex, one search per peak
+    sort_peaks:    sort the peaks, two binary searches per region (count_enclosed)
+
+    @return dict strategy -> cost
+    '''
+    log_regions = numpy.log2(num_regions + 2)
+    log_peaks = numpy.log2(num_peaks + 2)
+    return {'index_regions': INDEX_SEARCH_COST * (num_regions + num_peaks) * log_regions,
+            'sort_peaks': (num_regions + num_peaks) * log_peaks}
 
+def plan_strategy(num_regions, num_peaks, strategy=STRATEGY):
+    ''' Strategy to use: the given one, or the cheaper one for 'auto' '''
+    if strategy != 'auto':
+        return strategy
+    costs = strategy_costs(num_regions, num_peaks)
+    return min(sorted(costs), key=costs.get)
 
 
 ############################################################
 # Count peaks in strand_specific manner
 ############################################################
-def count_peaks_in_regions(chromosome_region_map, groseq_peaks):
-    ''' Count peaks falling in different chromosome regions '''
-    logger.info('Reading groseq data')
-    max_iter = len(groseq_peaks)
-    curr_iter = 0
-    result = dict()
-    chr_interval_trees = dict()
-    ############################################################
-    ## Initialize result
-    ############################################################
-    for chr in chromosome_region_map.keys():
-        num_regions = len(chromosome_region_map[chr])
-        result[chr] = ([0]*num_regions, [0]*num_regions)
-        ############################################################
-        ## Improved timing using interval trees.
-        ############################################################
-        interval_list = []
-        idx = 0        
-        logger.info('chromosome ' + chr + ' has regions: ' + str(num_regions))
-        for region in chromosome_region_map[chr]:
-            update_progress(idx, 'Reading regions' , num_regions, 1000)
-            r_start = region[0][0]
-            r_end = region[0][1]
-            interval_list = interval_list + [ Interval(r_start, r_end, idx) ]
-            idx = idx + 1
-        logger.info('Creating IntervalTree for chromosome' + chr) 
-        chr_interval_trees[chr] = IntervalTree.init_from_list(interval_list)
-        
+def count_peaks_in_chromosome(chr):
+    '''
+    Counts the peaks of one chromosome - runs in the worker processes
+
+    The tables, row groups and strategy are read from parallel.shared()
+    (see count_peaks_in_regions).
+
+    @return (plus counts, minus counts) for the regions of chr
+    '''
+    regions = parallel.shared('regions')
+    peaks = parallel.shared('peaks')
+    region_rows = parallel.shared('region_rows')[chr]
+    peak_rows = parallel.shared('peak_rows').get(chr)
+    num_regions = len(region_rows)
+    num_peaks = 0 if peak_rows is None else len(peak_rows)
+    strategy = plan_strategy(num_regions, num_peaks, parallel.shared('strategy'))
+    logger.info('chromosome ' + chr + ' has regions: ' + str(num_regions) + ', peaks: ' + str(num_peaks) + ', strategy: ' + strategy)
+    count = count_enclosed_indexed if strategy == 'index_regions' else count_enclosed
+    region_starts = regions.start[region_rows]
+    region_ends = regions.end[region_rows]
+    curr_plus = numpy.zeros(num_regions, dtype=numpy.int64)
+    curr_minus = numpy.zeros(num_regions, dtype=numpy.int64)
+    if peak_rows is not None:
+        peak_starts = peaks.start[peak_rows]
+        peak_ends = peaks.end[peak_rows]
+        peak_strands = peaks.strand[peak_rows]
+        plus = (peak_strands == STRAND_PLUS)
+        minus = (peak_strands == STRAND_MINUS)
+        curr_plus = count(region_starts, region_ends, peak_starts[plus], peak_ends[plus])
+        curr_minus = count(region_starts, region_ends, peak_starts[minus], peak_ends[minus])
+    return (curr_plus, curr_minus)
+
+def count_peaks_in_regions(regions, peaks, jobs=1, strategy=STRATEGY):
+    '''
+    Count peaks falling in different chromosome regions
+
+    @arg regions: IntervalTable of chromosome regions
+    @arg peaks:   IntervalTable of groseq peaks
+    @arg jobs:    number of worker processes, chromosomes are processed largest first
+    @arg strategy: one of STRATEGIES, chosen per chromosome for 'auto' (see plan_strategy)
+    @return dict chromosome -> (plus counts, minus counts), indexed like the rows
+            of that chromosome in regions.chromosome_groups()
+    '''
+    logger.info('Counting %d groseq peaks in %d regions (%s: %s)' % (len(peaks), len(regions), strategy, plan_strategy(len(regions), len(peaks), strategy)))
+    region_rows = dict(regions.chromosome_groups())
+    peak_rows = dict(peaks.chromosome_groups())
     ############################################################
-    ## Processing GROSeq begins here
+    ## Enclosed peak counts: region index or sorted peaks
     ############################################################
-    for peak in groseq_peaks:
-        peak = peak.strip()
-        ############################################################
-        ## progress line below - can be removed.
-        ############################################################
-        curr_iter = curr_iter + 1
-        update_progress(curr_iter, ('Reading GROSeq peaks file'), max_iter)
-
-        curr_record = GROSeqRecord.read_record(peak)
-        curr_chromosome  = curr_record.chromosome
-        if curr_chromosome in chromosome_region_map:
-            regions_on_curr_chromosome = chromosome_region_map[curr_chromosome]
-            peak_interval = Interval(curr_record.peak_start, curr_record.peak_end )
-            enclosing_intervals = chr_interval_trees[curr_chromosome].enclosing_interval_search(peak_interval)
-            ############################################################
-            ## update the counts
-            ############################################################
-            curr_count = result[curr_chromosome]
-            curr_plus= curr_count[0]
-            curr_minus = curr_count[1]
-            for interval in enclosing_intervals:
-                logger.debug('peak: ' + str(peak_interval) + ' on ' + curr_chromosome + ' ' + str(interval) + ' strand: ' +  curr_record.strand)
-                idx = interval.id
-                if curr_record.strand is '+':
-                    curr_plus[idx] = curr_plus[idx] + 1
-                elif curr_record.strand is '-':
-                    curr_minus[idx] = curr_minus[idx] + 1
-            result[curr_chromosome] = (curr_plus, curr_minus)
-    return result
+    chromosomes = sorted(region_rows)
+    weights = [len(region_rows[chr]) + len(peak_rows.get(chr, ())) for chr in chromosomes]
+    parallel.share(regions=regions, peaks=peaks, region_rows=region_rows, peak_rows=peak_rows, strategy=strategy)
+    try:
+        counts = parallel.map_tasks(count_peaks_in_chromosome, chromosomes, jobs, weights)
+    finally:
+        parallel.clear('regions', 'peaks', 'region_rows', 'peak_rows', 'strategy')
+    return dict(zip(chromosomes, counts))
+
+############################################################
+# Region x sample count matrix
+############################################################
+def count_sample(groseq_peak_file):
+    '''
+    Counts the peaks of one sample in all regions - runs in the worker processes
+
+    The regions, cache options and strategy are read from parallel.shared() (see
+    count_matrix). The peaks are loaded in the worker and dropped once counted.
+
+    @return regions x 2 array of (plus, minus) counts, rows in
+            regions.chromosome_groups() order
+    '''
+    regions = parallel.shared('matrix_regions')
+    (cache, rebuild_cache, strategy) = parallel.shared('matrix_options')
+    peaks = load_overlapping(groseq_peak_file, regions, cache, rebuild_cache)
+    result = count_peaks_in_regions(regions, peaks, strategy=strategy)
+    counts = numpy.zeros((len(regions), 2), dtype=numpy.int64)
+    offset = 0
+    for (chr, rows) in regions.chromosome_groups():
+        counts[offset:offset + len(rows), 0] = result[chr][0]
+        counts[offset:offset + len(rows), 1] = result[chr][1]
+        offset += len(rows)
+    return counts
+
+def count_matrix(regions, groseq_peak_files, cache=False, rebuild_cache=False, jobs=1, strategy=STRATEGY):
+    '''
+    Counts the peaks of several samples in the same regions
+
+    The regions are read once and inherited by the workers, each sample is
+    one task (largest file first).
+
+    @arg regions: IntervalTable of chromosome regions
+    @arg groseq_peak_files: list of GROSEQ files, one per sample
+    @arg jobs: number of worker processes
+    @arg strategy: counting strategy (see count_peaks_in_regions)
+    @return regions x samples x 2 (plus, minus) int64 array, rows in
+            regions.chromosome_groups() order
+    '''
+    weights = [os.path.getsize(file_name) for file_name in groseq_peak_files]
+    parallel.share(matrix_regions=regions, matrix_options=(cache, rebuild_cache, strategy))
+    try:
+        counts = parallel.map_tasks(count_sample, groseq_peak_files, jobs, weights)
+    finally:
+        parallel.clear('matrix_regions', 'matrix_options')
+    matrix = numpy.zeros((len(regions), len(groseq_peak_files), 2), dtype=numpy.int64)
+    for (k, sample_counts) in enumerate(counts):
+        matrix[:, k, :] = sample_counts
+    return matrix
+
+def sample_names(groseq_peak_files):
+    ''' Column names of the samples (file names without directory) '''
+    return [os.path.basename(file_name) for file_name in groseq_peak_files]
+
+def write_matrix(output_file, regions, matrix, names, strand_specific=STRAND_SPECIFIC, separator='\t'):
+    '''
+    Writes the count matrix as output_file.tsv and output_file.npy
+
+    The TSV file has a header line and one CHROMOSOME REGION_START REGION_END
+    line per region followed by the NAME+ and NAME- counts of each sample (one
+    NAME column per sample if strand_specific is False). The .npy file holds
+    the regions x samples x 2 matrix as int32, rows in the order of the TSV file.
+    '''
+    if strand_specific is True:
+        header = [name + strand for name in names for strand in '+-']
+        columns = matrix.reshape((len(matrix), -1))
+    else:
+        header = names
+        columns = matrix.sum(axis=2)
+    with ProgressReporter('Writing ' + output_file + '.tsv', total=len(regions)) as progress, open(output_file + '.tsv', 'w') as fid, BatchWriter() as writer:
+        print >> fid, separator.join(['chromosome', 'start', 'end'] + header)
+        offset = 0
+        for (chr, rows) in regions.chromosome_groups():
+            for first in xrange(0, len(rows), WRITE_BATCH_SIZE):
+                batch = rows[first:first + WRITE_BATCH_SIZE]
+                writer.write(fid, format_matrix_rows(chr, regions.start[batch], regions.end[batch], columns[offset + first:offset + first + len(batch)], separator))
+            offset += len(rows)
+            progress.update(len(rows))
+    numpy.save(output_file + '.npy', matrix.astype(numpy.int32))
+    logger.info('Wrote %d regions x %d samples to %s.tsv and %s.npy' % (len(regions), len(names), output_file, output_file))
+
+def format_matrix_rows(chr, starts, ends, columns, separator='\t'):
+    ''' CHROMOSOME REGION_START REGION_END COUNT... lines of the matrix rows of one chromosome '''
+    return ''.join(separator.join([chr, str(region_start), str(region_end)] + [str(x) for x in row]) + '\n'
+                   for (region_start, region_end, row) in itertools.izip(starts.tolist(), ends.tolist(), columns.tolist()))
+
+############################################################
+# Writing counts
+############################################################
+def format_region_counts(chr, starts, ends, counts, separator='\t'):
+    ''' CHROMOSOME REGION_START REGION_END COUNT lines '''
+    return ''.join(separator.join([chr, str(region_start), str(region_end), str(num_peaks)]) + '\n'
+                   for (region_start, region_end, num_peaks) in itertools.izip(starts.tolist(), ends.tolist(), counts.tolist()))
+
+def write_region_counts(writer, fid, chr, counts, region_bounds, skip_zero_counts=SKIP_ZERO_COUNTS, separator='\t'):
+    '''
+    Queues the CHROMOSOME REGION_START REGION_END COUNT lines of one chromosome to a BatchWriter
+
+    @arg counts: array of counts per region
+    @arg region_bounds: function mapping an array of region indices to (starts, ends)
+    @arg skip_zero_counts: only write regions with non-zero counts
+    @return number of lines written
+    '''
+    if skip_zero_counts:
+        rows = numpy.flatnonzero(counts)
+    else:
+        rows = numpy.arange(len(counts))
+    for first in xrange(0, len(rows), WRITE_BATCH_SIZE):
+        batch = rows[first:first + WRITE_BATCH_SIZE]
+        (starts, ends) = region_bounds(batch)
+        writer.write(fid, format_region_counts(chr, starts, ends, counts[batch], separator))
+    return len(rows)
+
+def write_counts(output_file, groups, result, strand_specific=STRAND_SPECIFIC, skip_zero_counts=SKIP_ZERO_COUNTS, separator='\t'):
+    '''
+    Writes the counts of all chromosomes
+
+    @arg output_file: output file (output_file+ and output_file- if strand_specific is True)
+    @arg groups: list of (chromosome, number of regions, region_bounds) in output order
+    @arg result: dict chromosome -> (plus counts, minus counts)
+    '''
+    with ProgressReporter('Writing ' + output_file, total=sum(n for (chr, n, region_bounds) in groups)) as progress, BatchWriter() as writer:
+        if strand_specific is True:
+            plus_fid = open((output_file + '+'), 'w')
+            minus_fid = open((output_file + '-'), 'w')
+            for (chr, n, region_bounds) in groups:
+                logger.info('Writing strand specific output for ' + chr + ' having ' + str(n) + ' regions')
+                r_count_p = write_region_counts(writer, plus_fid, chr, result[chr][0], region_bounds, skip_zero_counts, separator)
+                r_count_n = write_region_counts(writer, minus_fid, chr, result[chr][1], region_bounds, skip_zero_counts, separator)
+                logger.info('Wrote ' + str(r_count_p) + ' of '+ str(n) + ' regions for ' + chr + ' with non-zero peaks on strand: + ' )
+                logger.info('Wrote ' + str(r_count_n) + ' of '+ str(n) + ' regions for ' + chr + ' with non-zero peaks on strand: - ' )
+                progress.update(n)
+            writer.close_file(plus_fid)
+            writer.close_file(minus_fid)
+        else:
+            o_fid = open(output_file, 'w')
+            for (chr, n, region_bounds) in groups:
+                regions_written = write_region_counts(writer, o_fid, chr, result[chr][0] + result[chr][1], region_bounds, skip_zero_counts, separator)
+                logger.info('Finished writing ' + str(regions_written) + ' of '+ str(n) + ' regions for chromosome ' + chr)
+                progress.update(n)
+            writer.close_file(o_fid)
+
+def table_region_bounds(regions, rows):
+    ''' region_bounds function for the regions of a table at the given rows '''
+    return lambda idx: (regions.start[rows][idx], regions.end[rows][idx])
+
 
 ############################################################
 # This function does all the lifting
 ############################################################
-def main(chromosome_region_file, groseq_peak_file, output_file, strand_specific=STRAND_SPECIFIC, skip_zero_counts=SKIP_ZERO_COUNTS, separator='\t'): 
+def main(chromosome_region_file, groseq_peak_file, output_file, strand_specific=STRAND_SPECIFIC, skip_zero_counts=SKIP_ZERO_COUNTS, separator='\t', cache=False, rebuild_cache=False, jobs=1, window_size=None, strategy=STRATEGY): 
     ''' Main function that operates on the files 
 
     @arg chromosome_region_file BED file containing list of chromosome regions 
-    @arg groseq_peak_file       GROSEQ file containing groseq peaks
+                                (chromosome sizes file if window_size is given)
+    @arg groseq_peak_file       GROSEQ file containing groseq peaks (plain, gzip or BGZF;
+                                only the blocks near the regions are read from sorted BGZF files)
     @arg output_file            output file (output_file+ and output_file- if strand_specific is True)
+    @arg cache                  read the input files through their binary caches (see bed_loader.load_table)
+    @arg rebuild_cache          rewrite the binary caches
+    @arg jobs                   number of worker processes
+    @arg window_size            count peaks in fixed-size windows of this size (see genome_windows.py)
+    @arg strategy               counting strategy, one of STRATEGIES (see plan_strategy)
     
     '''
     logger.info('bed_file: ' + chromosome_region_file)
@@ -124,61 +310,116 @@ def main(chromosome_region_file, groseq_peak_file, output_file, strand_specific=
     logger.info('output_file: ' + output_file) 
     logger.info('strand_specific: ' + str(strand_specific) ) 
     logger.info('skip_zero_counts: ' +  str(skip_zero_counts) )
-    with open(chromosome_region_file , 'r') as chr_fid:
-        ############################################################
-        ## Construct the chromosome chr -> [(region_start, region_end)*]
-        ############################################################
+    ############################################################
+    ## Read chromosome regions and groseq peaks
+    ############################################################
+    if window_size is not None:
+        logger.info('Reading chromosome sizes file') 
+        chromosome_sizes = genome_windows.read_chromosome_sizes(chromosome_region_file)
+        peaks = load_table(groseq_peak_file, cache, rebuild_cache)
+        result = genome_windows.count_peaks_in_windows(peaks, chromosome_sizes, window_size)
+        bounds = lambda idx: genome_windows.window_bounds(idx, window_size)
+        groups = [(chr, genome_windows.num_windows(size, window_size), bounds) for (chr, size) in chromosome_sizes]
+    else:
         logger.info('Reading chromosome region file') 
-        chromosome_region_map = read_file_to_map(chr_fid, separator)
-        with open(groseq_peak_file, 'r') as groseq_fid:
-            ## Read next peak from groseq file
-            groseq_lines = groseq_fid.readlines()
-            result = count_peaks_in_regions(chromosome_region_map, groseq_lines)                
-
-            if strand_specific is True:
-                plus_fid = open((output_file + '+'), 'w')
-                minus_fid = open((output_file + '-'), 'w')
-                for chr in chromosome_region_map.keys():
-                    curr_regions = chromosome_region_map[chr]
-                    curr_num_peaks = result[chr]
-                    n = len(curr_regions)
-                    r_count_p = 0
-                    r_count_n = 0                         
-                    logger.info('Writing strand specific output for ' + chr + ' having ' + str(n) + ' regions')
-                    for j in range(n):    
-                        update_progress(j, 'Writing output for chromosome ' + chr, n)
-                        region_start = curr_regions[j][0][0]
-                        region_end = curr_regions[j][0][1]
-                        num_peaks_plus = curr_num_peaks[0][j]
-                        num_peaks_minus = curr_num_peaks[1][j]
-
-                        if (not skip_zero_counts) or (num_peaks_plus > 0):
-                            r_count_p = r_count_p + 1 
-                            print >> plus_fid, separator.join([chr, str(region_start), str(region_end), str(num_peaks_plus)])
-                        if (not skip_zero_counts) or (num_peaks_minus > 0):
-                            r_count_n = r_count_n + 1 
-                            print >> minus_fid, separator.join([chr, str(region_start), str(region_end), str(num_peaks_minus)])
-                    logger.info('Wrote ' + str(r_count_p) + ' of '+ str(n) + ' regions for ' + chr + ' with non-zero peaks on strand: + ' )
-                    logger.info('Wrote ' + str(r_count_n) + ' of '+ str(n) + ' regions for ' + chr + ' with non-zero peaks on strand: - ' )
-                plus_fid.close()
-                minus_fid.close()
-            else:
-                with open(output_file, 'w') as o_fid:
-                    for chr in chromosome_region_map.keys():
-                        curr_regions = chromosome_region_map[chr]
-                        n = len(curr_regions)
-                        regions_written = 0 
-                        for j in range(n):
-                            update_progress(j, 'Writing output for chromosome ' + chr, n)
-                            region_start = curr_regions[j][0][0]
-                            region_end = curr_regions[j][0][1]
-                            num_peaks = result[chr][0][j] + result[chr][1][j]
-                            if (not skip_zero_counts) or (num_peaks > 0): 
-                                regions_written = regions_written + 1
-                                print >>o_fid, separator.join([chr, str(region_start), str(region_end), str(num_peaks)])
-                        logger.info('Finished writing ' + str(regions_written) + ' of '+ str(n) + ' regions for chromosome ' + chr)
+        regions = load_table(chromosome_region_file, cache, rebuild_cache)
+        peaks = load_overlapping(groseq_peak_file, regions, cache, rebuild_cache)
+        result = count_peaks_in_regions(regions, peaks, jobs, strategy)
+        groups = [(chr, len(rows), table_region_bounds(regions, rows)) for (chr, rows) in regions.chromosome_groups()]
+    write_counts(output_file, groups, result, strand_specific, skip_zero_counts, separator)
+
+def main_matrix(chromosome_region_file, groseq_peak_files, output_file, strand_specific=STRAND_SPECIFIC, separator='\t', cache=False, rebuild_cache=False, jobs=1, strategy=STRATEGY):
+    ''' Writes the region x sample count matrix of several GROSEQ files (see write_matrix) '''
+    logger.info('bed_file: ' + chromosome_region_file)
+    logger.info('groseq_peak_files: ' + ' '.join(groseq_peak_files))
+    logger.info('output_file: ' + output_file)
+    regions = load_table(chromosome_region_file, cache, rebuild_cache)
+    matrix = count_matrix(regions, groseq_peak_files, cache, rebuild_cache, jobs, strategy)
+    write_matrix(output_file, regions, matrix, sample_names(groseq_peak_files), strand_specific, separator)
                         
 
+class TestCountPeaksInRegion(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        ## nested regions and regions sharing end points on chr1, random ones
+        ## on chr2, regions without peaks on chr3 and peaks without regions on chr4
+        regions = [('chr1', 0, 100), ('chr1', 10, 50), ('chr1', 10, 20), ('chr1', 20, 50), ('chr1', 50, 100), ('chr1', 50, 100)]
+        for chr in ['chr1', 'chr2']:
+            starts = random.randint(0, 1000, 60)
+            regions.extend((chr, start, start + length) for (start, length) in zip(starts.tolist(), random.randint(0, 300, 60).tolist()))
+        regions.append(('chr3', 0, 1000))
+        peaks = [('chr1', 10, 20, '+'), ('chr1', 20, 50, '-'), ('chr1', 50, 50, '+'), ('chr1', 0, 100, '.')]
+        for chr in ['chr1', 'chr2', 'chr4']:
+            starts = random.randint(0, 1200, 400)
+            peaks.extend((chr, start, start + length, '+-.'[k]) for (start, length, k) in
+                         zip(starts.tolist(), random.randint(0, 40, 400).tolist(), random.randint(0, 3, 400).tolist()))
+        self.regions = parse_block(''.join('%s\t%d\t%d\n' % region for region in regions))
+        self.peak_lines = ['%s\t%d\t%d\tp\t0\t%s\n' % peak for peak in peaks]
+        self.peaks = parse_block(''.join(self.peak_lines))
+        self.expected = dict()
+        for (chr, rows) in self.regions.chromosome_groups():
+            counts = [[sum(1 for (c, ps, pe, s) in peaks if c == chr and s == strand and ps >= rs and pe <= re)
+                       for (rs, re) in zip(self.regions.start[rows].tolist(), self.regions.end[rows].tolist())] for strand in '+-']
+            self.expected[chr] = counts
+
+    def test_strategies_agree(self):
+        for strategy in STRATEGIES:
+            for jobs in [1, 2]:
+                result = count_peaks_in_regions(self.regions, self.peaks, jobs, strategy)
+                self.assertEqual(sorted(result), ['chr1', 'chr2', 'chr3'])
+                for chr in result:
+                    self.assertEqual([result[chr][0].tolist(), result[chr][1].tolist()], self.expected[chr])
+
+    def test_count_matrix(self):
+        work_dir = tempfile.mkdtemp(prefix='count_peaks_in_region_')
+        try:
+            ## the full sample, every third peak, and the chr2 peaks only
+            samples = [self.peak_lines, self.peak_lines[::3], [line for line in self.peak_lines if line.startswith('chr2\t')]]
+            file_names = []
+            for (k, lines) in enumerate(samples):
+                file_names.append(os.path.join(work_dir, 'sample%d.groseq' % k))
+                with open(file_names[-1], 'w') as fid:
+                    fid.writelines(lines)
+            matrix = count_matrix(self.regions, file_names, jobs=2)
+            self.assertEqual(matrix.shape, (len(self.regions), 3, 2))
+            self.assertTrue((count_matrix(self.regions, file_names, strategy='index_regions') == matrix).all())
+            for (k, lines) in enumerate(samples):
+                result = count_peaks_in_regions(self.regions, parse_block(''.join(lines)))
+                column = numpy.concatenate([numpy.c_[result[chr][0], result[chr][1]] for (chr, rows) in self.regions.chromosome_groups()])
+                self.assertEqual(matrix[:, k, :].tolist(), column.tolist())
+            ## TSV rows and the .npy matrix: CHROMOSOME START END NAME+ NAME- per sample
+            output_file = os.path.join(work_dir, 'matrix')
+            names = sample_names(file_names)
+            write_matrix(output_file, self.regions, matrix, names)
+            saved = numpy.load(output_file + '.npy')
+            self.assertEqual(saved.dtype, numpy.int32)
+            self.assertEqual(saved.tolist(), matrix.tolist())
+            with open(output_file + '.tsv') as fid:
+                rows = [line.rstrip('\n').split('\t') for line in fid]
+            self.assertEqual(rows[0], ['chromosome', 'start', 'end', 'sample0.groseq+', 'sample0.groseq-', 'sample1.groseq+',
+                                       'sample1.groseq-', 'sample2.groseq+', 'sample2.groseq-'])
+            bounds = [(chr, start, end) for (chr, group) in self.regions.chromosome_groups()
+                      for (start, end) in zip(self.regions.start[group].tolist(), self.regions.end[group].tolist())]
+            self.assertEqual([(row[0], int(row[1]), int(row[2])) for row in rows[1:]], bounds)
+            self.assertEqual([[int(x) for x in row[3:]] for row in rows[1:]], saved.reshape((len(saved), -1)).tolist())
+            write_matrix(output_file, self.regions, matrix, names, strand_specific=False)
+            with open(output_file + '.tsv') as fid:
+                rows = [line.rstrip('\n').split('\t') for line in fid]
+            self.assertEqual(rows[0][3:], names)
+            self.assertEqual([[int(x) for x in row[3:]] for row in rows[1:]], matrix.sum(axis=2).tolist())
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_plan_strategy(self):
+        ## one search per peak in a small region index beats sorting many peaks
+        self.assertEqual(plan_strategy(100, 10 ** 7), 'index_regions')
+        ## two binary searches per region in a few sorted peaks beat indexing many regions
+        self.assertEqual(plan_strategy(10 ** 7, 100), 'sort_peaks')
+        self.assertEqual(plan_strategy(10 ** 5, 10 ** 5), 'sort_peaks')
+        self.assertEqual(plan_strategy(100, 10 ** 7, 'sort_peaks'), 'sort_peaks')
+        self.assertEqual(plan_strategy(10 ** 7, 100, 'index_regions'), 'index_regions')
+
+
 ############################################################
 # TODO: Argument parser
 ############################################################
@@ -198,10 +439,16 @@ if __name__=='__main__':
     
     parser = argparse.ArgumentParser(description='This script counts the peaks occuring in a certain region on the chromosome.')
     parser.add_argument('bed_file', metavar='CTCF_BED_FILE', type=str, help='CTCF file containing chromosome regions')
-    parser.add_argument('groseq_file', metavar='GROSEQ_PEAK_FILE', type=str, help='GROSEQ file containing peak information') 
+    parser.add_argument('groseq_file', metavar='GROSEQ_PEAK_FILE', type=str, nargs='+', help='GROSEQ file containing peak information; several files write a region x sample matrix (OUTPUT_FILE.tsv and OUTPUT_FILE.npy)') 
     parser.add_argument('output_file', metavar='OUTPUT_FILE', type=str, help='In strand specific mode, the program writes OUTPUT_FILE+ and OUTPUT_FILE- (for + and - strand resp.) else (if merge_strands option is given) generates single OUTPUT_FILE with counts for the two strands added together')  
     parser.add_argument('--keep_zero_counts',  action='store_true', help='Print regions with zero peaks')
     parser.add_argument('--merge_strands' ,  action='store_true', help='Merge counts from the two strands (+ and -)') 
+    parser.add_argument('--no_cache', action='store_true', help='Do not read or write the binary caches (FILE.npcache) and BGZF indices (FILE.bgzidx) of the input files')
+    parser.add_argument('--rebuild_cache', action='store_true', help='Rebuild the binary caches and BGZF indices of the input files')
+    parser.add_argument('--window_size', metavar='W', type=int, default=None, help='Count peaks in fixed windows of W bases; CTCF_BED_FILE is then a chromosome sizes file (CHROMOSOME SIZE per line)')
+    parser.add_argument('--matrix', action='store_true', help='Write the region x sample matrix even for a single GROSEQ file')
+    parser.add_argument('--jobs', metavar='N', type=int, default=1, help='Count chromosomes (samples in matrix mode) in N worker processes (default: 1)')
+    parser.add_argument('--strategy', choices=STRATEGIES, default=STRATEGY, help='index_regions: search each peak in an index of the regions; sort_peaks: sort the peaks, binary search per region; auto: cheaper one per chromosome from the input sizes (default: %s)' % STRATEGY)
     parser.add_argument('-v', '--verbosity', metavar='VERBOSITY', help="Increase verbosity level [0, 1, 2] (default: 1)", type=int, default=VERBOSITY) 
 
     args = parser.parse_args(sys.argv[1:])
@@ -226,7 +473,12 @@ if __name__=='__main__':
     ############################################################
     # calling main function
     ############################################################
-    main(bed_file, groseq_file, output_file, strand_specific, skip_zero_counts)
+    if args.matrix or len(groseq_file) > 1:
+        if args.window_size is not None:
+            parser.error('--window_size is not supported with several GROSEQ files')
+        main_matrix(bed_file, groseq_file, output_file, strand_specific, cache=(not args.no_cache), rebuild_cache=args.rebuild_cache, jobs=args.jobs, strategy=args.strategy)
+    else:
+        main(bed_file, groseq_file[0], output_file, strand_specific, skip_zero_counts, cache=(not args.no_cache), rebuild_cache=args.rebuild_cache, jobs=args.jobs, window_size=args.window_size, strategy=args.strategy)
 
 
 			
@@ -4,13 +4,14 @@
 # Filename: extract_common.py
 # Description: This script extracts the common reads from two files.
 #
-# Usage: extract_common.py [-h] [-c COMMON_FILE] [-p UNIQUE_PREFIX] FILE1 FILE2
+# Usage: extract_common.py [-h] [-c COMMON_FILE] [-p UNIQUE_PREFIX] FILE1 FILE2 [FILE3 ...]
 # 
 # This script extracts the common reads from two files.
 # 
 # positional arguments:
 #   FILE1             First file to read
 #   FILE2             Second file to read
+#   FILE3 ...         More files (N-way mode)
 #  
 # optional arguments:
 #   -h, --help        show this help message and exit
@@ -27,6 +28,11 @@
 #   
 # The regions are tab-separated while within a region, separated by a space.  
 #
+# N-way mode (more than two files, or --nway): the genome is split into
+# segments covered by the same set of files. Segments covered by a set
+# (pattern 101 = FILE1 and FILE3) are written to PATTERN_PREFIX101.bed and
+# summary.txt gives the number of segments and bases of each pattern.
+#
 # Created: Tue Aug 13 09:26:53 2013 (+0200)
 # Version: 2.0 
 # Last-Updated: Mon Oct 28 07:41:15 2013 (+0100)
@@ -47,19 +53,39 @@
 import argparse
 import sys
 import re 
+import os
+import shutil
+import itertools
+import tempfile
+import unittest
 import numpy
 
 from logger import logger 
-from IntervalTree import Interval,IntervalTree
+from bed_loader import load_table, iter_tables, sorted_chromosome_blocks
+from IntervalIndex import IntervalIndex
+from GROSeqRecord import chromosome_sort_key
+import parallel
+from update_progress import ProgressReporter
+from pipeline import read_ahead, batches, BatchWriter, BATCH_RECORDS
 
 # Argument parser
 parser = argparse.ArgumentParser(description='This script extracts the common reads from two files.')
 parser.add_argument('f1', metavar='FILE1', type=str, help='First file to read')
 parser.add_argument('f2', metavar='FILE2', type=str, help='Second file to read') 
+parser.add_argument('files', metavar='FILE3', type=str, nargs='*', help='More files: categorize the genome by the set of files covering it (see --nway)')
 parser.add_argument('-c', metavar='COMMON_PREFIX', type=str, help='Prefix appended to output file for common reads (default: co_)', default='co_')
 parser.add_argument('-p', metavar='UNIQUE_PREFIX', type=str, help='Prefix appended to unique reads in file (default: u_)', default='u_') 
 parser.add_argument('-o', metavar='OVERLAP_FILE', type=str, help='File containing region overlaps (default: overlap.txt)', default='overlap.txt')
 parser.add_argument('-v', metavar='VERBOSITY', help="Increase verbosity level [0, 1, 2] (default: 1)", type=int, default=1) 
+sort_group = parser.add_mutually_exclusive_group()
+sort_group.add_argument('--sorted', action='store_true', help='Inputs are sorted by chromosome and start (lexicographic or natural chromosome order): stream them without the detection pass (default: detected automatically)')
+sort_group.add_argument('--unsorted', action='store_true', help='Skip detection of sorted input and load the files into memory')
+parser.add_argument('--no_cache', action='store_true', help='Do not read or write the binary caches (FILE.npcache) when loading files into memory')
+parser.add_argument('--rebuild_cache', action='store_true', help='Rebuild the binary caches when loading files into memory')
+parser.add_argument('--jobs', metavar='N', type=int, default=1, help='Intersect chromosomes in N worker processes when loading files into memory (default: 1)')
+parser.add_argument('--nway', action='store_true', help='Write the segments covered by each combination of files (default with more than two files)')
+parser.add_argument('--pattern_prefix', metavar='PATTERN_PREFIX', type=str, default='pattern_', help='N-way mode: prefix of the per-pattern segment files (default: pattern_)')
+parser.add_argument('-s', metavar='SUMMARY_FILE', type=str, default='summary.txt', help='N-way mode: summary table of the patterns (default: summary.txt)')
 
 # separators and joiners (file formatting)
 my_separator = '_' 
@@ -76,47 +102,43 @@ def read_file_to_set(fid, separator=my_separator):
         lines.append(line) 
     return set(lines) 
 
-def read_file_to_map(fid, separator=my_separator): 
+def read_file_to_map(fid, separator=my_separator, cache=False, rebuild_cache=False): 
     """ 
     Converts output of read_file_to_set to required dict format 
 
-    string => [ (int, int) ] 
+    string => [ ((int, int), rest_of_line) ] 
+
+    The file is read through its binary cache if cache is True (see bed_loader.load_table).
     """
-    lines = []
+    return table_to_map(load_table(fid.name, cache, rebuild_cache))
+
+def table_to_map(table):
+    """ read_file_to_map() dict of an IntervalTable read by bed_loader """
     result = dict()
-    fid.seek(0) 
-    for line in fid.readlines(): 
-        line = line.strip()
-        parts = re.split('\s' , line )
-        parts = filter(None, parts) 
-        key = parts[0] # chromosome name
-        try: 
-            value = (int(round(float(parts[1]))) , int(round(float(parts[2])))) # (start, end)
-            logger.debug("file: %s key: %s value: %s" % (fid.name, key, str(value)))
-        except:             
-            print >> sys.stderr, "line is: ", line
-            for i in range(len(parts)): 
-                print >> sys.stderr, "parts[%d]: %s" % (i, parts[i])
-            raise
-        addendum = '\t'.join(parts[3:])
-        logger.debug("file: %s key: %s value: %s" % (fid.name, key, str(value)) )
-        logger.debug("addendum: %s" % (addendum) )
-        if key in result: 
-            result[key].append((value, addendum)) 
-        else:
-            result[key] = [(value, addendum)] 
+    ## one rest_of_line() call: compressed files are inflated once
+    rest = table.rest_of_line()
+    for (key, rows) in table.chromosome_groups():
+        result[key] = zip(zip(table.start[rows].tolist(), table.end[rows].tolist()), [rest[i] for i in rows.tolist()])
     for key in result: 
-        logger.info("%s chromosome: %s reads: %d" % (fid.name, key,  len(result[key])) )
+        logger.info("%s chromosome: %s reads: %d" % (table.file_name, key,  len(result[key])) )
     return result
 
 ############################################################
-## Uses IntervalTree O(n log(m) )
+## Uses IntervalIndex O(n log(m) )
 ############################################################
 def find_overlapping_sequences(list1, list2): 
-    m = len(list1) 
-    n = len(list2) 
+    starts1 = numpy.array([x[0][0] for x in list1], dtype=numpy.int64)
+    ends1 = numpy.array([x[0][1] for x in list1], dtype=numpy.int64)
+    starts2 = numpy.array([x[0][0] for x in list2], dtype=numpy.int64)
+    ends2 = numpy.array([x[0][1] for x in list2], dtype=numpy.int64)
+    return find_overlapping_rows(starts1, ends1, starts2, ends2)
+
+def find_overlapping_rows(starts1, ends1, starts2, ends2):
+    """ find_overlapping_sequences() on arrays of start and end points """
+    m = len(starts1) 
+    n = len(starts2) 
     if m < n:
-        (result_swapped, uniq2, uniq1) = find_overlapping_sequences(list2, list1)
+        (result_swapped, uniq2, uniq1) = find_overlapping_rows(starts2, ends2, starts1, ends1)
         result = dict()
         for item in result_swapped.keys():
             i = item[0]
@@ -124,22 +146,336 @@ def find_overlapping_sequences(list1, list2):
             result[(j, i)] = result_swapped[item]
         return (result, uniq1, uniq2)
     else:
-        intervals1 = [ Interval( list1[i][0][0], list1[i][0][1], i) for i in range(m)]
-        intervals2 = [ Interval( list2[i][0][0], list2[i][0][1], i) for i in range(n)]
-        result = dict()
-        unique1 = set(range(m))
-        unique2 = set(range(n)) 
-        interval_tree = IntervalTree.init_from_list(intervals1)
-        for i in range(n):
-            item2 = intervals2[i]
-            overlapping_intervals = interval_tree.overlapping_interval_search(item2)
-            for item1 in overlapping_intervals:
-                curr_overlap = item1.find_overlap(item2)                
-                result[ (item1.id, item2.id) ] = (curr_overlap.left, curr_overlap.right)
-                unique1.discard(item1.id)
-                unique2.discard(item2.id)
+        interval_index = IntervalIndex(starts1, ends1)
+        (idx2, idx1) = interval_index.batch_overlapping_search(starts2, ends2)
+        overlap_start = numpy.maximum(starts1[idx1], starts2[idx2])
+        overlap_end = numpy.minimum(ends1[idx1], ends2[idx2])
+        result = dict(zip(zip(idx1.tolist(), idx2.tolist()), zip(overlap_start.tolist(), overlap_end.tolist())))
+        unique1 = set(range(m)).difference(idx1.tolist())
+        unique2 = set(range(n)).difference(idx2.tolist())
         return (result, unique1, unique2) 
 
+def find_overlapping_chromosome(chr):
+    """ 
+    find_overlapping_rows() for one chromosome - runs in the worker processes
+
+    The tables and row groups are read from parallel.shared() (see main).
+    """
+    table1 = parallel.shared('table1')
+    table2 = parallel.shared('table2')
+    rows1 = parallel.shared('rows1')[chr]
+    rows2 = parallel.shared('rows2')[chr]
+    return find_overlapping_rows(table1.start[rows1], table1.end[rows1], table2.start[rows2], table2.end[rows2])
+
+
+############################################################
+## N-way segmentation O(T log T) for T regions in all files
+############################################################
+''' Largest number of files in N-way mode (patterns are int64 bitmasks) '''
+MAX_NWAY_FILES = 62
+
+def union_intervals(starts, ends):
+    """ Disjoint intervals covering the union of [starts, ends), touching intervals joined """
+    keep = ends > starts
+    order = numpy.argsort(starts[keep], kind='mergesort')
+    starts = starts[keep][order]
+    ends = ends[keep][order]
+    if len(starts) == 0:
+        return (starts, ends)
+    reach = numpy.maximum.accumulate(ends)
+    first = numpy.flatnonzero(numpy.r_[True, starts[1:] > reach[:-1]])
+    return (starts[first], reach[numpy.r_[first[1:] - 1, len(starts) - 1]])
+
+def overlap_segments(intervals):
+    """
+    Splits a chromosome into segments covered by the same set of files.
+
+    Each file's regions are merged into disjoint intervals, so sorting the
+    interval bounds of all files and summing +2^k at the starts and -2^k at
+    the ends of file k gives the bitmask of the files covering each segment.
+
+    Regions are half-open [start, end), as in the two-file overlap test
+    (start1 < end2 and start2 < end1); empty regions (start == end) cover
+    no base and are ignored.
+
+    @arg intervals: list of (starts, ends) arrays, one per file
+    @return (starts, ends, masks) of the segments covered by at least one file
+    """
+    positions = []
+    changes = []
+    for (k, (starts, ends)) in enumerate(intervals):
+        (starts, ends) = union_intervals(numpy.asarray(starts, dtype=numpy.int64), numpy.asarray(ends, dtype=numpy.int64))
+        positions += [starts, ends]
+        changes += [numpy.repeat(numpy.int64(1) << k, len(starts)), numpy.repeat(-(numpy.int64(1) << k), len(ends))]
+    if sum(len(x) for x in positions) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return (empty, empty, empty)
+    positions = numpy.concatenate(positions)
+    order = numpy.argsort(positions, kind='mergesort')
+    positions = positions[order]
+    masks = numpy.cumsum(numpy.concatenate(changes)[order])
+    ## mask after the last bound at each position
+    last = numpy.r_[positions[1:] != positions[:-1], True]
+    (positions, masks) = (positions[last], masks[last])
+    covered = numpy.flatnonzero(masks[:-1] != 0)
+    return (positions[covered], positions[covered + 1], masks[covered])
+
+def load_file_intervals(file_name, cache=False, rebuild_cache=False):
+    """ Union of the regions of a file per chromosome: dict chromosome -> (starts, ends) """
+    table = load_table(file_name, cache, rebuild_cache)
+    return dict((chr, union_intervals(table.start[rows], table.end[rows])) for (chr, rows) in table.chromosome_groups())
+
+def overlap_segments_chromosome(chr):
+    """
+    overlap_segments() for one chromosome - runs in the worker processes
+
+    The per-file intervals are read from parallel.shared() (see nway_segments_in_memory).
+    """
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    return overlap_segments([intervals.get(chr, (empty, empty)) for intervals in parallel.shared('file_intervals')])
+
+def nway_segments_in_memory(file_names, cache=False, rebuild_cache=False, jobs=1):
+    """
+    Generator over (chromosome, segments, number of regions) of unsorted files
+
+    The files are loaded one at a time and only the union of their regions
+    is kept, chromosomes are then segmented in jobs worker processes.
+    """
+    file_intervals = [load_file_intervals(file_name, cache, rebuild_cache) for file_name in file_names]
+    chromosomes = sorted(set(chr for intervals in file_intervals for chr in intervals))
+    weights = [sum(len(intervals[chr][0]) for intervals in file_intervals if chr in intervals) for chr in chromosomes]
+    parallel.share(file_intervals=file_intervals)
+    try:
+        segments = parallel.map_tasks(overlap_segments_chromosome, chromosomes, jobs, weights)
+    finally:
+        parallel.clear('file_intervals')
+    return itertools.izip(chromosomes, segments, weights)
+
+def pattern_name(mask, num_files):
+    """ Bitmask as a string of 0/1 per file, in file order (e.g. 101 for FILE1 and FILE3) """
+    return ''.join('1' if (mask >> k) & 1 else '0' for k in range(num_files))
+
+def write_nway_segments(file_names, pattern_prefix='pattern_', summary_file='summary.txt', cache=False, rebuild_cache=False, jobs=1, chromosome_key=None):
+    """
+    Writes the segments of each pattern (set of covering files) and a summary table
+
+    Pattern files PATTERN_PREFIX<pattern>.bed hold CHROMOSOME START END
+    lines. The summary has one line per pattern: pattern, files, number of
+    files, segments and bases.
+
+    With chromosome_key (files sorted by chromosome, see find_sort_order)
+    the files are streamed one chromosome at a time (sweep_nway_segments),
+    otherwise they are loaded (nway_segments_in_memory). The segments of a
+    chromosome are appended to the pattern files once it is done, so at
+    most one output file is open at a time.
+    """
+    num_files = len(file_names)
+    if num_files > MAX_NWAY_FILES:
+        raise ValueError('At most %d files can be categorized' % MAX_NWAY_FILES)
+    if chromosome_key is not None:
+        logger.info('Streaming sorted inputs ' + ' '.join(file_names))
+        chromosome_segments = sweep_nway_segments(file_names, chromosome_key)
+    else:
+        chromosome_segments = nway_segments_in_memory(file_names, cache, rebuild_cache, jobs)
+
+    summary = dict()
+    with ProgressReporter('Writing patterns') as progress:
+        for (chr, (starts, ends, masks), num_regions) in chromosome_segments:
+            order = numpy.argsort(masks, kind='mergesort')
+            bounds = numpy.r_[0, numpy.flatnonzero(masks[order][1:] != masks[order][:-1]) + 1, len(order)]
+            for (lo, hi) in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                if hi == lo:
+                    continue
+                rows = order[lo:hi]
+                mask = int(masks[rows[0]])
+                ## the first chromosome of a pattern truncates its file
+                with open(pattern_prefix + pattern_name(mask, num_files) + '.bed', 'a' if mask in summary else 'w') as fid:
+                    fid.write(''.join('%s\t%d\t%d\n' % (chr, x, y) for (x, y) in itertools.izip(starts[rows].tolist(), ends[rows].tolist())))
+                (count, bases) = summary.get(mask, (0, 0))
+                summary[mask] = (count + len(rows), bases + int((ends[rows] - starts[rows]).sum()))
+            logger.info('chromosome: %s segments: %d patterns: %d' % (chr, len(masks), len(bounds) - 1))
+            progress.update(num_regions)
+
+    with open(summary_file, 'w') as fid:
+        print >> fid, '\t'.join(['pattern', 'files', 'num_files', 'segments', 'bases'])
+        for mask in sorted(summary, key=lambda m: (-bin(m).count('1'), pattern_name(m, num_files)[::-1])):
+            members = [file_names[k] for k in range(num_files) if (mask >> k) & 1]
+            print >> fid, '\t'.join([pattern_name(mask, num_files), ','.join(members), str(len(members)), str(summary[mask][0]), str(summary[mask][1])])
+    logger.info('Wrote %d patterns to %s*.bed and %s' % (len(summary), pattern_prefix, summary_file))
+
+
+############################################################
+## Streaming sweep over sorted inputs O(n + m)
+############################################################
+''' Chromosome orderings recognised by find_sort_order() '''
+CHROMOSOME_ORDERS = [('lexicographic', lambda x: x), ('natural', chromosome_sort_key)]
+
+def read_records(fid):
+    ''' Generator over (chromosome, start, end, rest_of_line) in file order '''
+    for table in iter_tables(fid.name, with_rest=True):
+        names = table.chromosome_names
+        for (code, start, end, rest) in itertools.izip(table.chromosome.tolist(), table.start.tolist(), table.end.tolist(), table.rest):
+            yield (names[code], start, end, rest)
+
+def find_sort_order(file_names):
+    '''
+    Checks in one streaming pass whether all files are sorted by chromosome and start.
+
+    @return sort key for chromosome names shared by all files, None if some file is unsorted
+    '''
+    chromosome_blocks = []
+    for file_name in file_names:
+        blocks = sorted_chromosome_blocks(file_name)
+        if blocks is None:
+            return None
+        chromosome_blocks.append(blocks)
+    for (name, key) in CHROMOSOME_ORDERS:
+        if all(blocks == sorted(blocks, key=key) for blocks in chromosome_blocks):
+            logger.info('Inputs sorted with %s chromosome order' % name)
+            return key
+    return None
+
+def guess_sort_order(file_names):
+    '''
+    Chromosome order of files taken to be sorted, without the full check of find_sort_order()
+
+    The chromosome blocks of each file are read until a single order of
+    CHROMOSOME_ORDERS agrees with them (or the file ends); starts are not
+    checked here - the streaming sweeps raise ValueError on unsorted lines.
+
+    @return sort key, None if no order agrees with the chromosome blocks
+    '''
+    candidates = list(CHROMOSOME_ORDERS)
+    for file_name in file_names:
+        blocks = []
+        for table in iter_tables(file_name):
+            codes = table.chromosome
+            if len(codes) == 0:
+                continue
+            for code in codes[numpy.r_[True, codes[1:] != codes[:-1]]].tolist():
+                name = table.chromosome_names[code]
+                if (len(blocks) == 0) or (blocks[-1] != name):
+                    blocks.append(name)
+            candidates = [(name, key) for (name, key) in candidates if blocks == sorted(blocks, key=key) and len(set(blocks)) == len(blocks)]
+            if len(candidates) <= 1:
+                break
+    if len(candidates) == 0:
+        return None
+    logger.info('Inputs taken as sorted with %s chromosome order' % candidates[0][0])
+    return candidates[0][1]
+
+def sweep_overlapping_sequences(records1, records2, chromosome_key=CHROMOSOME_ORDERS[0][1]):
+    '''
+    Two-pointer sweep over two record streams sorted by chromosome and start.
+
+    Only regions that can still overlap the next start point are kept, so
+    memory is bounded by the overlap depth. As in the in-memory path,
+    chromosomes present in only one stream are skipped.
+
+    @arg records1, records2: iterables of (chromosome, start, end, rest_of_line)
+    @arg chromosome_key: sort key of the chromosome order of both streams
+    @return generator of (0, record1, record2, overlap_start, overlap_end) for overlaps,
+            (1, record1) and (2, record2) for unique regions.
+    '''
+    streams = (iter(records1), iter(records2))
+    head = [next(streams[0], None), next(streams[1], None)]
+    seen = (set(), set())
+    def advance(k):
+        prev = head[k]
+        head[k] = next(streams[k], None)
+        if head[k] is not None:
+            if head[k][0] != prev[0]:
+                if (head[k][0] in seen[k]) or (chromosome_key(head[k][0]) < chromosome_key(prev[0])):
+                    raise ValueError('Input %d is not sorted: chromosome %s after %s' % (k + 1, head[k][0], prev[0]))
+                seen[k].add(prev[0])
+            elif head[k][1] < prev[1]:
+                raise ValueError('Input %d is not sorted: %s %d after %d' % (k + 1, prev[0], head[k][1], prev[1]))
+        return prev
+    while (head[0] is not None) and (head[1] is not None):
+        key0 = chromosome_key(head[0][0])
+        key1 = chromosome_key(head[1][0])
+        if key0 != key1:
+            ## chromosome missing from the other stream
+            k = 0 if key0 < key1 else 1
+            chr = head[k][0]
+            while (head[k] is not None) and (head[k][0] == chr):
+                advance(k)
+            continue
+        chr = head[0][0]
+        ## active[k] holds [record, overlapped] of stream k that may still overlap
+        active = ([], [])
+        while True:
+            on_chr = [(head[k] is not None) and (head[k][0] == chr) for k in (0, 1)]
+            if not (on_chr[0] or on_chr[1]):
+                break
+            k = 0 if on_chr[0] and ((not on_chr[1]) or (head[0][1] <= head[1][1])) else 1
+            record = advance(k)
+            start = record[1]
+            for j in (0, 1):
+                retired = [x for x in active[j] if x[0][2] <= start]
+                if len(retired) > 0:
+                    active[j][:] = [x for x in active[j] if x[0][2] > start]
+                    for (other, overlapped) in retired:
+                        if not overlapped:
+                            yield (j + 1, other)
+            entry = [record, False]
+            for other in active[1 - k]:
+                if (other[0][1] < record[2]) and (other[0][2] > record[1]):
+                    other[1] = True
+                    entry[1] = True
+                    (record1, record2) = (record, other[0]) if k == 0 else (other[0], record)
+                    yield (0, record1, record2, max(record1[1], record2[1]), min(record1[2], record2[2]))
+            active[k].append(entry)
+        for j in (0, 1):
+            for (other, overlapped) in active[j]:
+                if not overlapped:
+                    yield (j + 1, other)
+
+def read_chromosome_intervals(file_name):
+    """ Generator over (chromosome, starts, ends) of the contiguous chromosome blocks of a file """
+    (chr, starts, ends) = (None, [], [])
+    for table in iter_tables(file_name):
+        if len(table) == 0:
+            continue
+        codes = table.chromosome
+        runs = numpy.r_[numpy.flatnonzero(numpy.r_[True, codes[1:] != codes[:-1]]), len(codes)]
+        for (lo, hi) in zip(runs[:-1].tolist(), runs[1:].tolist()):
+            name = table.chromosome_names[codes[lo]]
+            if (name != chr) and (chr is not None):
+                yield (chr, numpy.concatenate(starts), numpy.concatenate(ends))
+                (starts, ends) = ([], [])
+            chr = name
+            starts.append(table.start[lo:hi])
+            ends.append(table.end[lo:hi])
+    if chr is not None:
+        yield (chr, numpy.concatenate(starts), numpy.concatenate(ends))
+
+def sweep_nway_segments(file_names, chromosome_key=CHROMOSOME_ORDERS[0][1]):
+    """
+    Generator over (chromosome, segments, number of regions) of files sorted by chromosome
+
+    The chromosome blocks of all files are merged in chromosome_key order,
+    so only one chromosome of each file is held in memory.
+
+    @arg chromosome_key: sort key of the chromosome order of all files
+    """
+    streams = [read_chromosome_intervals(file_name) for file_name in file_names]
+    heads = [next(stream, None) for stream in streams]
+    seen = [set() for stream in streams]
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    while any(head is not None for head in heads):
+        chr = min((head[0] for head in heads if head is not None), key=chromosome_key)
+        intervals = []
+        for (k, head) in enumerate(heads):
+            if (head is None) or (head[0] != chr):
+                intervals.append((empty, empty))
+                continue
+            intervals.append(head[1:])
+            seen[k].add(chr)
+            heads[k] = next(streams[k], None)
+            if (heads[k] is not None) and ((heads[k][0] in seen[k]) or (chromosome_key(heads[k][0]) < chromosome_key(chr))):
+                raise ValueError('Input %d is not sorted: chromosome %s after %s' % (k + 1, heads[k][0], chr))
+        yield (chr, overlap_segments(intervals), sum(len(starts) for (starts, ends) in intervals))
 
 ############################################################
 ## Deprecated version O(m x n)
@@ -189,14 +525,93 @@ def write_set_to_file(s, fid, separator=my_separator, joiner=my_joiner):
         line = joiner.join(parts) 
         print >> fid, line
 
-def write_unique_sites_per_chromosome_to_file(fid, chromosome_name, list_of_chromosome_sites, unique_ids): 
+def format_records(records):
+    ''' <chromosome> <start> <end> <rest of line> lines of (chromosome, start, end, rest_of_line) records '''
+    return ''.join('%s\t%d\t%d\t%s\n' % record for record in records)
+
+def format_overlaps(overlaps):
+    ''' Overlap file lines of (chromosome, overlap start, overlap end, start1, end1, start2, end2) tuples '''
+    return ''.join('%s \t%d %d \t%d %d \t%d %d\n' % overlap for overlap in overlaps)
+
+def write_unique_sites_per_chromosome_to_file(writer, fid, chromosome_name, list_of_chromosome_sites, unique_ids): 
+    ''' Queues the unique sites of a chromosome to a pipeline.BatchWriter '''
     logger.info("Writing %d unique regions on chromosome: %s to file: %s" % (len(unique_ids), chromosome_name, fid.name)) 
-    for key in unique_ids: 
-        start_site = list_of_chromosome_sites[key][0][0]
-        end_site = list_of_chromosome_sites[key][0][1]
-        rest_of_line = list_of_chromosome_sites[key][1]
-        fid.write("%s\t%d\t%d\t%s\n" % (chromosome_name, start_site, end_site, rest_of_line))
-        logger.debug("file: %s unique: %s (%s, %s)" % (fid.name, chromosome_name, start_site, end_site)) 
+    records = [(chromosome_name, list_of_chromosome_sites[key][0][0], list_of_chromosome_sites[key][0][1], list_of_chromosome_sites[key][1]) for key in sorted(unique_ids)]
+    writer.write(fid, format_records(records))
+
+class TestOverlapSegments(unittest.TestCase):
+    def brute_force(self, intervals, size):
+        ''' Runs of equal non-zero masks of the per-base coverage bitmasks '''
+        masks = numpy.zeros(size + 1, dtype=numpy.int64)
+        for (k, (starts, ends)) in enumerate(intervals):
+            for (start, end) in zip(starts, ends):
+                masks[start:end] |= 1 << k
+        segments = []
+        for position in range(size):
+            if masks[position] == 0:
+                continue
+            if len(segments) > 0 and segments[-1][1] == position and segments[-1][2] == masks[position]:
+                segments[-1][1] = position + 1
+            else:
+                segments.append([position, position + 1, masks[position]])
+        return [tuple(x) for x in segments]
+
+    def test_random(self):
+        random = numpy.random.RandomState(0)
+        for trial in range(50):
+            intervals = []
+            for k in range(random.randint(1, 5)):
+                starts = random.randint(0, 100, random.randint(0, 8))
+                intervals.append((starts, starts + random.randint(0, 15, len(starts))))
+            (starts, ends, masks) = overlap_segments(intervals)
+            self.assertEqual(zip(starts.tolist(), ends.tolist(), masks.tolist()), self.brute_force(intervals, 120))
+
+    def test_empty_regions(self):
+        for intervals in ([], [([5], [5]), ([5], [5])], [([], []), ([3, 7], [3, 7])]):
+            (starts, ends, masks) = overlap_segments(intervals)
+            self.assertEqual((len(starts), len(ends), len(masks)), (0, 0, 0))
+
+    def test_write_nway_segments(self):
+        work_dir = tempfile.mkdtemp(prefix='extract_common_')
+        try:
+            random = numpy.random.RandomState(0)
+            file_names = []
+            for k in range(3):
+                lines = []
+                for chr in ['chr1', 'chr10', 'chr2', 'chrX'][k % 2:]:
+                    starts = numpy.sort(random.randint(0, 500, 30))
+                    lines.extend('%s\t%d\t%d\tr%d\n' % (chr, start, start + length, k) for (start, length) in zip(starts.tolist(), random.randint(0, 40, 30).tolist()))
+                file_names.append(os.path.join(work_dir, 'f%d.bed' % k))
+                with open(file_names[-1], 'w') as fid:
+                    fid.writelines(lines)
+            def run(name, **options):
+                prefix = os.path.join(work_dir, name + '_')
+                write_nway_segments(file_names, prefix, prefix + 'summary.txt', **options)
+                outputs = dict()
+                for output in os.listdir(work_dir):
+                    if output.startswith(name + '_'):
+                        with open(os.path.join(work_dir, output)) as fid:
+                            outputs[output[len(name) + 1:]] = fid.read()
+                return outputs
+            key = find_sort_order(file_names)
+            self.assertTrue(key is not None)
+            in_memory = run('memory')
+            self.assertEqual(run('jobs', jobs=2), in_memory)
+            self.assertEqual(run('stream', chromosome_key=key), in_memory)
+            self.assertEqual(len(in_memory), 8)
+            ## chr1 is missing from f1; the summary counts the lines of each pattern file
+            for (name, text) in in_memory.items():
+                if name.endswith('.bed') and name[1] == '1':
+                    self.assertFalse(('\n' + text).find('\nchr1\t') >= 0)
+            summary = [line.split('\t') for line in in_memory['summary.txt'].splitlines()[1:]]
+            self.assertEqual(sorted((x[0], int(x[3])) for x in summary), sorted((name[:-4], len(text.splitlines())) for (name, text) in in_memory.items() if name.endswith('.bed')))
+            ## chromosome out of order in a streamed file
+            with open(file_names[1], 'a') as fid:
+                fid.write('chr1\t5\t10\n')
+            self.assertRaises(ValueError, run, 'unsorted', chromosome_key=key)
+        finally:
+            shutil.rmtree(work_dir)
+
 
 if __name__ == '__main__':
     try:
@@ -214,6 +629,22 @@ if __name__ == '__main__':
         logger.setLevel(logging.DEBUG)
         channel.setLevel(logging.DEBUG)
 
+    input_files = [args.f1, args.f2] + args.files
+    chromosome_key = None
+    if args.sorted:
+        chromosome_key = guess_sort_order(input_files)
+        if chromosome_key is None:
+            logger.warning('--sorted: chromosomes are in no known order, loading the files into memory')
+    elif not args.unsorted:
+        chromosome_key = find_sort_order(input_files)
+
+    if args.nway or len(args.files) > 0:
+        ############################################################
+        ## N-way mode - segments of each combination of files
+        ############################################################
+        write_nway_segments(input_files, args.pattern_prefix, args.s, not args.no_cache, args.rebuild_cache, args.jobs, chromosome_key)
+        sys.exit(0)
+
     file1 = args.f1 
     file2 = args.f2 
     prefix = args.p 
@@ -227,20 +658,6 @@ if __name__ == '__main__':
     common1_file = common_prefix + file1
     common2_file = common_prefix + file2 
     
-    # Read the first file
-    with open(file1, 'r') as fid1: 
-        #    f1s = read_file_to_set(fid1)
-        f1m = read_file_to_map(fid1) 
-        
-    # Read the second file
-    with open(file2, 'r') as fid2: 
-        f2m = read_file_to_map(fid2) 
-        #       f2s = read_file_to_set(fid2) 
-
-    chromosomes1 = f1m.keys()
-    chromosomes2 = f2m.keys()
-    common_chr = set(chromosomes1).intersection(set(chromosomes2))
-
     try: 
         cfid = open(common_file, 'w')
         u1fid = open(unique1_file, 'w') 
@@ -254,55 +671,100 @@ if __name__ == '__main__':
         print "Could  not open file for writing: ", common_file 
         raise 
               
-    for chr in common_chr:
-        list1 = f1m[chr]
-        list2 = f2m[chr] 
-        (overlap_list, unique1, unique2) = find_overlapping_sequences(list1, list2) 
+    if chromosome_key is not None:
+        ############################################################
+        ## Streaming mode - both files sorted
+        ############################################################
+        logger.info('Streaming sorted inputs %s and %s' % (file1, file2))
+        with open(file1, 'r') as fid1:
+            with open(file2, 'r') as fid2:
+                with ProgressReporter('Intersecting %s and %s' % (file1, file2)) as progress, BatchWriter() as writer:
+                    records1 = read_ahead(read_records(fid1), batch_size=BATCH_RECORDS)
+                    records2 = read_ahead(read_records(fid2), batch_size=BATCH_RECORDS)
+                    for items in batches(sweep_overlapping_sequences(records1, records2, chromosome_key)):
+                        progress.update(len(items))
+                        (unique1, unique2, overlaps, common1, common2) = ([], [], [], [], [])
+                        for item in items:
+                            if item[0] == 1:
+                                unique1.append(item[1])
+                            elif item[0] == 2:
+                                unique2.append(item[1])
+                            else:
+                                (kind, record1, record2, overlap_start, overlap_end) = item
+                                overlaps.append((record1[0], overlap_start, overlap_end, record1[1], record1[2], record2[1], record2[2]))
+                                common1.append(record1)
+                                common2.append(record2)
+                        for (fid, records) in [(u1fid, unique1), (u2fid, unique2), (c1fid, common1), (c2fid, common2)]:
+                            writer.write(fid, format_records(records))
+                        writer.write(cfid, format_overlaps(overlaps))
+    else:
+        table1 = load_table(file1, not args.no_cache, args.rebuild_cache)
+        table2 = load_table(file2, not args.no_cache, args.rebuild_cache)
+        f1m = table_to_map(table1)
+        f2m = table_to_map(table2)
+
+        rows1 = dict(table1.chromosome_groups())
+        rows2 = dict(table2.chromosome_groups())
+        common_chr = sorted(set(rows1).intersection(set(rows2)))
 
         ############################################################
-        ## Comparison with find_overlapping_sequences_deprecated()
+        ## Per-chromosome intersection, largest chromosomes first
         ############################################################
-        # (old_ol, old_u1, old_u2) = find_overlapping_sequences_deprecated(list1, list2)
-        # assert(overlap_list == old_ol)
-        # assert(unique1 == old_u1)
-        # assert(unique2 == old_u2)
+        weights = [len(rows1[chr]) + len(rows2[chr]) for chr in common_chr]
+        parallel.share(table1=table1, table2=table2, rows1=rows1, rows2=rows2)
+        try:
+            overlaps = parallel.map_tasks(find_overlapping_chromosome, common_chr, args.jobs, weights)
+        finally:
+            parallel.clear('table1', 'table2', 'rows1', 'rows2')
+
+        with ProgressReporter('Writing overlaps', total=(len(table1) + len(table2))) as progress, BatchWriter() as writer:
+            for (chr, (overlap_list, unique1, unique2)) in zip(common_chr, overlaps):
+                list1 = f1m[chr]
+                list2 = f2m[chr] 
+
+                ############################################################
+                ## Comparison with find_overlapping_sequences_deprecated()
+                ############################################################
+                # (old_ol, old_u1, old_u2) = find_overlapping_sequences_deprecated(list1, list2)
+                # assert(overlap_list == old_ol)
+                # assert(unique1 == old_u1)
+                # assert(unique2 == old_u2)
         
-        logger.info("File: %s chromosome: %s Number of unique regions: %d" % (file1, chr,  len(unique1) ) )
-        logger.info("File: %s chromosome: %s Number of unique regions: %d" % (file2, chr,  len(unique2) ) )
-        logger.info("chromosome: %s Number of overlapping regions: %d" % (chr, len(overlap_list )) ) 
+                logger.info("File: %s chromosome: %s Number of unique regions: %d" % (file1, chr,  len(unique1) ) )
+                logger.info("File: %s chromosome: %s Number of unique regions: %d" % (file2, chr,  len(unique2) ) )
+                logger.info("chromosome: %s Number of overlapping regions: %d" % (chr, len(overlap_list )) ) 
         
-        write_unique_sites_per_chromosome_to_file(u1fid, chr, list1, unique1) 
-        write_unique_sites_per_chromosome_to_file(u2fid, chr, list2, unique2) 
+                write_unique_sites_per_chromosome_to_file(writer, u1fid, chr, list1, unique1) 
+                write_unique_sites_per_chromosome_to_file(writer, u2fid, chr, list2, unique2) 
         
-        for elem in overlap_list.keys(): 
-            overlap_start =  overlap_list[elem][0]
-            overlap_end =  overlap_list[elem][1]
-            start_site1 = list1[elem[0] ][0][0]
-            end_site1 = list1[elem[0] ][0][1]
-            start_site2 = list2[elem[1] ][0][0]
-            end_site2 = list2[elem[1] ][0][1]
-
-            rest_line1 = list1[elem[0] ][1]
-            rest_line2 = list2[elem[1] ][1]
-            
-            print >> cfid, chr, "\t", overlap_start,  overlap_end, "\t", start_site1, end_site1, "\t", start_site2, end_site2
-
-            c1fid.write('%s\t%d\t%d\t%s\n' % (chr, start_site1, end_site1, rest_line1))
-
+                (overlaps, common1, common2) = ([], [], [])
+                for elem in sorted(overlap_list.keys()): 
+                    overlap_start =  overlap_list[elem][0]
+                    overlap_end =  overlap_list[elem][1]
+                    start_site1 = list1[elem[0] ][0][0]
+                    end_site1 = list1[elem[0] ][0][1]
+                    start_site2 = list2[elem[1] ][0][0]
+                    end_site2 = list2[elem[1] ][0][1]
 
-            c2fid.write('%s\t%d\t%d\t%s\n' % (chr, start_site2, end_site2, rest_line2))
+                    rest_line1 = list1[elem[0] ][1]
+                    rest_line2 = list2[elem[1] ][1]
+            
+                    overlaps.append((chr, overlap_start, overlap_end, start_site1, end_site1, start_site2, end_site2))
+                    common1.append((chr, start_site1, end_site1, rest_line1))
+                    common2.append((chr, start_site2, end_site2, rest_line2))
 
-            logger.debug('file: %s chromosome: %s common region: (%d, %d)' % (common1_file, chr, start_site1, end_site1))
-            logger.debug('OVERLAPS WITH')
-            logger.debug('file: %s chromosome: %s common region: (%d, %d)\n' % (common2_file, chr, start_site2, end_site2))
-        logger.info('File: %s chromosome %s has %d common regions written to file: %s' % (file1, chr, len(overlap_list), common1_file))
-        logger.info('File: %s chromosome %s has %d common regions written to file: %s' % (file2, chr, len(overlap_list), common2_file))
+                    logger.debug('file: %s chromosome: %s common region: (%d, %d)' % (common1_file, chr, start_site1, end_site1))
+                    logger.debug('OVERLAPS WITH')
+                    logger.debug('file: %s chromosome: %s common region: (%d, %d)\n' % (common2_file, chr, start_site2, end_site2))
+                writer.write(cfid, format_overlaps(overlaps))
+                writer.write(c1fid, format_records(common1))
+                writer.write(c2fid, format_records(common2))
+                logger.info('File: %s chromosome %s has %d common regions written to file: %s' % (file1, chr, len(overlap_list), common1_file))
+                logger.info('File: %s chromosome %s has %d common regions written to file: %s' % (file2, chr, len(overlap_list), common2_file))
+                progress.update(len(list1) + len(list2))
     u1fid.close()
     u2fid.close()
     cfid.close() 
 
     c1fid.close()
     c2fid.close() 
-
-    fid1.close()
-    fid2.close()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# gene_set_overlap.py ---
+#
+# USAGE: python gene_set_overlap.py [-t THRESHOLD] [--metric {jaccard,overlap}] [--min_overlap M] [--block_size B] [--connected] [-p PREFIX] GMT_FILE
+#
+# Description: Pairwise overlaps of the gene sets of a GMT file, for
+# MSigDB-sized inputs (tens of thousands of gene sets).
+#
+# Genes are interned to integer ids and the gene sets are kept as a sparse
+# set x gene matrix (CSR arrays) together with its transpose, the postings
+# list of the sets containing each gene. The intersection sizes of a block
+# of sets with all other sets are counted by expanding the postings of the
+# genes of the block and binning the (set, other set) pairs, so memory is
+# bounded by the block size and only pairs sharing a gene are touched.
+#
+# Pairs with similarity >= THRESHOLD are streamed to the output files:
+#
+#   PREFIXgsID.csv      id,name,size of every gene set
+#   PREFIXoverlap.csv   name1,name2,size1,size2,intersection,jaccard,overlap_coefficient
+#   PREFIXadj_list.csv  id1,id2,similarity (the --metric value)
+#
+# with jaccard = |A & B| / |A | B| and overlap_coefficient = |A & B| / min(|A|, |B|).
+#
+# With --connected, PREFIXadj_list.csv holds only the maximum similarity
+# spanning forest of the thresholded pairs (a minimum spanning forest with
+# distance 1 - similarity, MinimumSpanningTree.minimum_spanning_forest):
+# one tree per connected block of gene sets, built from the edge arrays
+# without a dense set x set matrix.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import unittest
+
+import numpy
+
+from logger import logger
+from bgzf import open_input
+from IntervalIndex import expand_ranges
+from update_progress import ProgressReporter
+from MinimumSpanningTree import minimum_spanning_forest
+
+############################################################
+# Global parameters
+############################################################
+''' Default similarity threshold (gmt_main.py example) '''
+THRESHOLD = 0.2
+
+''' Gene sets per block of the overlap computation '''
+BLOCK_SIZE = 256
+
+METRICS = ('jaccard', 'overlap')
+
+
+############################################################
+# Gene sets as sparse arrays
+############################################################
+class GeneSets:
+    '''
+    Gene sets of a GMT file
+
+    names, descriptions  one entry per gene set
+    gene_names           interned gene names (gene id -> name)
+    indptr, gene_ids     CSR arrays: the genes of set k are gene_ids[indptr[k]:indptr[k + 1]],
+                         sorted and without duplicates
+    '''
+    def __init__(self, names, descriptions, gene_names, indptr, gene_ids):
+        self.names = names
+        self.descriptions = descriptions
+        self.gene_names = gene_names
+        self.indptr = indptr
+        self.gene_ids = gene_ids
+
+    def __len__(self):
+        return len(self.names)
+
+    def sizes(self):
+        return numpy.diff(self.indptr)
+
+    def postings(self):
+        '''
+        Transpose of the set x gene matrix
+
+        @return (indptr, set_ids): the sets containing gene g are set_ids[indptr[g]:indptr[g + 1]], in increasing order
+        '''
+        set_ids = numpy.repeat(numpy.arange(len(self)), self.sizes())
+        order = numpy.argsort(self.gene_ids, kind='mergesort')
+        counts = numpy.bincount(self.gene_ids, minlength=len(self.gene_names))
+        return (numpy.r_[0, numpy.cumsum(counts)], set_ids[order])
+
+    @classmethod
+    def read_gmt(cls, file_name):
+        ''' Reads a GMT file: NAME DESCRIPTION GENE1 GENE2 ... per line, tab-separated '''
+        names = []
+        descriptions = []
+        gene_index = dict()
+        gene_names = []
+        indptr = [0]
+        gene_ids = []
+        with open_input(file_name) as fid:
+            for line in fid:
+                parts = line.rstrip('\r\n').split('\t')
+                if len(parts) < 2 or line.startswith('#'):
+                    continue
+                ids = set()
+                for gene in parts[2:]:
+                    if gene == '':
+                        continue
+                    id = gene_index.get(gene)
+                    if id is None:
+                        id = len(gene_names)
+                        gene_index[gene] = id
+                        gene_names.append(gene)
+                    ids.add(id)
+                names.append(parts[0])
+                descriptions.append(parts[1])
+                gene_ids.extend(sorted(ids))
+                indptr.append(len(gene_ids))
+        logger.info('%s: %d gene sets, %d genes' % (file_name, len(names), len(gene_names)))
+        return cls(names, descriptions, gene_names, numpy.array(indptr, dtype=numpy.int64), numpy.array(gene_ids, dtype=numpy.int64))
+
+
+############################################################
+# Blocked overlap computation
+############################################################
+def block_intersections(gene_sets, postings, lo, hi, min_overlap=1):
+    '''
+    Intersection sizes of the sets lo .. hi-1 with all later sets
+
+    @arg postings: gene_sets.postings()
+    @return (i, j, intersection) arrays of the pairs i < j with at least min_overlap shared genes
+    '''
+    n = len(gene_sets)
+    (posting_indptr, posting_sets) = postings
+    members = gene_sets.gene_ids[gene_sets.indptr[lo]:gene_sets.indptr[hi]]
+    owner = numpy.repeat(numpy.arange(hi - lo), gene_sets.sizes()[lo:hi])
+    (k, position) = expand_ranges(posting_indptr[members], posting_indptr[members + 1])
+    i = owner[k]
+    j = posting_sets[position]
+    later = j > i + lo
+    counts = numpy.bincount(i[later] * n + j[later], minlength=(hi - lo) * n)
+    pairs = numpy.flatnonzero(counts >= max(min_overlap, 1))
+    return (pairs // n + lo, pairs % n, counts[pairs])
+
+def similarities(intersection, size1, size2):
+    ''' (jaccard, overlap coefficient) arrays '''
+    intersection = intersection.astype(numpy.float64)
+    jaccard = intersection / (size1 + size2 - intersection)
+    overlap = intersection / numpy.minimum(size1, size2)
+    return (jaccard, overlap)
+
+def iter_overlaps(gene_sets, threshold=THRESHOLD, metric='jaccard', min_overlap=1, block_size=BLOCK_SIZE):
+    '''
+    Generator over blocks of similar pairs
+
+    @return generator of (i, j, intersection, jaccard, overlap) arrays with
+            i < j and the chosen metric >= threshold
+    '''
+    postings = gene_sets.postings()
+    sizes = gene_sets.sizes()
+    for lo in xrange(0, len(gene_sets), block_size):
+        hi = min(lo + block_size, len(gene_sets))
+        (i, j, intersection) = block_intersections(gene_sets, postings, lo, hi, min_overlap)
+        (jaccard, overlap) = similarities(intersection, sizes[i], sizes[j])
+        keep = (jaccard if metric == 'jaccard' else overlap) >= threshold
+        yield (i[keep], j[keep], intersection[keep], jaccard[keep], overlap[keep])
+
+
+############################################################
+# Output
+############################################################
+def write_gene_set_ids(file_name, gene_sets):
+    with open(file_name, 'w') as fid:
+        print >> fid, 'id,name,size'
+        fid.writelines('%d,%s,%d\n' % (k, name, size) for (k, (name, size)) in enumerate(zip(gene_sets.names, gene_sets.sizes().tolist())))
+
+def write_overlaps(prefix, gene_sets, threshold=THRESHOLD, metric='jaccard', min_overlap=1, block_size=BLOCK_SIZE, connected=False):
+    '''
+    Writes PREFIXgsID.csv, PREFIXoverlap.csv and PREFIXadj_list.csv
+
+    @arg connected: the adjacency list is the maximum similarity spanning forest of the pairs
+
+    @return number of pairs written
+    '''
+    write_gene_set_ids(prefix + 'gsID.csv', gene_sets)
+    names = gene_sets.names
+    sizes = gene_sets.sizes()
+    num_pairs = 0
+    edges = []
+    with open(prefix + 'overlap.csv', 'w') as overlap_fid, open(prefix + 'adj_list.csv', 'w') as adjacency_fid:
+        print >> overlap_fid, 'name1,name2,size1,size2,intersection,jaccard,overlap_coefficient'
+        print >> adjacency_fid, 'id1,id2,similarity'
+        with ProgressReporter('Gene set overlaps', total=len(gene_sets)) as progress:
+            for (i, j, intersection, jaccard, overlap) in iter_overlaps(gene_sets, threshold, metric, min_overlap, block_size):
+                rows = zip(i.tolist(), j.tolist(), intersection.tolist(), jaccard.tolist(), overlap.tolist())
+                overlap_fid.writelines('%s,%s,%d,%d,%d,%g,%g\n' % (names[a], names[b], sizes[a], sizes[b], c, x, y) for (a, b, c, x, y) in rows)
+                similarity = jaccard if metric == 'jaccard' else overlap
+                if connected:
+                    edges.append((i, j, similarity))
+                else:
+                    adjacency_fid.writelines('%d,%d,%g\n' % (a, b, w) for (a, b, w) in zip(i.tolist(), j.tolist(), similarity.tolist()))
+                num_pairs += len(i)
+                progress.update(min(block_size, len(gene_sets) - progress.records))
+        if connected:
+            (i, j, similarity) = [numpy.concatenate(x) for x in zip(*edges)] if len(edges) > 0 else ([], [], numpy.zeros(0))
+            (i, j, distance) = minimum_spanning_forest(len(gene_sets), i, j, 1 - similarity)
+            adjacency_fid.writelines('%d,%d,%g\n' % (a, b, 1 - w) for (a, b, w) in zip(i.tolist(), j.tolist(), distance.tolist()))
+            logger.info('Spanning forest: %d edges' % len(i))
+    logger.info('Wrote %d pairs with %s >= %g' % (num_pairs, metric, threshold))
+    return num_pairs
+
+
+class TestGeneSetOverlap(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='gene_set_overlap_')
+        random = numpy.random.RandomState(0)
+        genes = ['G%d' % k for k in range(40)]
+        ## sets of 0 .. 11 genes (with repeated genes), a comment line and a line without genes
+        self.sets = []
+        lines = ['# comment\n', 'short\n']
+        for k in range(23):
+            members = [genes[g] for g in random.randint(0, 40, random.randint(0, 12))]
+            if k % 4 == 0:
+                members = members + members[:2]
+            self.sets.append(set(members))
+            lines.append('\t'.join(['set%d' % k, 'http://set%d' % k] + members) + '\n')
+        self.gmt_file = os.path.join(self.work_dir, 'sets.gmt')
+        with open(self.gmt_file, 'w') as fid:
+            fid.writelines(lines)
+        self.gene_sets = GeneSets.read_gmt(self.gmt_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def brute_force(self, threshold, metric, min_overlap):
+        pairs = []
+        for i in range(len(self.sets)):
+            for j in range(i + 1, len(self.sets)):
+                (a, b) = (self.sets[i], self.sets[j])
+                c = len(a & b)
+                if c == 0 or c < min_overlap:
+                    continue
+                jaccard = float(c) / len(a | b)
+                overlap = float(c) / min(len(a), len(b))
+                if (jaccard if metric == 'jaccard' else overlap) >= threshold:
+                    pairs.append((i, j, c, jaccard, overlap))
+        return pairs
+
+    def test_read_gmt(self):
+        self.assertEqual(self.gene_sets.names, ['set%d' % k for k in range(23)])
+        self.assertEqual(self.gene_sets.sizes().tolist(), [len(x) for x in self.sets])
+        for k in range(len(self.sets)):
+            ids = self.gene_sets.gene_ids[self.gene_sets.indptr[k]:self.gene_sets.indptr[k + 1]]
+            self.assertEqual(set(self.gene_sets.gene_names[g] for g in ids.tolist()), self.sets[k])
+
+    def test_blocked_overlaps(self):
+        for (threshold, metric, min_overlap) in [(0.0, 'jaccard', 1), (0.2, 'jaccard', 1), (0.5, 'overlap', 1), (0.0, 'overlap', 3)]:
+            expected = self.brute_force(threshold, metric, min_overlap)
+            for block_size in [1, 5, 100]:
+                pairs = []
+                for (i, j, intersection, jaccard, overlap) in iter_overlaps(self.gene_sets, threshold, metric, min_overlap, block_size):
+                    pairs.extend(zip(i.tolist(), j.tolist(), intersection.tolist(), jaccard.tolist(), overlap.tolist()))
+                self.assertEqual([x[:3] for x in pairs], [x[:3] for x in expected])
+                for (x, y) in zip(pairs, expected):
+                    self.assertAlmostEqual(x[3], y[3])
+                    self.assertAlmostEqual(x[4], y[4])
+        self.assertTrue(len(self.brute_force(0.0, 'overlap', 3)) < len(self.brute_force(0.0, 'overlap', 1)))
+
+    def test_connected(self):
+        prefix = os.path.join(self.work_dir, 'out_')
+        num_pairs = write_overlaps(prefix, self.gene_sets, 0.1, block_size=4, connected=True)
+        expected = self.brute_force(0.1, 'jaccard', 1)
+        self.assertEqual(num_pairs, len(expected))
+        with open(prefix + 'adj_list.csv') as fid:
+            edges = [line.strip().split(',') for line in fid][1:]
+        ## maximum similarity spanning forest (Kruskal on the brute force pairs)
+        parent = range(len(self.sets))
+        def find(x):
+            while parent[x] != x:
+                x = parent[x]
+            return x
+        total = 0.0
+        num_edges = 0
+        for (i, j, c, jaccard, overlap) in sorted(expected, key=lambda x: -x[3]):
+            (a, b) = (find(i), find(j))
+            if a != b:
+                parent[a] = b
+                total += jaccard
+                num_edges += 1
+        self.assertEqual(len(edges), num_edges)
+        self.assertAlmostEqual(sum(float(w) for (a, b, w) in edges), total, places=4)
+        ## the forest edges are thresholded pairs
+        similar = set((i, j) for (i, j, c, jaccard, overlap) in expected)
+        self.assertTrue(all((int(a), int(b)) in similar for (a, b, w) in edges))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pairwise overlaps of the gene sets of a GMT file.')
+    parser.add_argument('gmt_file', metavar='GMT_FILE', type=str, help='GMT file: NAME DESCRIPTION GENE1 GENE2 ... per line')
+    parser.add_argument('-t', metavar='THRESHOLD', type=float, default=THRESHOLD, help='Write pairs with similarity >= THRESHOLD (default: %g)' % THRESHOLD)
+    parser.add_argument('--metric', choices=METRICS, default='jaccard', help='Similarity: jaccard (|A & B| / |A | B|) or overlap (|A & B| / min(|A|, |B|)) (default: jaccard)')
+    parser.add_argument('--min_overlap', metavar='M', type=int, default=1, help='Only pairs sharing at least M genes (default: 1)')
+    parser.add_argument('--block_size', metavar='B', type=int, default=BLOCK_SIZE, help='Gene sets per block; memory grows with B x number of sets (default: %d)' % BLOCK_SIZE)
+    parser.add_argument('--connected', action='store_true', help='Write the maximum similarity spanning forest of the pairs as the adjacency list')
+    parser.add_argument('-p', metavar='PREFIX', type=str, default='', help='Prefix of the output files (default: none)')
+    args = parser.parse_args(sys.argv[1:])
+
+    gene_sets = GeneSets.read_gmt(args.gmt_file)
+    write_overlaps(args.p, gene_sets, args.t, args.metric, args.min_overlap, args.block_size, args.connected)
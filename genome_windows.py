@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# genome_windows.py ---
+#
+# Description: Fixed-size genome windows (port of Rcode_Windowsize.R).
+#
+# USAGE: python genome_windows.py CHROM_SIZES_FILE WINDOW_SIZE OUTPUT_FILE
+#
+# A chromosome of length L is split like seq(1, L, window_size) in
+# Rcode_Windowsize.R: window k covers [1 + k*w, (k+1)*w] for
+# k = 0 .. (L-1)//w - 1, the last partial window is dropped. Windows are
+# never stored - a peak falls in window (peak_start - 1) // w, and window
+# coordinates are computed from the window index when they are written.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import sys
+import argparse
+import unittest
+
+import numpy
+
+from bed_loader import parse_block, STRAND_PLUS, STRAND_MINUS
+from bgzf import open_input
+
+''' Window size used by Rcode_Windowsize.R '''
+WINDOW_SIZE = 9000
+
+
+############################################################
+# Chromosome sizes and window coordinates
+############################################################
+def read_chromosome_sizes(file_name):
+    '''
+    Reads a chromosome sizes file (UCSC chrom.sizes: CHROMOSOME SIZE per line)
+
+    @return list of (chromosome, size) in file order
+    '''
+    sizes = []
+    with open_input(file_name) as fid:
+        for line in fid:
+            parts = line.split()
+            if len(parts) < 2 or line.startswith('#') or not parts[1].isdigit():
+                continue
+            sizes.append((parts[0], int(parts[1])))
+    return sizes
+
+def num_windows(chromosome_size, window_size):
+    ''' Number of complete windows on a chromosome '''
+    return max((chromosome_size - 1) // window_size, 0)
+
+def window_bounds(window_idx, window_size):
+    ''' (starts, ends) of an array of window indices '''
+    window_idx = numpy.asarray(window_idx, dtype=numpy.int64)
+    return (window_idx * window_size + 1, (window_idx + 1) * window_size)
+
+def iter_windows(chromosome_sizes, window_size):
+    ''' Generator over (chromosome, window_start, window_end) '''
+    for (chr, size) in chromosome_sizes:
+        for k in xrange(num_windows(size, window_size)):
+            yield (chr, k * window_size + 1, (k + 1) * window_size)
+
+
+############################################################
+# Windowed peak counts
+############################################################
+def window_index(starts, ends, num_windows, window_size):
+    '''
+    Window enclosing each peak
+
+    @return array of window indices, -1 for peaks not inside a single window
+    '''
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    window_idx = (starts - 1) // window_size
+    inside = (starts >= 1) & (window_idx < num_windows) & (ends <= (window_idx + 1) * window_size)
+    window_idx[~inside] = -1
+    return window_idx
+
+def count_peaks_in_windows(peaks, chromosome_sizes, window_size=WINDOW_SIZE):
+    '''
+    Counts peaks per strand in fixed-size windows
+
+    A peak is counted in a window if the window encloses it, as
+    count_peaks_in_region.count_peaks_in_regions() does for regions.
+
+    @arg peaks: IntervalTable of groseq peaks
+    @arg chromosome_sizes: list of (chromosome, size)
+    @arg window_size: window size
+    @return dict chromosome -> (plus counts, minus counts) indexed by window
+    '''
+    peak_rows = dict(peaks.chromosome_groups())
+    result = dict()
+    for (chr, size) in chromosome_sizes:
+        n = num_windows(size, window_size)
+        curr_plus = numpy.zeros(n, dtype=numpy.int64)
+        curr_minus = numpy.zeros(n, dtype=numpy.int64)
+        if chr in peak_rows:
+            rows = peak_rows[chr]
+            window_idx = window_index(peaks.start[rows], peaks.end[rows], n, window_size)
+            strands = peaks.strand[rows]
+            curr_plus = numpy.bincount(window_idx[(window_idx >= 0) & (strands == STRAND_PLUS)], minlength=n)
+            curr_minus = numpy.bincount(window_idx[(window_idx >= 0) & (strands == STRAND_MINUS)], minlength=n)
+        result[chr] = (curr_plus, curr_minus)
+    return result
+
+
+class TestGenomeWindows(unittest.TestCase):
+    def test_windows(self):
+        ## seq(1, L, 10): 1 11 21 for L = 30 (2 windows), 1 11 21 31 for L = 31 (3 windows)
+        sizes = [('chr1', 31), ('chr2', 30), ('chr3', 10), ('chr4', 1), ('chr5', 11)]
+        self.assertEqual(list(iter_windows(sizes, 10)), [('chr1', 1, 10), ('chr1', 11, 20), ('chr1', 21, 30),
+                                                         ('chr2', 1, 10), ('chr2', 11, 20), ('chr5', 1, 10)])
+        self.assertEqual([num_windows(size, 10) for (chr, size) in sizes], [3, 2, 0, 0, 1])
+        (starts, ends) = window_bounds([0, 2], 10)
+        self.assertEqual((starts.tolist(), ends.tolist()), ([1, 21], [10, 30]))
+
+    def test_count_peaks_in_windows(self):
+        from IntervalTree import Interval, IntervalTree
+        sizes = [('chr1', 1001), ('chr2', 995), ('chr3', 50)]
+        window_size = 100
+        random = numpy.random.RandomState(0)
+        peaks = [('chr1', 1, 100, '+'), ('chr1', 0, 5, '+'), ('chr1', 100, 101, '-'), ('chr1', 901, 1000, '-'), ('chr2', 901, 950, '+')]
+        for chr in ['chr1', 'chr2', 'chr3', 'chr4']:
+            starts = random.randint(0, 1050, 300)
+            peaks.extend((chr, start, start + length, '+-.'[k]) for (start, length, k) in
+                         zip(starts.tolist(), random.randint(0, 30, 300).tolist(), random.randint(0, 3, 300).tolist()))
+        table = parse_block(''.join('%s\t%d\t%d\tp\t0\t%s\n' % peak for peak in peaks))
+        result = count_peaks_in_windows(table, sizes, window_size)
+        self.assertEqual(sorted(result), ['chr1', 'chr2', 'chr3'])
+        windows = list(iter_windows(sizes, window_size))
+        for (chr, size) in sizes:
+            n = num_windows(size, window_size)
+            self.assertEqual((len(result[chr][0]), len(result[chr][1])), (n, n))
+            expected = {'+': [0] * n, '-': [0] * n}
+            chr_windows = [Interval(start, end, k) for (k, (c, start, end)) in enumerate(x for x in windows if x[0] == chr)]
+            if len(chr_windows) > 0:
+                tree = IntervalTree.init_from_list(chr_windows)
+                for (c, start, end, strand) in peaks:
+                    if c == chr and strand in expected:
+                        for window in tree.enclosing_interval_search(Interval(start, end)):
+                            expected[strand][window.id] += 1
+            self.assertEqual((result[chr][0].tolist(), result[chr][1].tolist()), (expected['+'], expected['-']))
+        ## peaks starting before base 1, spanning two windows or in the dropped tail (901 .. 995 of chr2)
+        table = parse_block(''.join('%s\t%d\t%d\tp\t0\t%s\n' % peak for peak in peaks[:5]))
+        result = count_peaks_in_windows(table, sizes, window_size)
+        self.assertEqual(result['chr1'][0].tolist(), [1] + [0] * 9)
+        self.assertEqual(result['chr1'][1].tolist(), [0] * 9 + [1])
+        self.assertEqual((result['chr2'][0].sum(), result['chr2'][1].sum()), (0, 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the fixed-size windows of a genome as a BED file (as Rcode_Windowsize.R).')
+    parser.add_argument('sizes_file', metavar='CHROM_SIZES_FILE', type=str, help='File with CHROMOSOME SIZE per line')
+    parser.add_argument('window_size', metavar='WINDOW_SIZE', type=int, help='Window size (e.g. %d)' % WINDOW_SIZE)
+    parser.add_argument('output_file', metavar='OUTPUT_FILE', type=str, help='Output BED file')
+    args = parser.parse_args(sys.argv[1:])
+    with open(args.output_file, 'w') as fid:
+        for (chr, start, end) in iter_windows(read_chromosome_sizes(args.sizes_file), args.window_size):
+            print >> fid, '\t'.join([chr, str(start), str(end)])
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# merge_peaks.py ---
+#
+# USAGE: python merge_peaks.py [-g GAP] [--min_support K] [-o OUTPUT_FILE] [--sorted | --unsorted] FILE [FILE ...]
+#
+# Description: Merges the peaks of several BED files (e.g. replicate CTCF
+# peak calls) into consensus clusters.
+#
+# Peaks are joined into a cluster when they overlap or are at most GAP
+# bases apart: a peak starting at or before the largest end of the cluster
+# plus GAP joins it. Each cluster is written as
+#
+# <chromosome> <start> <end> <number of peaks> <number of files> <peaks per file>
+#
+# where the last column lists the number of peaks of each input file, in
+# the order of the files on the command line, separated by commas.
+#
+# If all files are sorted by chromosome and start (as detected by
+# extract_common_v3.find_sort_order), they are streamed through a k-way
+# heap merge and a single sweep, keeping only the current cluster in
+# memory. With --sorted the chromosome order is taken from the first
+# chromosome blocks (extract_common_v3.guess_sort_order) and an unsorted
+# line raises ValueError. Otherwise the files are loaded and the clusters are the
+# connected components (UnionFind) of the peaks joined in start order.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import os
+import sys
+import heapq
+import shutil
+import argparse
+import tempfile
+import unittest
+import itertools
+
+import numpy
+
+from logger import logger, set_verbosity
+from bed_loader import iter_tables, load_table
+from GROSeqRecord import natural_chromosome_ranks
+from UnionFind import ArrayUnionFind
+from extract_common_v3 import find_sort_order, guess_sort_order, CHROMOSOME_ORDERS
+from update_progress import ProgressReporter
+
+############################################################
+# Global parameters
+############################################################
+''' Peaks at most GAP bases apart are merged (0: overlapping or adjacent) '''
+GAP = 0
+
+
+############################################################
+# Streaming merge of sorted files
+############################################################
+def read_peaks(file_name, file_index, chromosome_key):
+    '''
+    Generator over (chromosome key, start, end, file index, chromosome) in file order
+
+    Raises ValueError if (chromosome key, start) decreases, i.e. if the file
+    is not sorted with chromosome_key.
+    '''
+    last = None
+    for table in iter_tables(file_name):
+        if len(table) == 0:
+            continue
+        keys = [chromosome_key(name) for name in table.chromosome_names]
+        names = table.chromosome_names
+        ############################################################
+        # Check order: chromosome keys and starts within a chromosome non-decreasing
+        ############################################################
+        chromosome = table.chromosome
+        same = chromosome[1:] == chromosome[:-1]
+        backwards = numpy.flatnonzero(same & (table.start[1:] < table.start[:-1]))
+        if len(backwards) > 0:
+            k = backwards[0]
+            raise ValueError('%s is not sorted: %s %d after %d' % (file_name, names[chromosome[k]], table.start[k + 1], table.start[k]))
+        changes = numpy.flatnonzero(~same) + 1
+        for (k, code) in zip(numpy.r_[0, changes].tolist(), chromosome[numpy.r_[0, changes]].tolist()):
+            if last is not None and ((keys[code], table.start[k]) < last[:2]):
+                raise ValueError('%s is not sorted: %s %d after %s %d' % (file_name, names[code], table.start[k], last[2], last[1]))
+            last = (keys[code], table.start[k], names[code])
+        last = (keys[chromosome[-1]], table.start[-1], names[chromosome[-1]])
+        for (code, start, end) in itertools.izip(chromosome.tolist(), table.start.tolist(), table.end.tolist()):
+            yield (keys[code], start, end, file_index, names[code])
+
+def sweep_clusters(peaks, num_files, gap=GAP):
+    '''
+    Clusters of a stream of peaks sorted by chromosome and start
+
+    @arg peaks: iterable of (chromosome key, start, end, file index, chromosome)
+    @arg num_files: number of input files
+    @arg gap: largest distance between joined peaks
+    @return generator over (chromosome, start, end, peaks per file) - peaks per file is a list
+    '''
+    cluster = None
+    for (key, start, end, file_index, chr) in peaks:
+        if (cluster is not None) and (cluster[0] == chr) and (start <= cluster[2] + gap):
+            cluster[2] = max(cluster[2], end)
+            cluster[3][file_index] += 1
+            continue
+        if cluster is not None:
+            yield tuple(cluster)
+        cluster = [chr, start, end, [0] * num_files]
+        cluster[3][file_index] = 1
+    if cluster is not None:
+        yield tuple(cluster)
+
+def merge_sorted_files(file_names, gap=GAP, chromosome_key=CHROMOSOME_ORDERS[0][1]):
+    ''' Clusters (see sweep_clusters) of files sorted with the given chromosome order '''
+    streams = [read_peaks(file_name, k, chromosome_key) for (k, file_name) in enumerate(file_names)]
+    return sweep_clusters(heapq.merge(*streams), len(file_names), gap)
+
+
+############################################################
+# Clusters of unsorted files
+############################################################
+def cluster_labels(chromosome, start, end, gap=GAP):
+    '''
+    Cluster of each peak
+
+    Within each chromosome, a peak is joined to the peak with the largest
+    end among those starting before it if it starts at most gap bases
+    after that end; the clusters are the connected components.
+
+    @return array of cluster labels (0 .. number of clusters - 1)
+    '''
+    order = numpy.lexsort((start, chromosome))
+    sorted_chromosome = chromosome[order]
+    sorted_end = end[order]
+    ## position of the running maximum of the ends within each chromosome
+    ## (ends shifted by chromosome so that maxima do not cross chromosomes)
+    shifted = sorted_chromosome * (sorted_end.max() + 1 if len(order) > 0 else 0) + sorted_end
+    reach_end = numpy.maximum.accumulate(numpy.where(shifted == numpy.maximum.accumulate(shifted), numpy.arange(len(order)), 0))
+    joined = numpy.flatnonzero((sorted_chromosome[1:] == sorted_chromosome[:-1]) & (start[order][1:] <= sorted_end[reach_end[:-1]] + gap)) + 1
+    forest = ArrayUnionFind(len(order))
+    forest.union_edges(order[joined], order[reach_end[joined - 1]])
+    return forest.component_labels()
+
+def merge_files(file_names, gap=GAP, cache=False, rebuild_cache=False):
+    ''' Clusters (see sweep_clusters) of files in any order, sorted by natural chromosome order and start '''
+    names = []
+    columns = []
+    for (k, file_name) in enumerate(file_names):
+        table = load_table(file_name, cache, rebuild_cache)
+        for (chr, rows) in table.chromosome_groups():
+            if chr not in names:
+                names.append(chr)
+            columns.append((numpy.repeat(names.index(chr), len(rows)), table.start[rows], table.end[rows], numpy.repeat(k, len(rows))))
+    if len(columns) == 0:
+        return
+    (chromosome, start, end, file_index) = [numpy.concatenate(x).astype(numpy.int64) for x in zip(*columns)]
+    labels = cluster_labels(chromosome, start, end, gap)
+    num_clusters = labels.max() + 1
+    cluster_chromosome = numpy.zeros(num_clusters, dtype=numpy.int64)
+    cluster_chromosome[labels] = chromosome
+    cluster_start = numpy.empty(num_clusters, dtype=numpy.int64)
+    cluster_start.fill(numpy.iinfo(numpy.int64).max)
+    numpy.minimum.at(cluster_start, labels, start)
+    cluster_end = numpy.empty(num_clusters, dtype=numpy.int64)
+    cluster_end.fill(numpy.iinfo(numpy.int64).min)
+    numpy.maximum.at(cluster_end, labels, end)
+    support = numpy.bincount(labels * len(file_names) + file_index, minlength=num_clusters * len(file_names)).reshape((num_clusters, len(file_names)))
+    ranks = natural_chromosome_ranks(names)
+    for k in numpy.lexsort((cluster_start, ranks[cluster_chromosome])).tolist():
+        yield (names[cluster_chromosome[k]], int(cluster_start[k]), int(cluster_end[k]), support[k].tolist())
+
+
+############################################################
+# Output
+############################################################
+def write_clusters(fid, clusters, file_names, min_support=1):
+    '''
+    Writes the clusters present in at least min_support files
+
+    @return (number of clusters written, number of clusters)
+    '''
+    print >> fid, '#' + '\t'.join(['chromosome', 'start', 'end', 'peaks', 'files', ','.join(file_names)])
+    (written, total) = (0, 0)
+    with ProgressReporter('Merging %d files' % len(file_names)) as progress:
+        for (chr, start, end, support) in clusters:
+            total += 1
+            progress.update(1)
+            files = len(support) - support.count(0)
+            if files < min_support:
+                continue
+            fid.write('%s\t%d\t%d\t%d\t%d\t%s\n' % (chr, start, end, sum(support), files, ','.join(str(x) for x in support)))
+            written += 1
+    return (written, total)
+
+
+class TestMergePeaks(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='merge_peaks_')
+        random = numpy.random.RandomState(0)
+        self.file_names = []
+        for k in range(3):
+            peaks = []
+            for chr in ['chr1', 'chr2', 'chr10']:
+                starts = random.randint(0, 20000, 150)
+                peaks.extend((chr, start, start + random.randint(1, 300)) for start in starts.tolist())
+            ## natural chromosome order: chr10 after chr2, so heapq.merge with the lexicographic order would interleave
+            peaks.sort(key=lambda peak: (int(peak[0][3:]), peak[1]))
+            file_name = os.path.join(self.work_dir, 'peaks%d.bed' % k)
+            with open(file_name, 'w') as fid:
+                fid.writelines('%s\t%d\t%d\n' % peak for peak in peaks)
+            self.file_names.append(file_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_sorted_equals_loaded(self):
+        key = guess_sort_order(self.file_names)
+        self.assertTrue(key is find_sort_order(self.file_names))
+        for gap in (0, 50):
+            streamed = list(merge_sorted_files(self.file_names, gap, key))
+            loaded = list(merge_files(self.file_names, gap))
+            self.assertEqual(streamed, loaded)
+
+    def test_lexicographic_key_raises(self):
+        self.assertRaises(ValueError, list, merge_sorted_files(self.file_names, GAP, CHROMOSOME_ORDERS[0][1]))
+
+    def test_unsorted_raises(self):
+        with open(self.file_names[0], 'a') as fid:
+            fid.write('chr10\t5\t10\n')
+        key = guess_sort_order(self.file_names)
+        self.assertRaises(ValueError, list, merge_sorted_files(self.file_names, GAP, key))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merges the peaks of several BED files into clusters with per-file support.')
+    parser.add_argument('files', metavar='FILE', type=str, nargs='+', help='BED files (plain, gzip or BGZF)')
+    parser.add_argument('-g', '--gap', metavar='GAP', type=int, default=GAP, help='Merge peaks at most GAP bases apart (default: %d, overlapping or adjacent)' % GAP)
+    parser.add_argument('--min_support', metavar='K', type=int, default=1, help='Only write clusters with peaks from at least K files (default: 1)')
+    parser.add_argument('-o', metavar='OUTPUT_FILE', type=str, default='merged.bed', help='Output file (default: merged.bed)')
+    sort_group = parser.add_mutually_exclusive_group()
+    sort_group.add_argument('--sorted', action='store_true', help='Inputs are sorted by chromosome and start (lexicographic or natural chromosome order): stream them without the detection pass (default: detected automatically)')
+    sort_group.add_argument('--unsorted', action='store_true', help='Skip detection of sorted input and load all files into memory')
+    parser.add_argument('--no_cache', action='store_true', help='Do not read or write the binary caches (FILE.npcache) when loading files into memory')
+    parser.add_argument('--rebuild_cache', action='store_true', help='Rebuild the binary caches when loading files into memory')
+    parser.add_argument('-v', metavar='VERBOSITY', type=int, default=1, help='Verbosity level [0, 1, 2] (default: 1)')
+    args = parser.parse_args(sys.argv[1:])
+    set_verbosity(args.v)
+
+    chromosome_key = None
+    if args.sorted:
+        chromosome_key = guess_sort_order(args.files)
+        if chromosome_key is None:
+            logger.warning('--sorted: chromosomes are in no known order, loading the files into memory')
+    elif not args.unsorted:
+        chromosome_key = find_sort_order(args.files)
+    if chromosome_key is not None:
+        logger.info('Streaming %d sorted files' % len(args.files))
+        clusters = merge_sorted_files(args.files, args.gap, chromosome_key)
+    else:
+        clusters = merge_files(args.files, args.gap, not args.no_cache, args.rebuild_cache)
+    with open(args.o, 'w') as fid:
+        (written, total) = write_clusters(fid, clusters, args.files, args.min_support)
+    logger.info('Wrote %d of %d clusters to %s' % (written, total, args.o))
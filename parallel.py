@@ -0,0 +1,119 @@
+# parallel.py ---
+#
+# Description: Per-chromosome process pool.
+#
+# Large inputs are handed to the workers by fork rather than by pickling:
+# share() stores the tables in a module-level dict before the pool is
+# created, so each worker inherits the numpy arrays (or the memory-mapped
+# cache files, see bed_loader.load_table) and a task only carries a
+# chromosome name. Results come back in task order whatever order the
+# workers finish in.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import os
+import time
+import unittest
+import multiprocessing
+
+''' Objects inherited by worker processes, see share() '''
+_shared = dict()
+
+
+############################################################
+# Data inherited by the workers
+############################################################
+def share(**objects):
+    ''' Makes objects available to workers (through shared()) created after this call '''
+    _shared.update(objects)
+
+def shared(name):
+    ''' Object stored by share() under name '''
+    return _shared[name]
+
+def clear(*names):
+    ''' Drops the named shared objects (all of them if no name is given) '''
+    if len(names) == 0:
+        _shared.clear()
+    for name in names:
+        _shared.pop(name, None)
+
+
+############################################################
+# Task map
+############################################################
+def map_tasks(function, tasks, jobs=1, weights=None):
+    '''
+    Applies function to every task, using a pool of jobs processes if jobs > 1
+
+    @arg function: module-level function of one argument
+    @arg tasks: list of task arguments (e.g. chromosome names)
+    @arg jobs: number of worker processes
+    @arg weights: estimated cost per task - heavier tasks are submitted first
+    @return list of results in the order of tasks
+    '''
+    tasks = list(tasks)
+    if weights is None:
+        order = range(len(tasks))
+    else:
+        order = sorted(range(len(tasks)), key=lambda k: -weights[k])
+    results = [None] * len(tasks)
+    if jobs <= 1 or len(tasks) <= 1:
+        for k in order:
+            results[k] = function(tasks[k])
+        return results
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        pending = [(k, pool.apply_async(function, (tasks[k],))) for k in order]
+        for (k, result) in pending:
+            results[k] = result.get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+
+def shared_task(task):
+    ''' Test task: sleeps, then returns (pid, task, shared objects named in task or None if missing) '''
+    (names, delay) = task
+    time.sleep(delay)
+    return (os.getpid(), task, [_shared.get(name) for name in names])
+
+class TestParallel(unittest.TestCase):
+    def tearDown(self):
+        clear()
+
+    def test_task_order(self):
+        ## heavy tasks are submitted first and the short ones finish first
+        tasks = [(('offsets',), 0.01 * (k % 3)) for k in range(9)]
+        weights = [9 - k for k in range(9)]
+        share(offsets=range(5))
+        for jobs in [1, 3]:
+            results = map_tasks(shared_task, tasks, jobs, weights)
+            self.assertEqual([task for (pid, task, objects) in results], tasks)
+            self.assertTrue(all(objects == [range(5)] for (pid, task, objects) in results))
+        pids = set(pid for (pid, task, objects) in map_tasks(shared_task, tasks, 3, weights))
+        self.assertTrue(os.getpid() not in pids)
+        self.assertEqual(map_tasks(shared_task, [], 3), [])
+
+    def test_share_and_clear(self):
+        share(table=[1, 2], rows={'chr1': [0]})
+        self.assertEqual(shared('table'), [1, 2])
+        results = map_tasks(shared_task, [(('table', 'rows'), 0)] * 2, 2)
+        self.assertEqual([objects for (pid, task, objects) in results], [[[1, 2], {'chr1': [0]}]] * 2)
+        clear('table', 'missing')
+        self.assertRaises(KeyError, shared, 'table')
+        self.assertEqual(shared('rows'), {'chr1': [0]})
+        ## workers forked after clear() do not see the dropped objects
+        results = map_tasks(shared_task, [(('table', 'rows'), 0)] * 2, 2)
+        self.assertEqual([objects for (pid, task, objects) in results], [[None, {'chr1': [0]}]] * 2)
+        clear()
+        self.assertEqual(_shared, dict())
+
+if __name__ == '__main__':
+    unittest.main()
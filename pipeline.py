@@ -0,0 +1,283 @@
+# pipeline.py ---
+#
+# Description: Reader / compute / writer stages connected by bounded queues.
+#
+# read_ahead() iterates an input (e.g. the blocks parsed by
+# bed_loader.iter_tables, which reads the file in fixed-size byte chunks)
+# in a reader thread, while the calling thread computes on the batches.
+# The calling thread formats each output batch into one string, and a
+# BatchWriter thread writes the strings of each file in large write()
+# calls. The queues hold at most QUEUE_DEPTH batches, so reading and
+# writing overlap with computing while memory stays bounded. The file
+# reads and writes, the decompression and most numpy operations release
+# the GIL; formatting lines in Python does not, so it is left to the
+# calling thread rather than to a thread competing for the GIL.
+#
+# An exception raised in a stage is raised again in the calling thread.
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import sys
+import Queue
+import threading
+import itertools
+import unittest
+
+############################################################
+# Global parameters
+############################################################
+''' Batches held by each queue between two stages '''
+QUEUE_DEPTH = 4
+
+''' Formatted bytes collected per file before a write() call '''
+WRITE_BUFFER_SIZE = 1 << 22
+
+''' Records per batch when a stream of records is batched (see batches) '''
+BATCH_RECORDS = 1 << 14
+
+''' Seconds between checks for a stopped consumer while a queue is full '''
+POLL_INTERVAL = 0.1
+
+_END = object()
+
+
+def batches(iterable, size=BATCH_RECORDS):
+    ''' Generator over lists of at most size consecutive items of iterable '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+############################################################
+# Reader stage
+############################################################
+def _put(queue, item, stopped):
+    ''' Puts item into a bounded queue; False if stopped was set while waiting '''
+    while not stopped.is_set():
+        try:
+            queue.put(item, timeout=POLL_INTERVAL)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def read_ahead(iterable, depth=QUEUE_DEPTH, batch_size=None):
+    '''
+    Generator over the items of iterable, produced by a reader thread
+
+    @arg depth: the reader stays at most depth items (batches) ahead
+    @arg batch_size: hand the items over in lists of batch_size items
+                     (for streams of small records)
+    '''
+    queue = Queue.Queue(depth)
+    stopped = threading.Event()
+    def read():
+        try:
+            source = iterable if batch_size is None else batches(iterable, batch_size)
+            for item in source:
+                if not _put(queue, (item, None), stopped):
+                    return
+            _put(queue, (_END, None), stopped)
+        except BaseException:
+            _put(queue, (_END, sys.exc_info()), stopped)
+    reader = threading.Thread(target=read, name='reader')
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            (item, error) = queue.get()
+            if item is _END:
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                return
+            if batch_size is None:
+                yield item
+            else:
+                for x in item:
+                    yield x
+    finally:
+        stopped.set()
+        reader.join()
+
+
+############################################################
+# Writer stage
+############################################################
+class BatchWriter:
+    '''
+    Writer thread
+
+    writer.write(fid, data) queues the string data to be written to fid by
+    the writer thread. The strings of each file are joined and written
+    once WRITE_BUFFER_SIZE bytes are pending. Strings are written in the
+    order they are queued.
+
+    Use as a context manager, or call close(); files are flushed by
+    flush() / close_file() / close() and closed by close_file().
+    '''
+    def __init__(self, depth=QUEUE_DEPTH, buffer_size=WRITE_BUFFER_SIZE):
+        self.queue = Queue.Queue(depth)
+        self.buffer_size = buffer_size
+        self.error = None
+        self.pending = dict()
+        self.thread = threading.Thread(target=self.run, name='writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None)
+
+    def run(self):
+        while True:
+            (action, fid, data) = self.queue.get()
+            try:
+                if self.error is None:
+                    if action == 'write':
+                        self.append(fid, data)
+                    elif action == 'close':
+                        self.flush_file(fid)
+                        fid.close()
+                    elif action in ('flush', 'end'):
+                        for fid in self.pending.keys():
+                            self.flush_file(fid)
+            except BaseException:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+            if action == 'end':
+                return
+
+    def append(self, fid, data):
+        (buffers, size) = self.pending.get(fid, ([], 0))
+        buffers.append(data)
+        size += len(data)
+        self.pending[fid] = (buffers, size)
+        if size >= self.buffer_size:
+            self.flush_file(fid)
+
+    def flush_file(self, fid):
+        (buffers, size) = self.pending.pop(fid, ([], 0))
+        if size > 0:
+            fid.write(''.join(buffers))
+
+    def check(self):
+        ''' Raises the exception of the writer thread, if any, in the calling thread '''
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error[0], error[1], error[2]
+
+    def write(self, fid, data):
+        ''' Queues the string data to be written to fid '''
+        self.check()
+        self.queue.put(('write', fid, data))
+
+    def close_file(self, fid):
+        ''' Queues flushing and closing fid after the batches already queued '''
+        self.check()
+        self.queue.put(('close', fid, None))
+
+    def flush(self):
+        ''' Waits until everything queued so far is written '''
+        self.queue.put(('flush', None, None))
+        self.queue.join()
+        self.check()
+
+    def close(self, check=True):
+        ''' Writes everything queued and stops the thread (re-raising its exception if check) '''
+        if self.thread.is_alive():
+            self.queue.put(('end', None, None))
+            self.thread.join()
+        if check:
+            self.check()
+
+
+class RecordingFile:
+    ''' File-like object that records its write() and close() calls '''
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def write(self, data):
+        if self.fail:
+            raise IOError('disk full')
+        self.calls.append(('write', data))
+
+    def close(self):
+        self.calls.append(('close', None))
+
+class TestPipeline(unittest.TestCase):
+    def test_read_ahead(self):
+        self.assertEqual(list(read_ahead(xrange(100), depth=2)), range(100))
+        self.assertEqual(list(read_ahead(xrange(100), depth=2, batch_size=7)), range(100))
+
+    def test_reader_error(self):
+        def source():
+            for i in range(5):
+                yield i
+            raise ValueError('bad line')
+        for batch_size in [None, 2]:
+            items = []
+            with self.assertRaises(ValueError):
+                for item in read_ahead(source(), depth=1, batch_size=batch_size):
+                    items.append(item)
+            self.assertEqual(items, range(5) if batch_size is None else range(4))
+
+    def test_early_stop(self):
+        produced = []
+        def source():
+            for i in itertools.count():
+                produced.append(i)
+                yield i
+        for batch_size in [None, 3]:
+            del produced[:]
+            items = read_ahead(source(), depth=2, batch_size=batch_size)
+            self.assertEqual([next(items) for i in range(5)], range(5))
+            ## closing the generator must stop the reader, which is blocked on the full queue
+            closer = threading.Thread(target=items.close)
+            closer.start()
+            closer.join(10)
+            self.assertFalse(closer.is_alive())
+            ## at most the batches handed over, depth queued and one being queued
+            size = batch_size or 1
+            self.assertTrue(len(produced) <= ((5 + size - 1) // size + 2 + 1) * size)
+
+    def test_close_file(self):
+        fid = RecordingFile()
+        other = RecordingFile()
+        with BatchWriter(depth=1, buffer_size=10) as writer:
+            for i in range(20):
+                writer.write(fid, '%d\n' % i)
+                writer.write(other, 'x')
+            writer.close_file(fid)
+            writer.flush()
+            self.assertEqual(fid.calls[-1], ('close', None))
+            self.assertEqual(''.join(data for (call, data) in fid.calls[:-1]), ''.join('%d\n' % i for i in range(20)))
+            writer.write(other, 'y')
+        self.assertEqual(''.join(data for (call, data) in other.calls), 'x' * 20 + 'y')
+
+    def test_writer_error(self):
+        writer = BatchWriter(buffer_size=1)
+        writer.write(RecordingFile(fail=True), 'data')
+        self.assertRaises(IOError, writer.flush)
+        ## the error is raised once, later batches are written again
+        fid = RecordingFile()
+        writer.write(fid, 'more')
+        writer.close()
+        self.assertEqual(fid.calls, [('write', 'more')])
+        writer = BatchWriter()
+        writer.write(RecordingFile(fail=True), 'data')
+        self.assertRaises(IOError, writer.close)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# rpkm_fold_change.py ---
+#
+# USAGE: python rpkm_fold_change.py [--pair CONTROL:TREATMENT ...] [--fold F ...] [--pseudocount P] RPKM_FILE
+#
+# Description: Classifies genes as up-regulated, down-regulated or
+# unchanged between pairs of samples of an RPKM table. Replaces
+# final_rpkm_2fold_upreg.pl and final_rpkm_2fold_downreg.pl, which read
+# GSE27463_RefSeq.reg.threecolumn once per test.
+#
+# Input format (tab-separated, optional header line):
+#
+# GENE    RPKM_SAMPLE1    RPKM_SAMPLE2    ...
+#
+# For a pair (control, treatment), fold F and pseudocount P a gene is
+#
+#   up        if treatment + P >= F * (control + P)
+#   down      if control + P >= F * (treatment + P)
+#   unchanged otherwise, or if both tests pass
+#
+# For P = 0, F = 2 and the pair 1:2 the up and down tests are those of the
+# two Perl scripts, with one difference: genes passing both tests (both
+# values 0 for F > 1) are written to both files by the Perl scripts and
+# are unchanged here. Each (pair, fold) writes PREFIXCONTROL_TREATMENT_foldF_up.txt
+# and ..._down.txt (and ..._unchanged.txt with --write_unchanged) with the
+# output lines of the Perl scripts:
+#
+# GENE    RPKM_CONTROL    RPKM_TREATMENT
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import unittest
+
+import numpy
+
+from logger import logger
+from bgzf import open_input
+
+############################################################
+# Global parameters
+############################################################
+''' Separator of input and output columns '''
+SEPARATOR = '\t'
+
+''' Fold threshold of the Perl scripts '''
+FOLD = 2.0
+
+''' Classes written for each (pair, fold) '''
+UP = 1
+DOWN = -1
+UNCHANGED = 0
+CLASS_NAMES = [(UP, 'up'), (DOWN, 'down'), (UNCHANGED, 'unchanged')]
+
+
+############################################################
+# Reading the RPKM table
+############################################################
+def read_rpkm_table(file_name, separator=SEPARATOR):
+    '''
+    Reads an RPKM table
+
+    @arg file_name: tab-separated file with gene name and sample columns
+    @return (sample_names, gene_names, values, columns) where values is a
+            genes x samples float array and columns[k] is the unparsed text
+            of the sample columns of gene k
+    '''
+    gene_names = []
+    columns = []
+    sample_names = None
+    with open_input(file_name) as fid:
+        for line in fid:
+            line = line.rstrip('\r\n')
+            if line == '' or line.startswith('#'):
+                continue
+            parts = line.split(separator, 1)
+            rest = parts[1] if len(parts) > 1 else ''
+            if sample_names is None and len(gene_names) == 0 and not is_numeric_row(rest, separator):
+                sample_names = rest.split(separator)
+                continue
+            gene_names.append(parts[0])
+            columns.append(rest)
+    num_samples = len(columns[0].split(separator)) if len(columns) > 0 else 0
+    values = numpy.fromstring(' '.join(columns).replace(separator, ' '), dtype=numpy.float64, sep=' ')
+    if len(values) != len(columns) * num_samples:
+        raise ValueError('%s: all lines must have %d numeric sample columns' % (file_name, num_samples))
+    values = values.reshape((len(columns), num_samples))
+    if sample_names is None:
+        sample_names = [str(k + 1) for k in range(num_samples)]
+    return (sample_names, gene_names, values, columns)
+
+def is_numeric_row(rest, separator=SEPARATOR):
+    ''' True if all columns are numbers '''
+    try:
+        [float(x) for x in rest.split(separator)]
+    except ValueError:
+        return False
+    return True
+
+def sample_index(sample, sample_names):
+    ''' Column index of a sample given by name or 1-based column number '''
+    if sample in sample_names:
+        return sample_names.index(sample)
+    if sample.isdigit() and 1 <= int(sample) <= len(sample_names):
+        return int(sample) - 1
+    raise ValueError('Unknown sample %s (samples: %s)' % (sample, ', '.join(sample_names)))
+
+
+############################################################
+# Classification
+############################################################
+def classify(values, pairs, folds, pseudocount=0.0):
+    '''
+    Classifies all genes for every (pair, fold) at once
+
+    @arg values: genes x samples array
+    @arg pairs: list of (control column, treatment column)
+    @arg folds: list of fold thresholds
+    @arg pseudocount: added to both values before the fold test
+    @return genes x pairs x folds int8 array of UP, DOWN or UNCHANGED
+    '''
+    pairs = numpy.asarray(pairs, dtype=numpy.intp).reshape((-1, 2))
+    folds = numpy.asarray(folds, dtype=numpy.float64)
+    control = values[:, pairs[:, 0]][:, :, numpy.newaxis] + pseudocount
+    treatment = values[:, pairs[:, 1]][:, :, numpy.newaxis] + pseudocount
+    up = treatment >= folds * control
+    down = control >= folds * treatment
+    classes = numpy.zeros(up.shape, dtype=numpy.int8)
+    classes[up & ~down] = UP
+    classes[down & ~up] = DOWN
+    return classes
+
+def write_classes(file_prefix, classes, pairs, folds, sample_names, gene_names, columns, write_unchanged=False, separator=SEPARATOR):
+    '''
+    Writes one file per (pair, fold, class) with GENE RPKM_CONTROL RPKM_TREATMENT lines
+
+    @return dict file name -> number of genes written
+    '''
+    written = dict()
+    for (p, (control, treatment)) in enumerate(pairs):
+        selected = numpy.flatnonzero((classes[:, p, :] != UNCHANGED).any(axis=1) | write_unchanged)
+        lines = []
+        for k in selected.tolist():
+            fields = columns[k].split(separator)
+            lines.append(separator.join([gene_names[k], fields[control], fields[treatment]]) + '\n')
+        for (f, fold) in enumerate(folds):
+            gene_classes = classes[selected, p, f]
+            for (value, name) in CLASS_NAMES:
+                if value == UNCHANGED and not write_unchanged:
+                    continue
+                file_name = '%s%s_%s_fold%g_%s.txt' % (file_prefix, sample_names[control], sample_names[treatment], fold, name)
+                rows = numpy.flatnonzero(gene_classes == value)
+                with open(file_name, 'w') as fid:
+                    fid.writelines(lines[k] for k in rows.tolist())
+                written[file_name] = len(rows)
+                logger.info('%s: %d genes' % (file_name, len(rows)))
+    return written
+
+
+class TestRpkmFoldChange(unittest.TestCase):
+    def test_classify(self):
+        ## control, treatment
+        values = numpy.array([[1.0, 2.0], [2.0, 1.0], [1.0, 1.9], [0.0, 0.0], [0.0, 0.5], [4.0, 12.0], [3.0, 3.0]])
+        classes = classify(values, [(0, 1), (1, 0)], [2.0, 3.0])
+        self.assertEqual(classes[:, 0, 0].tolist(), [UP, DOWN, UNCHANGED, UNCHANGED, UP, UP, UNCHANGED])
+        self.assertEqual(classes[:, 0, 1].tolist(), [UNCHANGED, UNCHANGED, UNCHANGED, UNCHANGED, UP, UP, UNCHANGED])
+        ## swapped pair
+        self.assertEqual(classes[:, 1, :].tolist(), (-classes[:, 0, :]).tolist())
+        ## pseudocount: (0.5 + 1) < 2 * (0 + 1)
+        classes = classify(values, [(0, 1)], [2.0], pseudocount=1.0)
+        self.assertEqual(classes[:, 0, 0].tolist(), [UNCHANGED, UNCHANGED, UNCHANGED, UNCHANGED, UNCHANGED, UP, UNCHANGED])
+        ## fold 1: equal values pass both tests
+        self.assertEqual(classify(values[[3, 6]], [(0, 1)], [1.0])[:, 0, 0].tolist(), [UNCHANGED, UNCHANGED])
+
+    def test_both_zero(self):
+        ## the Perl tests treatment >= 2 * control and control >= 2 * treatment both hold
+        values = numpy.array([[0.0, 0.0]])
+        self.assertTrue((values[:, 1] >= 2 * values[:, 0]).all() and (values[:, 0] >= 2 * values[:, 1]).all())
+        self.assertEqual(classify(values, [(0, 1)], [FOLD]).tolist(), [[[UNCHANGED]]])
+
+    def test_tables(self):
+        work_dir = tempfile.mkdtemp(prefix='rpkm_fold_change_')
+        try:
+            rows = 'g1\t1\t2.5\t0\ng2\t4\t1\t0\ng3\t0\t0\t7\n'
+            for (name, header) in [('header', 'gene\tctrl\ttreat\tother\n'), ('plain', '')]:
+                file_name = os.path.join(work_dir, name + '.txt')
+                with open(file_name, 'w') as fid:
+                    fid.write(header + rows)
+                (sample_names, gene_names, values, columns) = read_rpkm_table(file_name)
+                self.assertEqual(sample_names, ['ctrl', 'treat', 'other'] if header else ['1', '2', '3'])
+                self.assertEqual(gene_names, ['g1', 'g2', 'g3'])
+                self.assertEqual(values.tolist(), [[1, 2.5, 0], [4, 1, 0], [0, 0, 7]])
+                pairs = [(sample_index(sample_names[0], sample_names), sample_index('2', sample_names))]
+                prefix = os.path.join(work_dir, name + '_')
+                written = write_classes(prefix, classify(values, pairs, [2.0]), pairs, [2.0], sample_names, gene_names, columns, write_unchanged=True)
+                up = '%s%s_%s_fold2_up.txt' % (prefix, sample_names[0], sample_names[1])
+                self.assertEqual(sorted(written.values()), [1, 1, 1])
+                with open(up) as fid:
+                    self.assertEqual(fid.read(), 'g1\t1\t2.5\n')
+                with open(up.replace('_up.', '_down.')) as fid:
+                    self.assertEqual(fid.read(), 'g2\t4\t1\n')
+                with open(up.replace('_up.', '_unchanged.')) as fid:
+                    self.assertEqual(fid.read(), 'g3\t0\t0\n')
+            self.assertRaises(ValueError, sample_index, 'missing', ['ctrl', 'treat'])
+        finally:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classifies genes as up, down or unchanged between pairs of samples of an RPKM table.')
+    parser.add_argument('rpkm_file', metavar='RPKM_FILE', type=str, help='Tab-separated file: GENE RPKM_SAMPLE1 RPKM_SAMPLE2 ... (optional header line)')
+    parser.add_argument('--pair', metavar='CONTROL:TREATMENT', type=str, action='append', default=None, help='Samples to compare, by header name or 1-based sample column (default: 1:2); can be repeated')
+    parser.add_argument('--fold', metavar='F', type=float, nargs='+', default=[FOLD], help='Fold thresholds (default: %g)' % FOLD)
+    parser.add_argument('--pseudocount', metavar='P', type=float, default=0.0, help='Added to RPKM values before the fold test (default: 0)')
+    parser.add_argument('--write_unchanged', action='store_true', help='Also write the unchanged genes')
+    parser.add_argument('-p', metavar='PREFIX', type=str, default='', help='Prefix of the output files (default: none)')
+    args = parser.parse_args(sys.argv[1:])
+
+    (sample_names, gene_names, values, columns) = read_rpkm_table(args.rpkm_file)
+    logger.info('%s: %d genes, %d samples' % (args.rpkm_file, values.shape[0], values.shape[1]))
+    pairs = []
+    for pair in (args.pair or ['1:2']):
+        (control, treatment) = pair.split(':')
+        pairs.append((sample_index(control, sample_names), sample_index(treatment, sample_names)))
+    classes = classify(values, pairs, args.fold, args.pseudocount)
+    write_classes(args.p, classes, pairs, args.fold, sample_names, gene_names, columns, args.write_unchanged)
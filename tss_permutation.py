@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# tss_permutation.py ---
+#
+# USAGE: python tss_permutation.py [-n SAMPLES] [-d DISTANCE ...] [--seed SEED] [--jobs N] [-p PREFIX] GENE_FILE SIGNAL_FILE TARGET_FILE
+#
+# Description: Permutation test for the number of ChIP signals near the
+# TSSs of a set of target genes, producing the input files of
+# plot_statisticalanalysis.R.
+#
+# The statistic for a gene set and a distance d is the number of
+# (gene, signal) pairs with the signal overlapping [TSS - d, TSS + d]. The
+# count of every gene is computed once for all distances with an
+# AnchorIndex, so a random gene set only costs a sum over its genes.
+# Random sets of the size of the target set are drawn without replacement
+# from all genes, in chunks with seeds derived from --seed, so the null
+# distributions do not depend on --jobs.
+#
+# Input files:
+#   GENE_FILE    BED6 genes (chromosome, start, end, name, score, strand);
+#                the TSS is the end of - strand genes and the start otherwise
+#   SIGNAL_FILE  BED file of ChIP signals
+#   TARGET_FILE  names of the target genes, one per line
+#
+# Output files (see plot_statisticalanalysis.R):
+#   PREFIX_TotalGenes<N>Samples_<distance>  null distribution, one count per sample
+#   PREFIX_<D>Signals                        observed count per distance
+#   PREFIX_pvalues                           empirical p-values per distance
+#
+# Change Log:
+#
+#
+
+# Code:
+
+import sys
+import argparse
+import unittest
+
+import numpy
+
+from logger import logger
+from bgzf import open_input
+from bed_loader import read_table, parse_block, STRAND_MINUS
+import parallel
+from AnchorIndex import table_neighborhoods
+
+############################################################
+# Global parameters
+############################################################
+''' TSS distances of plot_statisticalanalysis.R '''
+DISTANCES = [10000, 1000000, 2000000]
+
+''' Number of random gene sets '''
+NUM_SAMPLES = 1000
+
+''' Random gene sets drawn per task '''
+CHUNK_SIZE = 250
+
+
+############################################################
+# Signal counts per gene
+############################################################
+def tss_positions(genes):
+    ''' TSS of each gene of an IntervalTable (end for - strand, start otherwise) '''
+    return numpy.where(genes.strand == STRAND_MINUS, genes.end, genes.start)
+
+def gene_signal_counts(genes, signals, distances=DISTANCES):
+    '''
+    Number of signals within each distance of each TSS
+
+    @arg genes: IntervalTable of genes
+    @arg signals: IntervalTable of ChIP signals
+    @arg distances: list of distances
+    @return genes x distances int64 array
+    '''
+    return table_neighborhoods(genes, tss_positions(genes), signals, distances)
+
+
+############################################################
+# Permutations
+############################################################
+def permutation_chunk(task):
+    '''
+    Statistics of one chunk of random gene sets - runs in the worker processes
+
+    @arg task: (seed, number of gene sets)
+    @return gene sets x distances array
+    '''
+    (seed, num_samples) = task
+    counts = parallel.shared('gene_counts')
+    sample_size = parallel.shared('sample_size')
+    random = numpy.random.RandomState(seed)
+    null = numpy.zeros((num_samples, counts.shape[1]), dtype=numpy.int64)
+    for k in range(num_samples):
+        null[k] = counts[random.choice(len(counts), sample_size, replace=False)].sum(axis=0)
+    return null
+
+def permutation_null(counts, sample_size, num_samples=NUM_SAMPLES, seed=0, jobs=1, chunk_size=CHUNK_SIZE):
+    '''
+    Null distribution of the statistic over random gene sets
+
+    @arg counts: genes x distances array from gene_signal_counts()
+    @arg sample_size: number of genes per random set
+    @arg num_samples: number of random sets
+    @arg seed: seed of the random sets
+    @arg jobs: number of worker processes
+    @return num_samples x distances array
+    '''
+    if sample_size > len(counts):
+        raise ValueError('Cannot draw %d of %d genes' % (sample_size, len(counts)))
+    chunks = [min(chunk_size, num_samples - first) for first in range(0, num_samples, chunk_size)]
+    seeds = numpy.random.RandomState(seed).randint(0, 2 ** 31 - 1, len(chunks)).tolist()
+    parallel.share(gene_counts=counts, sample_size=sample_size)
+    try:
+        nulls = parallel.map_tasks(permutation_chunk, zip(seeds, chunks), jobs)
+    finally:
+        parallel.clear('gene_counts', 'sample_size')
+    if len(nulls) == 0:
+        return numpy.zeros((0, counts.shape[1]), dtype=numpy.int64)
+    return numpy.concatenate(nulls)
+
+def empirical_p_values(null, observed):
+    '''
+    One-sided empirical p-values (1 + #{null >= observed}) / (N + 1) and (1 + #{null <= observed}) / (N + 1)
+
+    @return (p_greater, p_less) arrays, one value per distance
+    '''
+    num_samples = len(null)
+    p_greater = (1.0 + (null >= observed).sum(axis=0)) / (num_samples + 1)
+    p_less = (1.0 + (null <= observed).sum(axis=0)) / (num_samples + 1)
+    return (p_greater, p_less)
+
+
+############################################################
+# Input and output files
+############################################################
+def gene_names(genes):
+    ''' Name column (column 4) of an IntervalTable of genes '''
+    return [rest.split('\t', 1)[0] for rest in genes.rest_of_line()]
+
+def read_target_genes(file_name):
+    ''' Gene names in the first column of a file '''
+    names = []
+    with open_input(file_name) as fid:
+        for line in fid:
+            parts = line.split()
+            if len(parts) > 0 and not line.startswith('#'):
+                names.append(parts[0])
+    return names
+
+def write_results(prefix, distances, null, observed):
+    ''' Writes the null distributions, observed counts and p-values '''
+    for (i, distance) in enumerate(distances):
+        file_name = '%s_TotalGenes%dSamples_%d' % (prefix, len(null), distance)
+        with open(file_name, 'w') as fid:
+            print >> fid, 'count'
+            fid.writelines('%d\n' % x for x in null[:, i].tolist())
+        logger.info('Wrote null distribution for distance %d to %s' % (distance, file_name))
+    with open('%s_%dSignals' % (prefix, len(distances)), 'w') as fid:
+        print >> fid, 'count'
+        fid.writelines('%d\n' % x for x in observed.tolist())
+    (p_greater, p_less) = empirical_p_values(null, observed)
+    with open(prefix + '_pvalues', 'w') as fid:
+        print >> fid, '\t'.join(['distance', 'observed', 'null_mean', 'null_sd', 'p_greater', 'p_less'])
+        for (i, distance) in enumerate(distances):
+            print >> fid, '\t'.join([str(distance), str(observed[i]), '%g' % null[:, i].mean(), '%g' % null[:, i].std(), '%g' % p_greater[i], '%g' % p_less[i]])
+            logger.info('distance %d: observed %d, p(null >= observed) = %g' % (distance, observed[i], p_greater[i]))
+
+
+class TestTssPermutation(unittest.TestCase):
+    def test_tss_positions(self):
+        genes = parse_block('chr1\t100\t200\tg1\t0\t+\n'
+                            'chr1\t300\t400\tg2\t0\t-\n'
+                            'chr2\t500\t600\tg3\t0\t.\n'
+                            'chr2\t700\t800\tg4\n', with_rest=True)
+        self.assertEqual(tss_positions(genes).tolist(), [100, 400, 500, 700])
+        self.assertEqual(gene_names(genes), ['g1', 'g2', 'g3', 'g4'])
+
+    def test_permutation_null(self):
+        counts = numpy.random.RandomState(0).randint(0, 20, (50, 3))
+        null = permutation_null(counts, 7, num_samples=23, seed=5, chunk_size=4)
+        self.assertEqual(null.shape, (23, 3))
+        ## the random sets only depend on the seed
+        self.assertEqual(permutation_null(counts, 7, num_samples=23, seed=5, jobs=2, chunk_size=4).tolist(), null.tolist())
+        self.assertNotEqual(permutation_null(counts, 7, num_samples=23, seed=6, chunk_size=4).tolist(), null.tolist())
+        ## drawing all genes gives the total
+        self.assertEqual(permutation_null(counts, 50, num_samples=3).tolist(), [counts.sum(axis=0).tolist()] * 3)
+        self.assertRaises(ValueError, permutation_null, counts, 51)
+
+    def test_empirical_p_values(self):
+        null = numpy.array([[1, 10], [2, 10], [3, 10], [4, 10]])
+        (p_greater, p_less) = empirical_p_values(null, numpy.array([3, 5]))
+        ## distance 1: 2 of 4 null values >= 3, 3 of 4 <= 3; distance 2: all >= 5, none <= 5
+        self.assertEqual(p_greater.tolist(), [3 / 5.0, 5 / 5.0])
+        self.assertEqual(p_less.tolist(), [4 / 5.0, 1 / 5.0])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Permutation test for the number of ChIP signals near the TSSs of target genes.')
+    parser.add_argument('gene_file', metavar='GENE_FILE', type=str, help='BED6 file of genes (name in column 4, strand in column 6)')
+    parser.add_argument('signal_file', metavar='SIGNAL_FILE', type=str, help='BED file of ChIP signals')
+    parser.add_argument('target_file', metavar='TARGET_FILE', type=str, help='Names of the target genes, one per line')
+    parser.add_argument('-n', metavar='SAMPLES', type=int, default=NUM_SAMPLES, help='Number of random gene sets (default: %d)' % NUM_SAMPLES)
+    parser.add_argument('-d', metavar='DISTANCE', type=int, nargs='+', default=DISTANCES, help='Distances from the TSS (default: %s)' % ' '.join(str(d) for d in DISTANCES))
+    parser.add_argument('-p', metavar='PREFIX', type=str, default='signal', help='Prefix of the output files (default: signal)')
+    parser.add_argument('--seed', metavar='SEED', type=int, default=0, help='Seed of the random gene sets (default: 0)')
+    parser.add_argument('--jobs', metavar='N', type=int, default=1, help='Draw random gene sets in N worker processes (default: 1)')
+    args = parser.parse_args(sys.argv[1:])
+
+    genes = read_table(args.gene_file, with_rest=True)
+    signals = read_table(args.signal_file)
+    counts = gene_signal_counts(genes, signals, args.d)
+
+    targets = set(read_target_genes(args.target_file))
+    is_target = numpy.array([name in targets for name in gene_names(genes)], dtype=bool)
+    logger.info('%d of %d target genes found in %s' % (is_target.sum(), len(targets), args.gene_file))
+    observed = counts[is_target].sum(axis=0)
+    null = permutation_null(counts, int(is_target.sum()), args.n, args.seed, args.jobs)
+    write_results(args.p, args.d, null, observed)
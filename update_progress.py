@@ -1,5 +1,8 @@
 
 import sys 
+import time
+import resource
+import unittest
 
 ''' Number of lines after which to update progress counter '''
 PROGRESS_DELAY = 1000
@@ -41,7 +44,7 @@ def update_progress(progress, operation='Progress',  max_iter=None, skip_lines=P
         if progress >= 1:
 			progress = 1
 			status = "Done...\r\n"
-    elif (max_iter > skip_lines) and ( progress % skip_lines is 0): 
+    elif (max_iter > skip_lines) and ( progress % skip_lines == 0): 
         update_progress_flag = True
         progress = float(progress) / max_iter
 	## do not update each iteration 
@@ -50,3 +53,191 @@ def update_progress(progress, operation='Progress',  max_iter=None, skip_lines=P
 		text = "\r{0: <40}: [{1}] {2}% {3}".format(operation, "#"*block + "-"*(barLength-block), progress*100, status)
 		sys.stderr.write(text)
 		sys.stderr.flush()
+
+
+''' Minimum time between two redraws of a ProgressReporter (seconds) '''
+REDRAW_INTERVAL = 0.2
+
+
+############################################################
+# Rate-limited progress and throughput reporter
+############################################################
+def current_rss():
+    ''' Resident set size of this process in bytes (peak RSS if /proc is not available) '''
+    try:
+        with open('/proc/self/statm', 'r') as fid:
+            return int(fid.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def format_bytes(num_bytes):
+    ''' Human readable byte count '''
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024:
+            return '%.1f %s' % (num_bytes, unit)
+        num_bytes = num_bytes / 1024.0
+    return '%.1f TB' % num_bytes
+
+class ProgressReporter:
+    '''
+    Progress bar with records/s, ETA, bytes read and RSS
+
+    Callers report work in batches with update(); the line is redrawn at
+    most every interval seconds, so an update costs one clock() call.
+    Disabled unless the stream is a terminal.
+
+    USAGE:
+        with ProgressReporter('Reading ' + file_name, total_bytes=size) as progress:
+            for table in iter_tables(file_name):
+                progress.update(len(table), table.rest_end[-1])
+    '''
+    def __init__(self, operation='Progress', total=None, total_bytes=None, interval=REDRAW_INTERVAL, stream=None, enabled=None, clock=time.time):
+        '''
+        @arg operation: What to show before progress bar
+        @arg total: expected number of records (for percentage and ETA)
+        @arg total_bytes: expected number of bytes read (used if total is not given)
+        @arg interval: minimum number of seconds between redraws
+        @arg stream: output stream (default: sys.stderr)
+        @arg enabled: draw progress (default: only if stream is a terminal)
+        @arg clock: function returning the current time in seconds
+        '''
+        self.operation = operation
+        self.total = total
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.stream = sys.stderr if stream is None else stream
+        if enabled is None:
+            enabled = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.enabled = enabled
+        self.clock = clock
+        self.records = 0
+        self.bytes_read = 0
+        self.start_time = clock()
+        self.next_draw = self.start_time
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def update(self, records=0, bytes_read=None):
+        '''
+        Reports progress
+
+        @arg records: number of records processed since the last call
+        @arg bytes_read: total number of bytes read so far
+        '''
+        self.records = self.records + records
+        if bytes_read is not None:
+            self.bytes_read = bytes_read
+        if self.enabled:
+            now = self.clock()
+            if now >= self.next_draw:
+                self.next_draw = now + self.interval
+                self.draw(now)
+
+    def fraction(self):
+        ''' Fraction of the work done, None if the total is not known '''
+        if self.total:
+            return min(float(self.records) / self.total, 1.0)
+        if self.total_bytes:
+            return min(float(self.bytes_read) / self.total_bytes, 1.0)
+        return None
+
+    def draw(self, now=None, status=''):
+        ''' Redraws the progress line '''
+        barLength = 10 # Modify this to change the length of the progress bar
+        if now is None:
+            now = self.clock()
+        elapsed = max(now - self.start_time, 1e-9)
+        rate = self.records / elapsed
+        progress = self.fraction()
+        parts = ['\r{0: <40}:'.format(self.operation)]
+        if progress is not None:
+            block = int(round(barLength*progress))
+            parts.append('[{0}] {1:5.1f}%'.format("#"*block + "-"*(barLength-block), progress*100))
+        parts.append('%d records %.0f records/s' % (self.records, rate))
+        if progress is not None and progress > 0 and progress < 1:
+            parts.append('ETA %ds' % int(elapsed * (1 - progress) / progress))
+        if self.bytes_read > 0:
+            parts.append(format_bytes(self.bytes_read) + ' read')
+        parts.append('RSS ' + format_bytes(current_rss()))
+        parts.append(status)
+        self.stream.write(' '.join(parts))
+        self.stream.flush()
+
+    def close(self):
+        ''' Draws the final state and ends the line '''
+        if self.enabled:
+            self.enabled = False
+            self.draw(status='Done...\n')
+
+
+class FakeStream:
+    ''' Output stream recording what is written '''
+    def __init__(self, tty):
+        self.tty = tty
+        self.text = ''
+
+    def isatty(self):
+        return self.tty
+
+    def write(self, text):
+        self.text += text
+
+    def flush(self):
+        pass
+
+class TestProgressReporter(unittest.TestCase):
+    def reporter(self, tty=True, **options):
+        self.now = 100.0
+        self.stream = FakeStream(tty)
+        return ProgressReporter('Counting', stream=self.stream, clock=lambda: self.now, **options)
+
+    def test_rate_limit(self):
+        progress = self.reporter(total=100, interval=1.0)
+        progress.update(10)
+        self.assertEqual(self.stream.text.count('\r'), 1)
+        ## no redraw within the interval
+        self.now += 0.5
+        progress.update(10)
+        self.assertEqual(self.stream.text.count('\r'), 1)
+        self.now += 0.5
+        progress.update(5)
+        self.assertEqual(self.stream.text.count('\r'), 2)
+        ## 25 of 100 records in 1 s: 25 records/s, 3 s to go
+        last = self.stream.text.split('\r')[-1]
+        self.assertTrue('[###-------]  25.0%' in last)
+        self.assertTrue('25 records 25 records/s' in last)
+        self.assertTrue('ETA 3s' in last)
+        progress.close()
+        self.assertTrue(self.stream.text.endswith('Done...\n'))
+        self.assertEqual(self.stream.text.count('\r'), 3)
+        ## close() draws once
+        progress.close()
+        self.assertEqual(self.stream.text.count('\r'), 3)
+
+    def test_bytes(self):
+        progress = self.reporter(total_bytes=1000)
+        self.now += 2
+        progress.update(7, 250)
+        self.assertTrue('25.0%' in self.stream.text and 'ETA 6s' in self.stream.text and '250.0 B read' in self.stream.text)
+        ## without a total: no percentage and no ETA
+        progress = self.reporter()
+        self.now += 2
+        progress.update(7, 1 << 20)
+        self.assertTrue('1.0 MB read' in self.stream.text)
+        self.assertFalse('%' in self.stream.text or 'ETA' in self.stream.text)
+
+    def test_not_a_terminal(self):
+        with self.reporter(tty=False, total=10) as progress:
+            progress.update(10)
+        self.assertEqual(self.stream.text, '')
+        with self.reporter(tty=False, enabled=True) as progress:
+            progress.update(10)
+        self.assertTrue(self.stream.text.endswith('Done...\n'))
+
+if __name__ == '__main__':
+    unittest.main()